@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# python3.7+
+
+"""
+Measures how generate_pipelines scales. Creates a directory of synthetic
+"pipeline.service.<service_name>.yml" files and runs the generator against the
+tests' mock of the Buildkite pipelines API, with optional latency and errors, then
+reports throughput, requests per pipeline, connections opened and peak memory.
+
+The mock runs in its own process, so the memory figures are the generator's alone.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import tempfile
+import time
+import tracemalloc
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+import requests
+import generate_pipelines as gp
+from test_generate_pipelines import MockServerRequestHandler, get_free_port
+
+COLLECTION = f"/{gp.ENDPOINT}"
+STATS = "/_stats"
+# how long to wait for the mock to start listening
+STARTUP_TIMEOUT = 10
+
+
+class MockBuildkite(MockServerRequestHandler):
+    """
+    The tests' mock handler, made to keep the pipelines it's sent, so the generator
+    sees creates turn into updates. Sleeps latency seconds before each response, and
+    answers error_rate of requests with a 503. Connections and requests are counted
+    by the tests' handler.
+    """
+
+    # headers and body go out in separate writes, which Nagle would hold up
+    disable_nagle_algorithm = True
+    latency = 0
+    error_rate = 0
+    pipelines = {}
+    errors = 0
+
+    @property
+    def existing(self):
+        return [self.pipelines[slug] for slug in sorted(self.pipelines)]
+
+    def _respond(self, code, body=None):
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _stats(self, url):
+        cls = MockServerRequestHandler
+        with self.lock:
+            served = [
+                method for method, path in cls.requests if urlparse(path).path != STATS
+            ]
+            # less the connection asking for the stats
+            stats = {
+                "connections": cls.connections - 1,
+                "requests": {method: served.count(method) for method in set(served)},
+                "errors": MockBuildkite.errors,
+            }
+            if "reset" in parse_qs(url.query):
+                cls.connections = 0
+                cls.requests = []
+                MockBuildkite.errors = 0
+        self._respond(200, stats)
+
+    def _handle(self):
+        url = urlparse(self.path)
+        if url.path == STATS:
+            return self._stats(url)
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.lock:
+            failed = random.random() < self.error_rate
+            if failed:
+                MockBuildkite.errors += 1
+        time.sleep(self.latency)
+        if failed:
+            return self._respond(503)
+
+        slug = url.path[len(COLLECTION) + 1 :]
+        if self.command == "GET" and url.path == COLLECTION:
+            self._list_pipelines(url)
+        elif self.command == "GET":
+            pipeline = self.pipelines.get(slug)
+            self._respond(200, pipeline) if pipeline else self._respond(404)
+        elif self.command == "POST":
+            pipeline = json.loads(body)
+            slug = pipeline["name"].lower().replace(" ", "")
+            self.pipelines[slug] = dict(pipeline, slug=slug)
+            self._respond(201, self.pipelines[slug])
+        elif self.command == "PATCH":
+            self.pipelines[slug] = dict(json.loads(body), slug=slug)
+            self._respond(200, self.pipelines[slug])
+        elif self.command == "DELETE":
+            self.pipelines.pop(slug, None)
+            self._respond(204)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+
+def serve(port, latency, error_rate, existing, seed):
+    random.seed(seed)
+    MockBuildkite.latency = latency
+    MockBuildkite.error_rate = error_rate
+    MockBuildkite.pipelines = {pipeline["slug"]: pipeline for pipeline in existing}
+    ThreadingHTTPServer(("localhost", port), MockBuildkite).serve_forever()
+
+
+class MockServer:
+    """
+    Runs MockBuildkite in a child process for the life of the with block, and points
+    the generator at it
+    """
+
+    def __init__(self, latency=0, error_rate=0, existing=(), seed=0):
+        self.port = get_free_port()
+        self.url = f"http://localhost:{self.port}"
+        self.process = multiprocessing.Process(
+            target=serve,
+            args=(self.port, latency, error_rate, list(existing), seed),
+            daemon=True,
+        )
+
+    def __enter__(self):
+        self.process.start()
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                # so waiting for it to start isn't counted
+                self.stats(reset=True)
+                break
+            except requests.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.previous_url, gp.BUILDKITE_URL = gp.BUILDKITE_URL, self.url
+        return self
+
+    def __exit__(self, *exc):
+        gp.BUILDKITE_URL = self.previous_url
+        self.process.terminate()
+        self.process.join()
+
+    def stats(self, reset=False):
+        params = {"reset": 1} if reset else None
+        return requests.get(f"{self.url}{STATS}", params=params).json()
+
+
+def make_files(path, count):
+    """
+    Writes count synthetic pipeline files to path, alternating between plain steps
+    and steps with overrides, so both paths through the template are exercised
+    """
+    files = []
+    for i in range(count):
+        file = Path(path) / f"pipeline.service.service-{i:05}.yml"
+        overrides = f"pipeline:\n  env: {{SERVICE: service-{i:05}}}\n" if i % 2 else ""
+        file.write_text(overrides + "steps:\n  - command: make deploy\n")
+        files.append(file)
+    return files
+
+
+def benchmark(
+    files=100,
+    workers=8,
+    latency=0,
+    error_rate=0,
+    existing=0.5,
+    bulk=False,
+    trace_memory=True,
+    seed=0,
+):
+    """
+    Runs the generator once over files synthetic files and returns a report of how
+    it went. existing is the fraction of pipelines the mock already has, so that
+    share are updates and the rest creates. Client pacing is lifted, as it's the
+    generator being measured, not Buildkite's rate limit.
+
+    :param files: number of pipeline files to generate
+    :param workers: passed to generate_pipelines
+    :param latency: seconds the mock waits before each response
+    :param error_rate: fraction of requests the mock answers with a 503
+    :param existing: fraction of the pipelines that already exist
+    :param bulk: passed to generate_pipelines
+    :param trace_memory: whether to measure peak memory, which slows the run
+    :param seed: for the mock's error injection
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_files(directory, files)
+        seeded = [
+            dict(pipeline.data, slug=pipeline.slug, default_branch="an-old-branch")
+            for pipeline in map(gp.Pipeline, paths[: int(files * existing)])
+        ]
+
+        unpaced = gp.TokenBucket(rate=10**9, capacity=10**9)
+        with MockServer(latency, error_rate, seeded, seed) as server:
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            failed = False
+            try:
+                gp.generate_pipelines(
+                    directory, workers=workers, bulk=bulk, bucket=unpaced
+                )
+            except (requests.RequestException, ValueError):
+                failed = True
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+            tracemalloc.stop()
+            stats = server.stats()
+
+    total = sum(stats["requests"].values())
+    return {
+        "files": files,
+        "workers": workers,
+        "latency": latency,
+        "error_rate": error_rate,
+        "bulk": bulk,
+        "seconds": elapsed,
+        "pipelines_per_second": files / elapsed if elapsed else None,
+        "requests": stats["requests"],
+        "requests_per_pipeline": total / files if files else 0,
+        "connections": stats["connections"],
+        "errors_injected": stats["errors"],
+        "failed": failed,
+        "peak_memory_bytes": peak,
+    }
+
+
+def format_report(report):
+    peak = report["peak_memory_bytes"]
+    lines = [
+        f"files                 {report['files']}",
+        f"workers               {report['workers']}",
+        f"bulk                  {report['bulk']}",
+        f"latency               {report['latency'] * 1000:.0f}ms",
+        f"error rate            {report['error_rate']:.1%}",
+        f"elapsed               {report['seconds']:.2f}s",
+        f"throughput            {report['pipelines_per_second']:.1f} pipelines/s",
+        f"requests per pipeline {report['requests_per_pipeline']:.2f}",
+        "requests              "
+        + ", ".join(f"{k} {v}" for k, v in sorted(report["requests"].items())),
+        f"connections           {report['connections']}",
+        f"errors injected       {report['errors_injected']}",
+        f"run failed            {report['failed']}",
+    ]
+    if peak is not None:
+        lines.append(f"peak memory           {peak / 2 ** 20:.1f}MiB")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark generate_pipelines against a local mock Buildkite API"
+    )
+    parser.add_argument("-n", "--files", type=int, default=500)
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 8],
+        help="worker counts to compare",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=20, help="milliseconds per response"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="fraction of requests to fail"
+    )
+    parser.add_argument(
+        "--existing",
+        type=float,
+        default=0.5,
+        help="fraction of pipelines that already exist",
+    )
+    parser.add_argument("--bulk", action="store_true")
+    parser.add_argument(
+        "--no-memory",
+        dest="trace_memory",
+        action="store_false",
+        help="skip measuring peak memory, which slows the run",
+    )
+    parser.add_argument("--json", action="store_true", help="print reports as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    reports = [
+        benchmark(
+            files=args.files,
+            workers=workers,
+            latency=args.latency / 1000,
+            error_rate=args.error_rate,
+            existing=args.existing,
+            bulk=args.bulk,
+            trace_memory=args.trace_memory,
+        )
+        for workers in args.workers
+    ]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print("\n\n".join(map(format_report, reports)))
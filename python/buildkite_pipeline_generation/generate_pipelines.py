@@ -10,59 +10,593 @@ templating out with the data blob defaulted in the class
 """
 
 import argparse
+import copy
+import hashlib
 import json
 import logging
 import os
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import requests
+import yaml
+from requests.adapters import HTTPAdapter
 
 BUILDKITE_URL = "https://api.buildkite.com"
 API_KEY = os.environ.get("BUILDKITE_API_KEY")
+ENDPOINT = "v2/organizations/an-org/pipelines"
+# slugs of the pipelines this script generates start with this
+GENERATED_PREFIX = "devops-deploy-"
+# the largest page the pipelines API will return
+PAGE_SIZE = 100
+# seconds to connect, and to wait for a response
+TIMEOUT = (5, 30)
+# attempts per request, and the backoff cap in seconds between them
+RETRIES = 5
+BACKOFF = 0.5
+BACKOFF_MAX = 30
+# Buildkite allows 200 REST calls a minute per organization
+RATE_LIMIT = 200
+RATE_WINDOW = 60
+# safe to send again if the response never arrived
+IDEMPOTENT = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+# the definition every pipeline starts from. {name} and {filename} are filled in
+# from the pipeline file
+DEFAULTS = {
+    "description": "Auto-generated pipeline for deploying {name} infrastructure",
+    "default_branch": "master",
+    "name": "DevOps - Deploy - {name}",
+    "repository": "git@github.com:an-org/a_repo.git",
+    "steps": [
+        {
+            "type": "script",
+            "name": ":pipeline: Uploading Pipeline",
+            "command": "buildkite-agent pipeline upload .buildkite/this/{filename}",
+        }
+    ],
+}
+PLACEHOLDERS = ("{name}", "{filename}")
+# A pipeline file is the steps its pipeline uploads, so settings for the pipeline
+# itself go under this key. Steps given there run after the upload step. The name
+# can't be overridden, as the slug comes from it.
+OVERRIDES_KEY = "pipeline"
+FIXED = ("name",)
 
 
 def get_files(path):
     return sorted(Path(path).glob("*.yml"))
 
 
-class Pipeline:
-    endpoint = "v2/organizations/an-org/pipelines"
+def file_digest(file):
+    return hashlib.sha256(Path(file).read_bytes()).hexdigest()
+
+
+class Manifest:
+    """
+    Local record of the mtime and hash of each pipeline file as of the last run, keyed
+    by filename, so only files that changed since need to be processed. The hash is
+    only read when the mtime has moved, so an untouched directory costs a stat a file.
+    Every file counts as changed when the template digest differs from the last run.
+    """
+
+    def __init__(self, path, template=None):
+        self.path = Path(path)
+        self.template = template
+        self.entries = json.loads(self.path.read_text()) if self.path.exists() else {}
+
+    def changes(self, path, files):
+        """
+        Returns the files that are new or whose contents changed, and the paths in
+        path of files in the manifest that are gone
+        """
+        changed = []
+        for file in files:
+            entry = self.entries.get(file.name)
+            if entry and entry.get("template") != self.template:
+                entry = None
+            mtime = file.stat().st_mtime_ns
+            if entry and entry["mtime"] == mtime:
+                continue
+            sha256 = file_digest(file)
+            if entry and entry["sha256"] == sha256:
+                # touched but the same, so there's no need to hash it next time
+                entry["mtime"] = mtime
+                continue
+            changed.append(file)
+
+        names = {file.name for file in files}
+        deleted = [
+            Path(path) / name for name in sorted(self.entries) if name not in names
+        ]
+        return changed, deleted
+
+    def update(self, files, deleted=()):
+        for file in files:
+            self.entries[file.name] = {
+                "mtime": file.stat().st_mtime_ns,
+                "sha256": file_digest(file),
+                "template": self.template,
+            }
+        for file in deleted:
+            self.entries.pop(file.name, None)
+
+    def save(self):
+        self.path.write_text(json.dumps(self.entries, indent=2, sort_keys=True))
+
+
+def changed_files(path, since):
+    """
+    The pipeline files in path that git says were added or modified since the since
+    revision, and the paths of those that were deleted
+    """
+    output = subprocess.run(
+        [
+            "git",
+            "diff",
+            "--name-status",
+            "--no-renames",
+            "--relative",
+            since,
+            "--",
+            ".",
+        ],
+        cwd=path,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+    changed, deleted = [], []
+    for line in output.splitlines():
+        status, name = line.split("\t", 1)
+        # get_files doesn't look in subdirectories either
+        if "/" in name or not name.endswith(".yml"):
+            continue
+        (deleted if status == "D" else changed).append(Path(path) / name)
+    return sorted(changed), sorted(deleted)
+
+
+class TokenBucket:
+    """
+    Paces calls to rate per second, allowing bursts of up to capacity. Kept in step
+    with the server by update, from the rate limit headers on each response. The
+    default matches Buildkite's limit, a burst of the whole window then an even pace.
+    """
+
+    def __init__(
+        self,
+        rate=RATE_LIMIT / RATE_WINDOW,
+        capacity=RATE_LIMIT,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Takes a token, sleeping until one is available. Tokens can be owed, so
+        concurrent callers queue up behind each other rather than all waking at once.
+        """
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= 1
+            wait = max(0, -self.tokens / self.rate, self.blocked_until - now)
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def update(self, remaining, reset=None):
+        """
+        Takes no more tokens than the server says are left. Once they are all gone,
+        nothing is let through until the limit resets, reset seconds from now.
+        """
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens = min(self.tokens, remaining)
+            if remaining <= 0 and reset is not None:
+                self.blocked_until = max(self.blocked_until, now + reset)
+
+    def pause(self, seconds):
+        """Lets nothing through for seconds, eg when told to Retry-After"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+
+
+class Client:
+    """
+    Wraps a requests session with timeouts, pacing and retries, with the same
+    get/post/patch/delete calls so it can be used in its place.
+
+    Every call waits on the token bucket. A 429 is retried for any method, as the
+    server didn't act on it, after its Retry-After. Connection errors and 5xx are only
+    retried for idempotent methods. Retries back off exponentially with full jitter.
+    """
+
+    def __init__(
+        self,
+        session=None,
+        bucket=None,
+        timeout=TIMEOUT,
+        retries=RETRIES,
+        backoff=None,
+        sleep=time.sleep,
+    ):
+        self.session = session or requests.Session()
+        self.bucket = bucket or TokenBucket(sleep=sleep)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = BACKOFF if backoff is None else backoff
+        self.sleep = sleep
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(BACKOFF_MAX, self.backoff * 2**attempt))
+
+    def _observe(self, r):
+        remaining = r.headers.get("RateLimit-Remaining")
+        if remaining is not None:
+            reset = r.headers.get("RateLimit-Reset")
+            self.bucket.update(int(remaining), int(reset) if reset else None)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        idempotent = method.upper() in IDEMPOTENT
+
+        for attempt in range(self.retries):
+            last = attempt == self.retries - 1
+            self.bucket.acquire()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not idempotent or last:
+                    raise
+                delay = self._delay(attempt)
+                logging.warning(
+                    "%s %s failed, retrying in %.1fs: %s", method, url, delay, e
+                )
+                self.sleep(delay)
+                continue
+
+            self._observe(r)
+            if r.status_code == 429 and not last:
+                retry_after = r.headers.get("Retry-After")
+                delay = float(retry_after) if retry_after else self._delay(attempt)
+                logging.warning(
+                    "%s %s rate limited, retrying in %.1fs", method, url, delay
+                )
+                self.bucket.pause(delay)
+            elif r.status_code >= 500 and idempotent and not last:
+                delay = self._delay(attempt)
+                logging.warning(
+                    "%s %s returned %s, retrying in %.1fs",
+                    method,
+                    url,
+                    r.status_code,
+                    delay,
+                )
+                self.sleep(delay)
+            else:
+                return r
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+def get_session(workers=1, **options):
+    """
+    A client shared by every Pipeline, so connections are pooled and reused rather
+    than each call opening its own, and all calls are paced against the one rate
+    limit. The pool is sized to the worker count. Options are passed to Client.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return Client(session, **options)
+
+
+def digest(data):
+    """A hash of data that doesn't depend on key order or whitespace"""
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def matches(local, remote):
+    """
+    Whether everything set in local is the same in remote. Buildkite adds fields of its
+    own to a pipeline, so anything only in remote is ignored.
+    """
+    if isinstance(local, dict):
+        return isinstance(remote, dict) and all(
+            key in remote and matches(value, remote[key])
+            for key, value in local.items()
+        )
+    if isinstance(local, list):
+        return (
+            isinstance(remote, list)
+            and len(local) == len(remote)
+            and all(map(matches, local, remote))
+        )
+    return local == remote
+
+
+def _compile(value):
+    """
+    Turns a definition into a function of the placeholder values that builds a fresh
+    copy of it, so the defaults are only walked and searched for placeholders once
+    """
+    if isinstance(value, dict):
+        items = [(key, _compile(item)) for key, item in value.items()]
+        return lambda context: {key: build(context) for key, build in items}
+    if isinstance(value, list):
+        builds = [_compile(item) for item in value]
+        return lambda context: [build(context) for build in builds]
+    if isinstance(value, str) and any(p in value for p in PLACEHOLDERS):
+        # replace rather than format, as commands are full of shell ${} and braces
+        def render(context):
+            result = value
+            for placeholder, replacement in context:
+                result = result.replace(placeholder, replacement)
+            return result
+
+        return render
+    return lambda context: value
+
+
+def merge(base, overrides):
+    """
+    Merges overrides into base in place. Dicts are merged key by key, lists such as
+    steps are extended, and anything else is replaced.
+    """
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge(base[key], value)
+        elif isinstance(value, list) and isinstance(base.get(key), list):
+            base[key].extend(copy.deepcopy(value))
+        else:
+            base[key] = copy.deepcopy(value)
+    return base
+
+
+class Template:
+    """
+    The definition a pipeline file's overrides are merged over. The defaults are
+    compiled once, and can be layered with a shared defaults file. The name can't be
+    overridden, as the slug comes from it, and the file's own steps are appended.
+    """
+
+    def __init__(self, defaults=None):
+        self.defaults = defaults or DEFAULTS
+        self.digest = digest(self.defaults)
+        self._build = _compile(self.defaults)
+        self._name = _compile(self.defaults["name"])
+
+    @classmethod
+    def load(cls, path):
+        """
+        A template with the yml mapping of settings at path merged over the built-in
+        defaults, leaving the name as it is
+        """
+        settings = OVERRIDES.parse(path) or {}
+        if not isinstance(settings, dict):
+            raise ValueError(f"{path} should be a mapping of pipeline settings")
+        if "name" in settings:
+            logging.warning("Ignoring name in %s, as slugs come from it", path)
+        settings = {key: value for key, value in settings.items() if key != "name"}
+        return cls(merge(copy.deepcopy(DEFAULTS), settings))
+
+    @staticmethod
+    def _context(name, filename):
+        return (("{name}", name), ("{filename}", filename))
+
+    def name(self, name, filename):
+        return self._name(self._context(name, filename))
+
+    def render(self, name, filename, overrides=None):
+        data = self._build(self._context(name, filename))
+        if overrides:
+            for key in FIXED:
+                if key in overrides:
+                    logging.warning(
+                        "Ignoring %s in %s, as slugs come from it", key, filename
+                    )
+            merge(data, {k: v for k, v in overrides.items() if k not in FIXED})
+        return data
+
+
+class OverrideCache:
+    """
+    Parsed pipeline files, keyed by the hash of their contents, so files are only
+    parsed once and files with the same contents share one copy
+    """
+
+    def __init__(self):
+        self.parsed = {}
+        self.lock = threading.Lock()
+
+    def parse(self, path):
+        """The yml file at path, parsed. None if it's empty or doesn't exist."""
+        try:
+            content = Path(path).read_bytes()
+        except FileNotFoundError:
+            return None
+        key = hashlib.sha256(content).hexdigest()
+
+        with self.lock:
+            if key in self.parsed:
+                return self.parsed[key]
+        try:
+            document = yaml.safe_load(content)
+        except yaml.YAMLError as e:
+            raise ValueError(f"{path} isn't valid YAML: {e}") from e
+        with self.lock:
+            return self.parsed.setdefault(key, document)
+
+    def load(self, path):
+        """
+        The overrides under the pipeline key of the yml file at path. A file without
+        one, such as a plain list of steps, overrides nothing.
+        """
+        document = self.parse(path)
+        if not isinstance(document, dict):
+            return {}
+        overrides = document.get(OVERRIDES_KEY) or {}
+        if not isinstance(overrides, dict):
+            raise ValueError(
+                f"{OVERRIDES_KEY} in {path} should be a mapping of pipeline settings"
+            )
+        return overrides
+
+
+OVERRIDES = OverrideCache()
+TEMPLATE = Template()
+
+
+def load_overrides(path):
+    return OVERRIDES.load(path)
+
+
+class StateCache:
+    """
+    Local record of the digest of each pipeline's data as it was last sent, keyed by
+    slug. Used to skip updates when the remote definition isn't available to compare.
+    """
 
     def __init__(self, path):
+        self.path = Path(path)
+        self.digests = json.loads(self.path.read_text()) if self.path.exists() else {}
+
+    def unchanged(self, pipeline):
+        return self.digests.get(pipeline.slug) == digest(pipeline.data)
+
+    def update(self, pipeline):
+        self.digests[pipeline.slug] = digest(pipeline.data)
+
+    def save(self):
+        self.path.write_text(json.dumps(self.digests, indent=2, sort_keys=True))
+
+
+def list_pipelines(http=requests):
+    """
+    Lists every pipeline in the organization in as few calls as possible, following
+    the Link headers page by page. Returns a dict of slug to pipeline.
+    """
+    headers = {"Authorization": f"Bearer {API_KEY}"}
+    url = f"{BUILDKITE_URL}/{ENDPOINT}"
+    params = {"per_page": PAGE_SIZE}
+    index = {}
+
+    while url:
+        r = http.get(url, params=params, headers=headers)
+        r.raise_for_status()
+        for pipeline in r.json():
+            index[pipeline["slug"]] = pipeline
+        # the next link already carries the query string
+        url = r.links.get("next", {}).get("url")
+        params = None
+
+    return index
+
+
+def find_orphans(index, pipelines):
+    """
+    Slugs of generated pipelines in the index that no longer have a file
+    """
+    wanted = {pipeline.slug for pipeline in pipelines}
+    return sorted(
+        slug
+        for slug in index
+        if slug.startswith(GENERATED_PREFIX) and slug not in wanted
+    )
+
+
+def delete_pipeline(slug, http=requests):
+    r = http.delete(
+        f"{BUILDKITE_URL}/{ENDPOINT}/{slug}",
+        headers={"Authorization": f"Bearer {API_KEY}"},
+    )
+    r.raise_for_status()
+    return r.status_code
+
+
+class Pipeline:
+    endpoint = ENDPOINT
+
+    def __init__(self, path, http=None, template=None):
+        self.http = http or requests
+        self.path = path
         self.filename = path.name
         self.name = path.name.split(".")[-2]
         self.headers = {"Authorization": f"Bearer {API_KEY}"}
-        self.data = {
-            "description": f"Auto-generated pipeline for deploying {self.name} infrastructure",
-            "default_branch": "master",
-            "name": f"DevOps - Deploy - {self.name}",
-            "repository": "git@github.com:an-org/a_repo.git",
-            "steps": [
-                {
-                    "type": "script",
-                    "name": ":pipeline: Uploading Pipeline",
-                    "command": f"buildkite-agent pipeline upload .buildkite/this/{self.filename}",
-                }
-            ],
-        }
+        self.template = template or TEMPLATE
         self.slug = self._gen_slug()
         self.responses = []
+        self.remote = None
+        self._data = None
+
+    @property
+    def data(self):
+        """
+        The definition from the template and the file's overrides, only parsed when
+        needed
+        """
+        if self._data is None:
+            self._data = self.template.render(
+                self.name, self.filename, load_overrides(self.path)
+            )
+        return self._data
 
     def _gen_slug(self):
-        return self.data["name"].lower().replace(" ", "")
+        return self.template.name(self.name, self.filename).lower().replace(" ", "")
 
     def _exists(self):
-        r = requests.get(
+        r = self.http.get(
             f"{BUILDKITE_URL}/{self.endpoint}/{self.slug}", headers=self.headers
         )
         # Only expecting 404 and 200
         if r.status_code != 404:
             r.raise_for_status()
+        if r.status_code == 200 and r.content:
+            self.remote = r.json()
 
         self.responses.append(("GET", r.status_code))
         return r.status_code == 200
 
     def _create(self):
-        r = requests.post(
+        r = self.http.post(
             f"{BUILDKITE_URL}/{self.endpoint}",
             data=json.dumps(self.data),
             headers=self.headers,
@@ -71,7 +605,7 @@ class Pipeline:
         self.responses.append(("POST", r.status_code))
 
     def _update(self):
-        r = requests.patch(
+        r = self.http.patch(
             f"{BUILDKITE_URL}/{self.endpoint}/{self.slug}",
             data=json.dumps(self.data),
             headers=self.headers,
@@ -80,28 +614,160 @@ class Pipeline:
         self.responses.append(("PATCH", r.status_code))
 
     def _delete(self):
-        r = requests.delete(
+        r = self.http.delete(
             f"{BUILDKITE_URL}/{self.endpoint}/{self.slug}", headers=self.headers
         )
         r.raise_for_status()
         return r.status_code
 
-    def review(self):
-        if not self._exists():
+    def unchanged(self, state=None):
+        """
+        Whether the pipeline already matches what would be sent. The remote definition
+        is compared when there is one, otherwise the digest in the state cache.
+        """
+        if self.remote is not None:
+            return matches(self.data, self.remote)
+        return state is not None and state.unchanged(self)
+
+    def review(self, exists=None, remote=None, state=None):
+        """
+        Creates or updates the pipeline, skipping the update if nothing has changed.
+        Pass exists and remote when they are already known, eg from list_pipelines, to
+        skip the existence check.
+        """
+        if remote is not None:
+            self.remote = remote
+        if exists is None:
+            exists = self._exists()
+
+        if not exists:
             self._create()
+        elif self.unchanged(state):
+            logging.info("%s is unchanged", self.slug)
+            self.responses.append(("SKIP", 304))
         else:
             self._update()
 
+        if state is not None:
+            state.update(self)
         return self.responses
 
 
-def generate_pipelines(path):
-    results = []
+def generate_pipelines(
+    path,
+    workers=1,
+    bulk=False,
+    prune=False,
+    state=None,
+    manifest=None,
+    since=None,
+    defaults=None,
+    bucket=None,
+):
+    """
+    Creates or updates a pipeline for every file in path. With more than one worker,
+    pipelines are reviewed concurrently over a shared connection pool.
+
+    With bulk, every pipeline in the organization is listed once up front to decide
+    between create and update, rather than checking each one. Generated pipelines
+    without a file are logged, and deleted if prune is set. Pruning is refused with
+    a ValueError when path has no pipeline files, as a mistyped or empty directory
+    would otherwise delete every generated pipeline.
 
-    for file in get_files(path):
+    Pipelines whose definition hasn't changed are not updated. With bulk, or when the
+    existence check returns the pipeline, the remote definition is compared. Otherwise
+    a local cache of digests at the state path is used.
+
+    Given a manifest path, or a git revision to diff against as since, only files that
+    were added or changed are processed. Deleted files are logged as orphans, unless
+    listing with bulk or prune finds them anyway. Files that fail are left out of the
+    manifest, so they are tried again on the next run.
+
+    Each definition is the built-in template, with the yml file at the defaults path
+    merged over it, then the pipeline key of the pipeline's own file merged over that.
+
+    Calls are paced by bucket, a TokenBucket, which defaults to Buildkite's rate limit.
+
+    Returns the responses for each pipeline processed, in file order. If any pipeline
+    fails, the rest are still reviewed before the first error is raised.
+    """
+    everything = get_files(path)
+    if prune and not everything:
+        raise ValueError(f"Refusing to prune, as there are no pipeline files in {path}")
+    files, deleted = everything, []
+    template = Template.load(defaults) if defaults else TEMPLATE
+    incremental = bool(since or manifest)
+    manifest = Manifest(manifest, template.digest) if manifest and not since else None
+    if since:
+        files, deleted = changed_files(path, since)
+    elif manifest is not None:
+        files, deleted = manifest.changes(path, everything)
+    if incremental:
+        logging.info("%s changed and %s deleted files", len(files), len(deleted))
+        if not files and not deleted:
+            if manifest is not None:
+                manifest.save()
+            return []
+
+    results = [None] * len(files)
+    errors = []
+    cache = StateCache(state) if state else None
+
+    def review(index, file):
         logging.info("Processing %s", file)
-        plan = Pipeline(file)
-        results.append(plan.review())
+        pipeline = pipelines[index]
+        try:
+            if bulk:
+                results[index] = pipeline.review(
+                    exists=pipeline.slug in existing,
+                    remote=existing.get(pipeline.slug),
+                    state=cache,
+                )
+            else:
+                results[index] = pipeline.review(state=cache)
+        except (requests.RequestException, ValueError) as e:
+            logging.error("Failed to process %s: %s", file, e)
+            errors.append(e)
+
+    with get_session(workers, bucket=bucket) as http:
+        pipelines = [Pipeline(file, http=http, template=template) for file in files]
+
+        if bulk or prune:
+            existing = list_pipelines(http)
+            # orphans are judged against every file, not just the changed ones
+            wanted = (
+                [Pipeline(file, template=template) for file in everything]
+                if incremental
+                else pipelines
+            )
+            for slug in find_orphans(existing, wanted):
+                if prune:
+                    logging.info("Deleting orphaned pipeline %s", slug)
+                    delete_pipeline(slug, http)
+                else:
+                    logging.info("Orphaned pipeline %s has no file", slug)
+        else:
+            for file in deleted:
+                slug = Pipeline(file, template=template).slug
+                logging.info("Orphaned pipeline %s has no file", slug)
+
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(review, range(len(files)), files))
+        else:
+            for index, file in enumerate(files):
+                review(index, file)
+
+    if cache is not None:
+        cache.save()
+    if manifest is not None:
+        manifest.update(
+            [file for file, result in zip(files, results) if result is not None],
+            deleted,
+        )
+        manifest.save()
+    if errors:
+        raise errors[0]
 
     return results
 
@@ -111,8 +777,53 @@ if __name__ == "__main__":
         description="Programmatically generate buildkite pipelines based on files found in the specified directory"
     )
     parser.add_argument("directory", help="the path to a directory of pipeline files")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=8,
+        help="number of pipelines to create or update at once",
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="list every pipeline once instead of checking for each one",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="delete generated pipelines that no longer have a file",
+    )
+    parser.add_argument(
+        "--state",
+        help="file to cache pipeline digests in, to skip unchanged updates",
+    )
+    changes = parser.add_mutually_exclusive_group()
+    changes.add_argument(
+        "--manifest",
+        help="file recording the pipeline files already processed, to only process changes",
+    )
+    changes.add_argument(
+        "--since",
+        metavar="REVISION",
+        help="only process files git says changed since this revision",
+    )
+    parser.add_argument(
+        "--defaults",
+        help="yml file of settings shared by every pipeline, under each file's own "
+        f"{OVERRIDES_KEY} settings",
+    )
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO, format="%(message)s")
 
-    generate_pipelines(args.directory)
+    generate_pipelines(
+        args.directory,
+        workers=args.workers,
+        bulk=args.bulk,
+        prune=args.prune,
+        state=args.state,
+        manifest=args.manifest,
+        since=args.since,
+        defaults=args.defaults,
+    )
@@ -1,8 +1,10 @@
 import generate_pipelines as gp
 import socket
+import subprocess
 import threading
 import json
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 import pytest
 import requests
 
@@ -24,13 +26,78 @@ def gen_expected(name, filename):
 
 
 class MockServerRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, so connection reuse can be measured
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    lock = threading.Lock()
+    # every (method, path) served, and the slugs the collection endpoint lists
+    requests = []
+    existing = []
+    # how many of the next requests to turn away with a 429
+    throttled = 0
+
+    def setup(self):
+        super().setup()
+        with MockServerRequestHandler.lock:
+            MockServerRequestHandler.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_response(self, code, message=None):
+        with MockServerRequestHandler.lock:
+            MockServerRequestHandler.requests.append((self.command, self.path))
+        super().send_response(code, message)
+
+    def _list_pipelines(self, url):
+        query = parse_qs(url.query)
+        per_page = int(query.get("per_page", ["30"])[0])
+        page = int(query.get("page", ["1"])[0])
+        slugs = self.existing[(page - 1) * per_page : page * per_page]
+        # entries are either full pipeline definitions or just slugs
+        body = json.dumps(
+            [slug if isinstance(slug, dict) else {"slug": slug} for slug in slugs]
+        ).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if page * per_page < len(self.existing):
+            next_url = f"http://{self.headers['Host']}{url.path}?page={page + 1}&per_page={per_page}"
+            self.send_header("Link", f'<{next_url}>; rel="next"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _throttle(self):
+        with MockServerRequestHandler.lock:
+            throttled = MockServerRequestHandler.throttled > 0
+            if throttled:
+                MockServerRequestHandler.throttled -= 1
+        if not throttled:
+            return False
+
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(429)
+        self.send_header("Retry-After", "0")
+        self.send_header("RateLimit-Remaining", "0")
+        self.send_header("RateLimit-Reset", "0")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return True
+
     def _set_headers(self, code):
         self.send_response(code)
         self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def do_GET(self):
-        if (
+        if self._throttle():
+            return
+        url = urlparse(self.path)
+        if url.path == "/v2/organizations/an-org/pipelines":
+            self._list_pipelines(url)
+        elif (
             self.path
             == "/v2/organizations/an-org/pipelines/devops-deploy-not-a-pipeline"
         ):
@@ -46,17 +113,23 @@ class MockServerRequestHandler(BaseHTTPRequestHandler):
         return
 
     def do_POST(self):
+        if self._throttle():
+            return
         self._set_headers(201)
         # read the data param that requests sends
         print(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
         return
 
     def do_PATCH(self):
+        if self._throttle():
+            return
         self._set_headers(200)
         print(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
         return
 
     def do_DELETE(self):
+        if self._throttle():
+            return
         self._set_headers(204)
         return
 
@@ -74,12 +147,18 @@ def mock_server():
     port = get_free_port()
     gp.BUILDKITE_URL = f"http://localhost:{port}"
 
-    mock_server = HTTPServer(("localhost", port), MockServerRequestHandler)
+    MockServerRequestHandler.connections = 0
+    MockServerRequestHandler.requests = []
+    MockServerRequestHandler.existing = []
+    MockServerRequestHandler.throttled = 0
+    gp.BACKOFF = 0
+    mock_server = ThreadingHTTPServer(("localhost", port), MockServerRequestHandler)
     mock_server_thread = threading.Thread(target=mock_server.serve_forever, daemon=True)
     yield mock_server_thread
 
     mock_server.shutdown()
     gp.BUILDKITE_URL = "https://api.buildkite.com"
+    gp.BACKOFF = 0.5
 
 
 class TestUnit:
@@ -236,6 +315,564 @@ class TestFunctional:
         )
 
 
+class TestConcurrency:
+    def test_serial_run_reuses_one_connection(self, tmp_path, capsys, mock_server):
+        for i in range(5):
+            (tmp_path / f"pipeline.service.is-a-pipeline-{i}.yml").write_text("")
+
+        mock_server.start()
+
+        result = gp.generate_pipelines(tmp_path)
+
+        assert result == [[("GET", 200), ("PATCH", 200)]] * 5
+        assert MockServerRequestHandler.connections == 1
+
+    def test_concurrent_run_pools_connections(self, tmp_path, capsys, mock_server):
+        for i in range(20):
+            (tmp_path / f"pipeline.service.is-a-pipeline-{i:02}.yml").write_text("")
+        (tmp_path / "pipeline.service.not-a-pipeline.yml").write_text("")
+
+        mock_server.start()
+
+        result = gp.generate_pipelines(tmp_path, workers=4)
+        captured = capsys.readouterr()
+
+        # results stay in file order
+        assert result == [[("GET", 200), ("PATCH", 200)]] * 20 + [
+            [("GET", 404), ("POST", 201)]
+        ]
+        assert len(captured.out.splitlines()) == 21
+        assert MockServerRequestHandler.connections <= 4
+
+    def test_concurrent_run_finishes_before_raising(
+        self, tmp_path, capsys, mock_server
+    ):
+        (tmp_path / "pipeline.service.is-a-pipeline.yml").write_text("")
+        (tmp_path / "pipeline.service.should-raise-exception.yml").write_text("")
+        (tmp_path / "pipeline.service.zz-is-a-pipeline.yml").write_text("")
+
+        mock_server.start()
+
+        with pytest.raises(requests.HTTPError):
+            gp.generate_pipelines(tmp_path, workers=2)
+        captured = capsys.readouterr()
+
+        # both good pipelines were still updated
+        assert len(captured.out.splitlines()) == 2
+
+
+class TestBulkListing:
+    def test_list_pipelines_follows_pages(self, mock_server):
+        MockServerRequestHandler.existing = [f"pipeline-{i}" for i in range(250)]
+
+        mock_server.start()
+
+        index = gp.list_pipelines()
+
+        assert list(index) == MockServerRequestHandler.existing
+        assert [method for method, _ in MockServerRequestHandler.requests] == [
+            "GET"
+        ] * 3
+        assert MockServerRequestHandler.requests[0][1].endswith("?per_page=100")
+
+    def test_find_orphans(self, tmp_path):
+        index = {
+            "devops-deploy-is-a-pipeline": {},
+            "devops-deploy-orphan": {},
+            "someone-elses-pipeline": {},
+        }
+        pipelines = [gp.Pipeline(tmp_path / "pipeline.service.is-a-pipeline.yml")]
+
+        assert gp.find_orphans(index, pipelines) == ["devops-deploy-orphan"]
+
+    def test_bulk_run_skips_existence_checks(self, tmp_path, capsys, mock_server):
+        (tmp_path / "pipeline.service.is-a-pipeline.yml").write_text("")
+        (tmp_path / "pipeline.service.not-a-pipeline.yml").write_text("")
+        MockServerRequestHandler.existing = ["devops-deploy-is-a-pipeline"]
+
+        mock_server.start()
+
+        result = gp.generate_pipelines(tmp_path, bulk=True)
+
+        assert result == [[("PATCH", 200)], [("POST", 201)]]
+        # one listing instead of a GET per pipeline
+        assert [method for method, _ in MockServerRequestHandler.requests] == [
+            "GET",
+            "PATCH",
+            "POST",
+        ]
+
+    def test_prune_deletes_orphans(self, tmp_path, capsys, mock_server):
+        (tmp_path / "pipeline.service.is-a-pipeline.yml").write_text("")
+        MockServerRequestHandler.existing = [
+            "devops-deploy-is-a-pipeline",
+            "devops-deploy-orphan",
+            "someone-elses-pipeline",
+        ]
+
+        mock_server.start()
+
+        gp.generate_pipelines(tmp_path, bulk=True, prune=True)
+
+        assert (
+            "DELETE",
+            "/v2/organizations/an-org/pipelines/devops-deploy-orphan",
+        ) in MockServerRequestHandler.requests
+        assert [method for method, _ in MockServerRequestHandler.requests].count(
+            "DELETE"
+        ) == 1
+
+    def test_prune_refuses_without_files(self, tmp_path, mock_server):
+        MockServerRequestHandler.existing = ["devops-deploy-is-a-pipeline"]
+
+        mock_server.start()
+
+        for path in (tmp_path, tmp_path / "mistyped"):
+            with pytest.raises(ValueError):
+                gp.generate_pipelines(path, bulk=True, prune=True)
+        assert MockServerRequestHandler.requests == []
+
+
+class TestDiffing:
+    def test_matches_ignores_remote_only_fields(self):
+        local = {"name": "a", "steps": [{"command": "x"}]}
+
+        assert gp.matches(local, {"name": "a", "id": 1, "steps": [{"command": "x"}]})
+        assert not gp.matches(local, {"name": "b", "steps": [{"command": "x"}]})
+        assert not gp.matches(local, {"name": "a", "steps": []})
+        assert not gp.matches(local, {"steps": [{"command": "x"}]})
+
+    def test_digest_ignores_key_order(self):
+        assert gp.digest({"a": 1, "b": [1, 2]}) == gp.digest({"b": [1, 2], "a": 1})
+        assert gp.digest({"a": 1}) != gp.digest({"a": 2})
+
+    def test_bulk_run_skips_unchanged_pipeline(self, tmp_path, capsys, mock_server):
+        fp = tmp_path / "pipeline.service.is-a-pipeline.yml"
+        fp.write_text("")
+        pipeline = gp.Pipeline(fp)
+        MockServerRequestHandler.existing = [
+            dict(pipeline.data, slug=pipeline.slug, id="an-id")
+        ]
+
+        mock_server.start()
+
+        result = gp.generate_pipelines(tmp_path, bulk=True)
+
+        assert result == [[("SKIP", 304)]]
+        assert [method for method, _ in MockServerRequestHandler.requests] == ["GET"]
+
+    def test_bulk_run_updates_changed_pipeline(self, tmp_path, capsys, mock_server):
+        fp = tmp_path / "pipeline.service.is-a-pipeline.yml"
+        fp.write_text("")
+        pipeline = gp.Pipeline(fp)
+        MockServerRequestHandler.existing = [
+            dict(pipeline.data, slug=pipeline.slug, default_branch="main")
+        ]
+
+        mock_server.start()
+
+        assert gp.generate_pipelines(tmp_path, bulk=True) == [[("PATCH", 200)]]
+
+    def test_state_cache_skips_second_run(self, tmp_path, capsys, mock_server):
+        pipelines = tmp_path / "pipelines"
+        pipelines.mkdir()
+        (pipelines / "pipeline.service.is-a-pipeline.yml").write_text("")
+        state = tmp_path / "state.json"
+
+        mock_server.start()
+
+        first = gp.generate_pipelines(pipelines, state=state)
+        second = gp.generate_pipelines(pipelines, state=state)
+
+        assert first == [[("GET", 200), ("PATCH", 200)]]
+        assert second == [[("GET", 200), ("SKIP", 304)]]
+        assert json.loads(state.read_text()) == {
+            "devops-deploy-is-a-pipeline": gp.digest(
+                gp.Pipeline(pipelines / "pipeline.service.is-a-pipeline.yml").data
+            )
+        }
+
+
+class TestIncremental:
+    def make_files(self, path, *names):
+        path.mkdir()
+        for name in names:
+            (path / f"pipeline.service.{name}.yml").write_text(f"# {name}\n")
+        return path
+
+    def test_manifest_skips_unchanged_files(self, tmp_path, capsys, mock_server):
+        pipelines = self.make_files(
+            tmp_path / "pipelines", "is-a-pipeline", "not-a-pipeline"
+        )
+        manifest = tmp_path / "manifest.json"
+
+        mock_server.start()
+
+        first = gp.generate_pipelines(pipelines, manifest=manifest)
+        calls = len(MockServerRequestHandler.requests)
+        second = gp.generate_pipelines(pipelines, manifest=manifest)
+
+        assert len(first) == 2
+        assert second == []
+        assert len(MockServerRequestHandler.requests) == calls
+
+    def test_manifest_picks_up_changed_files(self, tmp_path, capsys, mock_server):
+        pipelines = self.make_files(
+            tmp_path / "pipelines", "is-a-pipeline", "not-a-pipeline"
+        )
+        manifest = tmp_path / "manifest.json"
+
+        mock_server.start()
+
+        gp.generate_pipelines(pipelines, manifest=manifest)
+        (pipelines / "pipeline.service.is-a-pipeline.yml").write_text("env: {A: b}")
+        # touched with the same contents, so it isn't processed
+        (pipelines / "pipeline.service.not-a-pipeline.yml").write_text(
+            "# not-a-pipeline\n"
+        )
+        result = gp.generate_pipelines(pipelines, manifest=manifest)
+
+        assert result == [[("GET", 200), ("PATCH", 200)]]
+
+    def test_manifest_drops_deleted_files(self, tmp_path, capsys, mock_server):
+        pipelines = self.make_files(tmp_path / "pipelines", "is-a-pipeline", "gone")
+        manifest = tmp_path / "manifest.json"
+
+        mock_server.start()
+
+        gp.generate_pipelines(pipelines, manifest=manifest)
+        (pipelines / "pipeline.service.gone.yml").unlink()
+        result = gp.generate_pipelines(pipelines, manifest=manifest)
+
+        assert result == []
+        assert list(json.loads(manifest.read_text())) == [
+            "pipeline.service.is-a-pipeline.yml"
+        ]
+
+    def test_manifest_retries_failed_files(self, tmp_path, capsys, mock_server):
+        pipelines = self.make_files(tmp_path / "pipelines", "should-raise-exception")
+        manifest = tmp_path / "manifest.json"
+
+        mock_server.start()
+
+        with pytest.raises(requests.HTTPError):
+            gp.generate_pipelines(pipelines, manifest=manifest)
+
+        assert json.loads(manifest.read_text()) == {}
+
+    def test_changed_files_since_revision(self, tmp_path):
+        pipelines = self.make_files(
+            tmp_path / "pipelines", "same", "changed", "deleted"
+        )
+
+        def git(*args):
+            subprocess.run(
+                ["git", *args], cwd=tmp_path, check=True, capture_output=True
+            )
+
+        git("init", "-q")
+        git("add", ".")
+        git(
+            "-c",
+            "user.name=test",
+            "-c",
+            "user.email=test@example.com",
+            "commit",
+            "-qm",
+            "base",
+        )
+        (pipelines / "pipeline.service.changed.yml").write_text("new contents")
+        (pipelines / "pipeline.service.deleted.yml").unlink()
+        (pipelines / "pipeline.service.added.yml").write_text("")
+        (pipelines / "README.md").write_text("")
+        git("add", ".")
+
+        changed, deleted = gp.changed_files(pipelines, "HEAD")
+
+        assert [file.name for file in changed] == [
+            "pipeline.service.added.yml",
+            "pipeline.service.changed.yml",
+        ]
+        assert [file.name for file in deleted] == ["pipeline.service.deleted.yml"]
+
+
+class TestTemplates:
+    def test_empty_file_renders_defaults(self, tmp_path):
+        fp = tmp_path / "pipeline.service.test.yml"
+        fp.write_text("")
+
+        assert gp.Pipeline(fp).data == {
+            "description": "Auto-generated pipeline for deploying test infrastructure",
+            "default_branch": "master",
+            "name": "DevOps - Deploy - test",
+            "repository": "git@github.com:an-org/a_repo.git",
+            "steps": [
+                {
+                    "type": "script",
+                    "name": ":pipeline: Uploading Pipeline",
+                    "command": "buildkite-agent pipeline upload .buildkite/this/pipeline.service.test.yml",
+                }
+            ],
+        }
+
+    def test_file_overrides_are_merged(self, tmp_path, caplog):
+        fp = tmp_path / "pipeline.service.test.yml"
+        fp.write_text(
+            "pipeline:\n"
+            "  default_branch: main\n"
+            "  name: ignored\n"
+            "  env: {REGION: us-east-1}\n"
+            "  steps:\n"
+            "    - command: make notify\n"
+            "env: {TIER: dev}\n"
+            "agents: {queue: deploy}\n"
+            "steps:\n"
+            "  - command: echo ${BUILDKITE_BRANCH}\n"
+        )
+
+        pipeline = gp.Pipeline(fp)
+
+        assert pipeline.slug == "devops-deploy-test"
+        assert pipeline.data["name"] == "DevOps - Deploy - test"
+        assert pipeline.data["default_branch"] == "main"
+        assert pipeline.data["env"] == {"REGION": "us-east-1"}
+        assert "agents" not in pipeline.data
+        # steps under pipeline run after the upload; the file's own are uploaded
+        assert [step["command"] for step in pipeline.data["steps"]] == [
+            "buildkite-agent pipeline upload .buildkite/this/pipeline.service.test.yml",
+            "make notify",
+        ]
+        assert "Ignoring name in pipeline.service.test.yml" in caplog.text
+
+    def test_steps_files_render_defaults(self, tmp_path):
+        steps = tmp_path / "pipeline.service.steps.yml"
+        steps.write_text("steps:\n  - command: make deploy\n")
+        listed = tmp_path / "pipeline.service.listed.yml"
+        listed.write_text("- command: make deploy\n")
+
+        for fp in (steps, listed):
+            name = fp.name.split(".")[-2]
+            assert gp.Pipeline(fp).data == gp.TEMPLATE.render(name, fp.name)
+
+    def test_defaults_file_cant_rename(self, tmp_path):
+        defaults = tmp_path / "defaults.yml"
+        defaults.write_text("name: Team - {name}\ndefault_branch: main\n")
+
+        pipeline = gp.Pipeline(
+            tmp_path / "pipeline.service.x.yml", template=gp.Template.load(defaults)
+        )
+
+        assert pipeline.slug == "devops-deploy-x"
+        assert pipeline.data["default_branch"] == "main"
+
+    def test_defaults_file_is_layered_under_overrides(self, tmp_path):
+        defaults = tmp_path / "defaults.yml"
+        defaults.write_text(
+            "repository: git@github.com:an-org/another_repo.git\n"
+            "env: {REGION: us-east-1, TIER: prod}\n"
+        )
+        fp = tmp_path / "pipeline.service.test.yml"
+        fp.write_text("pipeline:\n  env: {TIER: dev}\n")
+
+        pipeline = gp.Pipeline(fp, template=gp.Template.load(defaults))
+
+        assert pipeline.data["repository"] == "git@github.com:an-org/another_repo.git"
+        assert pipeline.data["env"] == {"REGION": "us-east-1", "TIER": "dev"}
+        # rendering doesn't leak into the template or the next pipeline
+        assert gp.Pipeline(tmp_path / "pipeline.service.other.yml").data == (
+            gp.TEMPLATE.render("other", "pipeline.service.other.yml")
+        )
+
+    def test_same_contents_are_parsed_once(self, tmp_path, monkeypatch):
+        parsed = []
+        safe_load = gp.yaml.safe_load
+        monkeypatch.setattr(
+            gp.yaml,
+            "safe_load",
+            lambda content: parsed.append(content) or safe_load(content),
+        )
+        cache = gp.OverrideCache()
+        for name in ("a", "b", "c"):
+            (tmp_path / f"pipeline.service.{name}.yml").write_text(
+                "pipeline:\n  env: {A: b}\n"
+            )
+
+        loaded = [cache.load(file) for file in gp.get_files(tmp_path)]
+
+        assert len(parsed) == 1
+        assert loaded[0] is loaded[1] is loaded[2]
+
+    def test_bad_file_fails_that_pipeline(self, tmp_path, capsys, mock_server):
+        (tmp_path / "pipeline.service.is-a-pipeline.yml").write_text("")
+        (tmp_path / "pipeline.service.not-a-pipeline.yml").write_text(
+            "pipeline:\n  - a list\n"
+        )
+
+        mock_server.start()
+
+        with pytest.raises(ValueError):
+            gp.generate_pipelines(tmp_path)
+        # the good pipeline was still updated
+        assert len(capsys.readouterr().out.splitlines()) == 1
+
+    def test_defaults_change_invalidates_manifest(self, tmp_path, capsys, mock_server):
+        pipelines = tmp_path / "pipelines"
+        pipelines.mkdir()
+        (pipelines / "pipeline.service.is-a-pipeline.yml").write_text("")
+        defaults = tmp_path / "defaults.yml"
+        defaults.write_text("default_branch: main\n")
+        manifest = tmp_path / "manifest.json"
+
+        mock_server.start()
+
+        gp.generate_pipelines(pipelines, manifest=manifest, defaults=defaults)
+        unchanged = gp.generate_pipelines(
+            pipelines, manifest=manifest, defaults=defaults
+        )
+        defaults.write_text("default_branch: trunk\n")
+        changed = gp.generate_pipelines(pipelines, manifest=manifest, defaults=defaults)
+
+        assert unchanged == []
+        assert changed == [[("GET", 200), ("PATCH", 200)]]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def fake_response(code, **headers):
+    r = requests.Response()
+    r.status_code = code
+    r.headers.update(headers)
+    return r
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, kwargs))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class TestRateLimiting:
+    def test_bucket_allows_burst_then_paces(self):
+        clock = FakeClock()
+        bucket = gp.TokenBucket(rate=1, capacity=2, clock=clock, sleep=clock.sleep)
+
+        waits = [bucket.acquire() for _ in range(4)]
+
+        assert waits == [0, 0, 1, 1]
+        assert clock.now == 2
+
+    def test_bucket_waits_for_reset_when_exhausted(self):
+        clock = FakeClock()
+        bucket = gp.TokenBucket(rate=1, capacity=10, clock=clock, sleep=clock.sleep)
+
+        bucket.update(remaining=0, reset=30)
+
+        assert bucket.acquire() == 30
+
+    def test_client_honours_retry_after(self):
+        clock = FakeClock()
+        bucket = gp.TokenBucket(clock=clock, sleep=clock.sleep)
+        session = FakeSession(
+            fake_response(429, **{"Retry-After": "7"}), fake_response(200)
+        )
+        client = gp.Client(session, bucket=bucket, sleep=clock.sleep)
+
+        r = client.post("http://localhost/")
+
+        assert r.status_code == 200
+        assert clock.slept == [7]
+        # 429s weren't acted on, so even a POST is sent again
+        assert [method for method, _ in session.calls] == ["POST", "POST"]
+
+    def test_client_applies_timeout(self):
+        session = FakeSession(fake_response(200))
+        client = gp.Client(session, timeout=3)
+
+        client.get("http://localhost/")
+
+        assert session.calls[0][1]["timeout"] == 3
+
+    def test_client_only_retries_idempotent_calls_on_error(self):
+        error = requests.ConnectionError("reset")
+        get = FakeSession(error, fake_response(503), fake_response(200))
+        post = FakeSession(error, fake_response(200))
+
+        assert gp.Client(get, backoff=0).get("http://localhost/").status_code == 200
+        with pytest.raises(requests.ConnectionError):
+            gp.Client(post, backoff=0).post("http://localhost/")
+        assert len(post.calls) == 1
+
+    def test_client_gives_up_after_retries(self):
+        session = FakeSession(*[fake_response(503)] * 3)
+        client = gp.Client(session, retries=3, backoff=0)
+
+        assert client.get("http://localhost/").status_code == 503
+        assert len(session.calls) == 3
+
+    def test_run_survives_rate_limiting(self, tmp_path, capsys, mock_server):
+        (tmp_path / "pipeline.service.is-a-pipeline.yml").write_text("")
+        (tmp_path / "pipeline.service.not-a-pipeline.yml").write_text("")
+        MockServerRequestHandler.throttled = 3
+
+        mock_server.start()
+
+        result = gp.generate_pipelines(tmp_path, workers=2)
+
+        assert sorted(result) == sorted(
+            [[("GET", 200), ("PATCH", 200)], [("GET", 404), ("POST", 201)]]
+        )
+        # every call that was turned away was sent again
+        assert len(MockServerRequestHandler.requests) == 4 + 3
+
+
+@pytest.fixture
+def bench():
+    # imported here rather than at the top, as the benchmark builds on the mock above
+    import benchmark_generate_pipelines
+
+    return benchmark_generate_pipelines
+
+
+class TestBenchmark:
+    def test_reports_request_pattern(self, bench):
+        report = bench.benchmark(files=6, workers=2)
+
+        assert not report["failed"]
+        assert report["requests"] == {"GET": 6, "PATCH": 3, "POST": 3}
+        assert report["requests_per_pipeline"] == 2
+        assert 1 <= report["connections"] <= 2
+        assert report["peak_memory_bytes"] > 0
+
+    def test_bulk_lists_once(self, bench):
+        report = bench.benchmark(files=6, workers=2, bulk=True, trace_memory=False)
+
+        assert report["requests"] == {"GET": 1, "PATCH": 3, "POST": 3}
+
+    def test_injected_errors_fail_the_run(self, bench):
+        report = bench.benchmark(files=4, error_rate=1, trace_memory=False)
+
+        assert report["failed"]
+        assert report["errors_injected"] == sum(report["requests"].values())
+
+
 class TestIntegration:
     """
     Calls Buildkite API. Will test for presence of API key
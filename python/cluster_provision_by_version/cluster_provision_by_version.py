@@ -7,8 +7,21 @@
 
 
 import argparse
+import codecs
+import fcntl
+import hashlib
+import itertools
+import json
+import os
+import re
 import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 
 # update as required
 ENDPOINTS = {
@@ -17,26 +30,452 @@ ENDPOINTS = {
     "prod": "ccc33ccccc",
     "cde_prod": "4ddddddd44",
 }
+ENVS = ["dev", "qa", "sb", "prod"]
+# {endpoint} is filled in from ENDPOINTS
+API_URL = "https://{endpoint}.execute-api.ap-southeast-2.amazonaws.com/live"
+# seconds to connect, and to wait for the dashboard to answer
+TIMEOUT = (5, 30)
+# buildkite-agent processes to run at once when storing metadata
+MAX_WORKERS = 8
+# bytes to read from the dashboard at a time when streaming its response
+CHUNK_SIZE = 16384
+# where dashboard responses are cached between builds on the same host
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "cluster_provision_by_version",
+)
 
 
-def get_service_request(endpoint, env, key):
+class MetadataError(Exception):
+    """
+    Raised once every key has been tried, if any of them couldn't be set
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__(
+            f"Failed to set {len(failures)} metadata keys: {', '.join(failures)}"
+        )
+
+
+class FetchError(Exception):
+    """
+    Raised once every account and env has been tried, if any of them failed
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        targets = ", ".join(f"{account}/{env}" for account, env in failures)
+        super().__init__(f"Failed to fetch versions for {targets}")
+
+
+class PayloadError(Exception):
+    """
+    Raised once the versions that could be read have been stored, if the dashboard's
+    response as a whole is missing, malformed or cut off
+    """
+
+
+class ResponseCache:
+    """
+    Dashboard responses on disk, keyed by (endpoint, env, api key), shared by every
+    build on the host. Only a hash of the key is kept, so builds with different keys
+    never share an entry and the key itself never lands on disk. An entry younger
+    than ttl seconds is used as is. An older one is revalidated with its ETag when
+    the dashboard sent one.
+
+    Entries are replaced atomically, so readers never see half a file. A miss takes
+    a lock on the key, so when several builds miss at once only one of them calls the
+    dashboard and the rest use what it fetched.
+    """
+
+    def __init__(self, directory=CACHE_DIR, ttl=60, clock=time.time):
+        self.directory = directory
+        self.ttl = ttl
+        self.clock = clock
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, endpoint, env, key, suffix=".json"):
+        key_hash = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        name = hashlib.sha256(f"{endpoint}/{env}/{key_hash}".encode("utf-8"))
+        return os.path.join(self.directory, name.hexdigest() + suffix)
+
+    def get(self, endpoint, env, key):
+        """
+        Returns the cached entry, or None if there isn't a readable one
+        """
+        try:
+            with open(self._path(endpoint, env, key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def fresh(self, entry):
+        return entry is not None and self.clock() - entry["fetched"] < self.ttl
+
+    def put(self, endpoint, env, key, body, etag=None):
+        entry = {"fetched": self.clock(), "etag": etag, "body": body}
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.replace(temp, self._path(endpoint, env, key))
+        except BaseException:
+            os.unlink(temp)
+            raise
+        return entry
+
+    @contextmanager
+    def lock(self, endpoint, env, key):
+        with open(self._path(endpoint, env, key, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def cached_response(entry):
+    """
+    A response built from a cache entry, so callers can't tell it from a fetch
+    """
+    r = requests.Response()
+    r.status_code = 200
+    r._content = entry["body"].encode("utf-8")
+    r._content_consumed = True
+    r.encoding = "utf-8"
+    if entry["etag"]:
+        r.headers["ETag"] = entry["etag"]
+    return r
+
+
+def cacheable(request):
+    """
+    Whether a dashboard response is worth caching: its payload is an array with at
+    least one valid service record, so error payloads aren't kept for the next build
+    """
+    try:
+        return bool(get_versions(request))
+    except PayloadError:
+        return False
+
+
+def get_service_request(
+    endpoint, env, key, http=requests, timeout=TIMEOUT, cache=None, stream=False
+):
     """
     Calls the relevant AWS Apigateway endpoint with the required api key
-    and passes the environment to get a response from the dashboard service
+    and passes the environment to get a response from the dashboard service.
+    Given a ResponseCache, a fresh cached response is returned without calling
+    the dashboard, and a response is only cached once its payload has been checked.
+    With stream, the body is left to be read as it arrives.
 
     Returns the request object
     """
 
-    url = f"https://{endpoint}.execute-api.ap-southeast-2.amazonaws.com/live"
+    if cache is None:
+        return _post_service_request(endpoint, env, key, http, timeout, stream=stream)
+
+    entry = cache.get(endpoint, env, key)
+    if cache.fresh(entry):
+        return cached_response(entry)
+
+    with cache.lock(endpoint, env, key):
+        # another build may have fetched it while this one waited for the lock
+        entry = cache.get(endpoint, env, key)
+        if cache.fresh(entry):
+            return cached_response(entry)
+
+        etag = entry["etag"] if entry else None
+        r = _post_service_request(endpoint, env, key, http, timeout, etag)
+        if r.status_code == 304 and entry:
+            return cached_response(cache.put(endpoint, env, key, entry["body"], etag))
+        if cacheable(r):
+            cache.put(endpoint, env, key, r.text, r.headers.get("ETag"))
+        return r
+
+
+def _post_service_request(endpoint, env, key, http, timeout, etag=None, stream=False):
+    url = API_URL.format(endpoint=endpoint)
     data = {"env": f"{env}"}
     headers = {"content-Type": "x-www-form-urlencoded", "x-api-key": f"{key}"}
+    if etag:
+        headers["If-None-Match"] = etag
 
-    r = requests.post(url, json=data, headers=headers)
+    r = http.post(url, json=data, headers=headers, timeout=timeout, stream=stream)
     r.raise_for_status()
     return r
 
 
-def store_versions(request):
+def get_session(workers=1):
+    """
+    A requests session whose connection pools hold workers connections, so
+    concurrent calls to the same endpoint reuse them
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def load_keys(path):
+    """
+    Reads the api keys to fan out with from a json file. Each account maps to either
+    one key for all its envs, or a mapping of env to key. Only the account and env
+    pairs with a key are queried.
+
+    eg:
+    {"nonprod": {"dev": "key1", "qa": "key2"}, "prod": "key3"}
+
+    Returns a dict of (account, env) to key
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    keys = {}
+    for account, value in config.items():
+        if account not in ENDPOINTS:
+            raise ValueError(f"Unknown account {account} in {path}")
+        per_env = value if isinstance(value, dict) else dict.fromkeys(ENVS, value)
+        for env, key in per_env.items():
+            if env not in ENVS:
+                raise ValueError(f"Unknown env {env} for {account} in {path}")
+            keys[(account, env)] = key
+    return keys
+
+
+def fetch_versions(keys, timeout=TIMEOUT, cache=None):
+    """
+    Queries the dashboard for every (account, env) in keys at once, over one pooled
+    session, so it takes about as long as the slowest single call. A pair that fails
+    doesn't stop the rest.
+
+    Returns a dict of (account, env) to the response, and a dict of each pair that
+    failed to why
+    """
+    results, failures = {}, {}
+    if not keys:
+        return results, failures
+
+    with get_session(len(keys)) as http, ThreadPoolExecutor(len(keys)) as pool:
+        futures = {
+            (account, env): pool.submit(
+                get_service_request,
+                ENDPOINTS[account],
+                env,
+                key,
+                http,
+                timeout,
+                cache,
+            )
+            for (account, env), key in keys.items()
+        }
+        for target, future in futures.items():
+            try:
+                results[target] = future.result()
+            except requests.RequestException as e:
+                failures[target] = str(e)
+    return results, failures
+
+
+def set_metadata(key, value):
+    """
+    Stores a single key with the buildkite agent, which only takes one key per call.
+    The value is fed on stdin, so it's never mistaken for an option.
+    """
+    subprocess.run(
+        ["buildkite-agent", "meta-data", "set", key],
+        input=value,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+
+def write_metadata(metadata, max_workers=MAX_WORKERS):
+    """
+    Stores every key in metadata, a dict or an iterable of (key, value) pairs,
+    running up to max_workers agent processes at once. The agent has no way to set
+    more than one key per process, and each spends most of its time waiting on the
+    agent API, so overlapping them is what saves time. Pairs are written as they
+    come, so a stream can start being stored before it ends. A key that fails
+    doesn't stop the rest.
+
+    Returns a dict of each key that failed to why
+    """
+    pairs = metadata.items() if isinstance(metadata, dict) else metadata
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for key, value in pairs:
+            print(f"Setting {key}={value}")
+            futures[key] = pool.submit(set_metadata, key, value)
+
+    failures = {}
+    for key, future in futures.items():
+        try:
+            future.result()
+        except subprocess.CalledProcessError as e:
+            failures[key] = (e.stderr or "").strip() or str(e)
+        except OSError as e:
+            failures[key] = str(e)
+    return failures
+
+
+WHITESPACE = re.compile(r"\s*")
+# what the rest of a number could be made of, if it hasn't all arrived
+NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+
+
+def iter_json_array(chunks):
+    """
+    Parses a JSON array from an iterable of text chunks, yielding each item as soon
+    as it has fully arrived rather than waiting for the whole document
+
+    Raises ValueError if the document isn't an array, or is cut off or malformed,
+    after yielding every item before the problem
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, count = "", 0, 0
+    # where in the array the parser is: before the [, before an item or the ], after
+    # an item, after a comma, or past the ]
+    state = "start"
+
+    # a final None marks the end of the input
+    for chunk in itertools.chain(chunks, [None]):
+        buffer = buffer[pos:] + (chunk or "")
+        pos = 0
+        while True:
+            pos = WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            char = buffer[pos]
+            if state == "start":
+                if char != "[":
+                    raise ValueError("the payload isn't a JSON array")
+                state = "first"
+                pos += 1
+                continue
+            if state == "end":
+                raise ValueError("the payload carries on after the array")
+            if state == "item":
+                if char == "]":
+                    state = "end"
+                elif char == ",":
+                    state = "comma"
+                else:
+                    raise ValueError(f"the payload is malformed after item {count}")
+                pos += 1
+                continue
+            if char == "]":
+                if state == "comma":
+                    raise ValueError(
+                        f"the payload has a trailing comma after item {count}"
+                    )
+                state = "end"
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # not all here yet, unless this is the end
+                break
+            if (
+                chunk is not None
+                and type(item) in (int, float)
+                and NUMBER_TAIL.match(buffer, end).end() == len(buffer)
+            ):
+                # the number may carry on into the next chunk
+                break
+            yield item
+            count += 1
+            pos = end
+            state = "item"
+
+    if state != "end":
+        raise ValueError(f"the payload is cut off or malformed after item {count}")
+
+
+def parse_service(item):
+    """
+    Validates a service record from the dashboard
+
+    Returns its name and version, or raises ValueError saying what's wrong with it
+    """
+    if not isinstance(item, dict):
+        raise ValueError("isn't an object")
+    name = item.get("name")
+    if not isinstance(name, str) or not name:
+        raise ValueError("has no name")
+    try:
+        version = item["instances"][0]["healthz"]["version"]
+    except (KeyError, IndexError, TypeError):
+        raise ValueError(f"{name} has no instances[0].healthz.version") from None
+    if not isinstance(version, str) or not version or version.split() != [version]:
+        raise ValueError(f"{name} has an invalid version {version!r}")
+    return name, version.replace("v", "")
+
+
+def iter_versions(request, report):
+    """
+    Yields (service, version) for each valid record in the dashboard response as it
+    is read. Bad records are appended to report as (index, reason) and skipped. If
+    the payload itself is missing, malformed or cut off, PayloadError is raised after
+    every record before the problem.
+    """
+    # JSON is UTF-8, and a character can be split across chunks
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+    chunks = map(decode, request.iter_content(chunk_size=CHUNK_SIZE))
+    records = iter_json_array(chunks)
+    for index in itertools.count():
+        try:
+            item = next(records)
+        except StopIteration:
+            return
+        except ValueError as e:
+            raise PayloadError(str(e)) from e
+        try:
+            yield parse_service(item)
+        except ValueError as e:
+            report.append((index, str(e)))
+
+
+def get_versions(request, report=None):
+    """
+    Returns a dict of each valid service in the dashboard response to its version.
+    Raises PayloadError if the payload itself is bad.
+    """
+    return dict(iter_versions(request, [] if report is None else report))
+
+
+def version_metadata(services, prefix=""):
+    """
+    Yields the two metadata keys for each (service, version), optionally namespaced
+    by prefix
+    """
+    for service, version in services:
+        yield f"{prefix}{service}_version", version
+        yield f"{prefix}{service}_cf_friendly_version", version.replace(".", "-")
+
+
+def print_report(report, label=""):
+    for index, reason in report:
+        print(f"Skipped {label}record {index}: {reason}", file=sys.stderr)
+
+
+def store_metadata(metadata, max_workers=MAX_WORKERS):
+    """
+    Writes metadata with the buildkite agent, raising MetadataError listing every key
+    that couldn't be set once all of them have been tried
+    """
+    failures = write_metadata(metadata, max_workers)
+    for key, reason in failures.items():
+        print(f"Failed to set {key}: {reason}", file=sys.stderr)
+    if failures:
+        raise MetadataError(failures)
+
+
+def store_versions(request, max_workers=MAX_WORKERS):
     """
     Takes a requests object and extracts the version number for each service.
     Then calls the buildkite agent and stores it in metadata under two key names:
@@ -46,48 +485,132 @@ def store_versions(request):
     eg:
     device-service_version: 1.2.0
     device-service_cf_friendly_version: 1-2-0
+
+    The response is parsed as it streams in, and keys are written concurrently as
+    soon as their service is read. Records that are malformed are skipped, and
+    printed and returned as a list of (index, reason). Raises MetadataError listing
+    every key that couldn't be set, once all of them have been tried, or failing
+    that PayloadError if the payload itself was bad, once the keys read before the
+    problem have been stored.
     """
 
-    services = {
-        item["name"]: item["instances"][0]["healthz"]["version"].replace("v", "")
-        for item in request.json()
-    }
+    report, errors = [], []
 
-    for service, version in services.items():
-        print(f"Setting {service}_version={version}")
-        subprocess.run(
-            ["buildkite-agent", "meta-data", "set", f"{service}_version", version],
-            check=True,
-        )
-        print(f"Setting {service}_cf_friendly_version={version.replace('.', '-')}")
-        subprocess.run(
-            [
-                "buildkite-agent",
-                "meta-data",
-                "set",
-                f"{service}_cf_friendly_version",
-                f"{version.replace('.', '-')}",
-            ],
-            check=True,
+    def versions():
+        try:
+            yield from iter_versions(request, report)
+        except PayloadError as e:
+            print(f"Failed to read the dashboard response: {e}", file=sys.stderr)
+            errors.append(e)
+
+    try:
+        store_metadata(version_metadata(versions()), max_workers)
+    finally:
+        print_report(report)
+    if errors:
+        raise errors[0]
+    return report
+
+
+def store_all_versions(keys, max_workers=MAX_WORKERS, timeout=TIMEOUT, cache=None):
+    """
+    Fetches versions for every (account, env) in keys concurrently, and stores them
+    all as one set of metadata, with each key namespaced by its account and env:
+    <account>_<env>_<service_name>_version: x.x.x
+    <account>_<env>_<service_name>_cf_friendly_version: x-x-x
+
+    eg:
+    prod_prod_device-service_version: 1.2.0
+
+    The versions that were fetched are stored even if some pairs failed, then
+    FetchError is raised listing those. A pair whose payload is bad counts as failed,
+    but the versions read before the problem are still stored.
+    """
+    results, failures = fetch_versions(keys, timeout, cache)
+
+    metadata = {}
+    for (account, env), request in sorted(results.items()):
+        report = []
+        versions = {}
+        try:
+            for service, version in iter_versions(request, report):
+                versions[service] = version
+        except PayloadError as e:
+            failures[(account, env)] = str(e)
+        metadata.update(version_metadata(versions.items(), f"{account}_{env}_"))
+        print_report(report, f"{account}/{env} ")
+    store_metadata(metadata, max_workers)
+
+    for (account, env), reason in failures.items():
+        print(
+            f"Failed to fetch versions for {account}/{env}: {reason}", file=sys.stderr
         )
+    if failures:
+        raise FetchError(failures)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Dynamically fetch service versions from the Dashboard Lambda"
     )
-    parser.add_argument("account", choices=ENDPOINTS.keys(), help="account to target")
+    parser.add_argument(
+        "account", nargs="?", choices=ENDPOINTS.keys(), help="account to target"
+    )
     parser.add_argument(
         "env",
-        choices=["dev", "qa", "sb", "prod"],
+        nargs="?",
+        choices=ENVS,
         help="environment to get version information about",
     )
     parser.add_argument(
         "key",
+        nargs="?",
         help="apigateway auth key that matches the specified account and environment",
     )
+    parser.add_argument(
+        "--all",
+        metavar="KEYS",
+        help="json file of api keys by account and env; fetches every pair in it at "
+        "once and namespaces the metadata by account and env",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=TIMEOUT[1],
+        help="seconds to wait for the dashboard to respond",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=MAX_WORKERS,
+        help="number of metadata keys to set at once",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=0,
+        help="seconds to reuse a dashboard response for, shared by builds on this "
+        "host; 0 to always fetch",
+    )
+    parser.add_argument(
+        "--cache-dir", default=CACHE_DIR, help="where to cache dashboard responses"
+    )
     args = parser.parse_args()
+    timeout = (TIMEOUT[0], args.timeout)
+    cache = ResponseCache(args.cache_dir, args.cache_ttl) if args.cache_ttl else None
 
-    # This is where the stuff is happening
-    request = get_service_request(ENDPOINTS[args.account], args.env, args.key)
-    store_versions(request)
+    if args.all:
+        store_all_versions(load_keys(args.all), args.max_workers, timeout, cache)
+    else:
+        if not (args.account and args.env and args.key):
+            parser.error("account, env and key are required without --all")
+        # This is where the stuff is happening
+        request = get_service_request(
+            ENDPOINTS[args.account],
+            args.env,
+            args.key,
+            timeout=timeout,
+            cache=cache,
+            stream=True,
+        )
+        store_versions(request, args.max_workers)
@@ -0,0 +1,461 @@
+import cluster_provision_by_version as cpv
+import json
+import os
+import socket
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+# stands in for `buildkite-agent meta-data set KEY VALUE`, appending KEY=VALUE to
+# $STUB_LOG after sleeping $STUB_SLEEP seconds, and failing for keys in $STUB_FAIL
+AGENT = """#!/bin/sh
+case " $STUB_FAIL " in
+    *" $3 "*) echo "refused $3" >&2; exit 1;;
+esac
+sleep "${STUB_SLEEP:-0}"
+echo "$3=$(cat)" >> "$STUB_LOG"
+"""
+
+VALID_ARRAYS = [
+    "[]",
+    " [ ] ",
+    '[1.5, {"a": [1, -2]}, "x", -2e-3, 1E+2, true, null, 10]',
+    '[{"name": "]", "note": "caf\\u00e9 ,"}, [], {}]',
+]
+INVALID_ARRAYS = [
+    "",
+    "[1,]",
+    "[1] trailing",
+    "[1 2]",
+    "[,1]",
+    '[1, {"a"',
+    '{"message": "Internal server error"}',
+]
+
+
+def service(name, version):
+    return {"name": name, "instances": [{"healthz": {"version": version}}]}
+
+
+class FakeResponse:
+    """Just enough of a streamed requests response to read versions from"""
+
+    def __init__(self, body, chunk_size=7):
+        self.body = body.encode("utf-8")
+        self.chunk_size = chunk_size
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start : start + self.chunk_size]
+
+
+def splits(text):
+    """The text as two chunks split at every offset, then one character a chunk"""
+    for offset in range(len(text) + 1):
+        yield [text[:offset], text[offset:]]
+    yield list(text)
+
+
+def stored(log):
+    lines = log.read_text().splitlines()
+    return dict(line.split("=", 1) for line in lines)
+
+
+class DashboardHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for the dashboard behind every endpoint, at /<endpoint>. Answers with
+    the payload for the endpoint and env posted, after delay seconds, or with the
+    status code given in its place. Answers 304 when sent the payload's ETag.
+    """
+
+    protocol_version = "HTTP/1.1"
+    lock = threading.Lock()
+    # (endpoint, env) to a payload, or a status code to answer with
+    payloads = {}
+    etags = {}
+    delay = 0
+    # (endpoint, env, api key, If-None-Match) of every request
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        target = (self.path.strip("/"), body["env"])
+        etag = self.headers.get("If-None-Match")
+        with DashboardHandler.lock:
+            DashboardHandler.requests.append(
+                target + (self.headers.get("x-api-key"), etag)
+            )
+        time.sleep(self.delay)
+
+        payload = self.payloads.get(target, 404)
+        if isinstance(payload, int):
+            code, content = payload, b""
+        elif etag is not None and etag == self.etags.get(target):
+            code, content = 304, b""
+        else:
+            code, content = 200, payload.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        if target in self.etags:
+            self.send_header("ETag", self.etags[target])
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def get_free_port():
+    s = socket.socket(socket.AF_INET, type=socket.SOCK_STREAM)
+    s.bind(("localhost", 0))
+    address, port = s.getsockname()
+    s.close()
+    return port
+
+
+@pytest.fixture
+def dashboard(monkeypatch):
+    port = get_free_port()
+    monkeypatch.setattr(cpv, "API_URL", f"http://localhost:{port}/{{endpoint}}")
+
+    DashboardHandler.payloads = {}
+    DashboardHandler.etags = {}
+    DashboardHandler.delay = 0
+    DashboardHandler.requests = []
+    server = ThreadingHTTPServer(("localhost", port), DashboardHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield DashboardHandler
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def agent(tmp_path, monkeypatch):
+    """A stub buildkite-agent on the PATH. Returns the file it logs keys set to."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "buildkite-agent"
+    script.write_text(AGENT)
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    log = tmp_path / "metadata.log"
+    log.touch()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("STUB_LOG", str(log))
+    monkeypatch.delenv("STUB_FAIL", raising=False)
+    monkeypatch.delenv("STUB_SLEEP", raising=False)
+    return log
+
+
+class TestParsing:
+    @pytest.mark.parametrize("text", VALID_ARRAYS)
+    def test_valid_arrays_parse_however_they_are_split(self, text):
+        for chunks in splits(text):
+            assert list(cpv.iter_json_array(chunks)) == json.loads(text), chunks
+
+    @pytest.mark.parametrize("text", INVALID_ARRAYS)
+    def test_invalid_arrays_raise_however_they_are_split(self, text):
+        for chunks in splits(text):
+            with pytest.raises(ValueError):
+                list(cpv.iter_json_array(chunks))
+
+    def test_items_before_a_problem_are_yielded(self):
+        for chunks in splits('[1.5, {"a": 1}, 2,]'):
+            items = []
+            with pytest.raises(ValueError):
+                for item in cpv.iter_json_array(chunks):
+                    items.append(item)
+            assert items == [1.5, {"a": 1}, 2]
+
+    def test_parse_service_rejects_bad_records(self):
+        assert cpv.parse_service(service("a", "v1.2.0")) == ("a", "1.2.0")
+        for record in (
+            [],
+            {"instances": []},
+            {"name": "a", "instances": []},
+            service("a", ""),
+            service("a", "1.2 3"),
+            service("a", 12),
+        ):
+            with pytest.raises(ValueError):
+                cpv.parse_service(record)
+
+
+class TestStoreVersions:
+    def test_bad_records_are_skipped_and_reported(self, agent):
+        body = json.dumps([service("a", "v1.2.0"), {"name": "b"}, service("c", "3")])
+
+        report = cpv.store_versions(FakeResponse(body))
+
+        assert stored(agent) == {
+            "a_version": "1.2.0",
+            "a_cf_friendly_version": "1-2-0",
+            "c_version": "3",
+            "c_cf_friendly_version": "3",
+        }
+        assert [index for index, _ in report] == [1]
+
+    def test_payload_that_isnt_an_array_fails(self, agent):
+        body = json.dumps({"message": "Internal server error"})
+
+        with pytest.raises(cpv.PayloadError):
+            cpv.store_versions(FakeResponse(body))
+        assert stored(agent) == {}
+
+    def test_cut_off_payload_fails_after_storing_what_was_read(self, agent):
+        body = json.dumps([service("a", "1.0"), service("b", "2.0")])[:-20]
+
+        with pytest.raises(cpv.PayloadError):
+            cpv.store_versions(FakeResponse(body))
+        assert stored(agent) == {"a_version": "1.0", "a_cf_friendly_version": "1-0"}
+
+
+class TestMetadata:
+    def test_keys_are_set_concurrently(self, agent, monkeypatch):
+        monkeypatch.setenv("STUB_SLEEP", "0.5")
+        metadata = {f"key{i}": f"value{i}" for i in range(8)}
+
+        start = time.monotonic()
+        failures = cpv.write_metadata(metadata, max_workers=8)
+        elapsed = time.monotonic() - start
+
+        assert failures == {}
+        assert stored(agent) == metadata
+        # one at a time would take 4s
+        assert elapsed < 2
+
+    def test_every_failed_key_is_reported(self, agent, monkeypatch):
+        monkeypatch.setenv("STUB_FAIL", "b d")
+
+        failures = cpv.write_metadata(
+            iter([("a", "1"), ("b", "2"), ("c", "3"), ("d", "4")])
+        )
+
+        assert failures == {"b": "refused b", "d": "refused d"}
+        assert stored(agent) == {"a": "1", "c": "3"}
+
+    def test_store_metadata_raises_once_every_key_is_tried(self, agent, monkeypatch):
+        monkeypatch.setenv("STUB_FAIL", "a c")
+
+        with pytest.raises(cpv.MetadataError) as e:
+            cpv.store_metadata({"a": "1", "b": "2", "c": "3"})
+
+        assert set(e.value.failures) == {"a", "c"}
+        assert stored(agent) == {"b": "2"}
+
+    def test_values_are_fed_on_stdin(self, agent):
+        failures = cpv.write_metadata({"a": "--help", "b": "1.2.0 (hotfix)"})
+
+        assert failures == {}
+        assert stored(agent) == {"a": "--help", "b": "1.2.0 (hotfix)"}
+
+    def test_missing_agent_is_reported(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("PATH", str(tmp_path))
+
+        failures = cpv.write_metadata({"a": "1"})
+
+        assert list(failures) == ["a"]
+
+
+class TestFanOut:
+    def write_keys(self, tmp_path, config):
+        path = tmp_path / "keys.json"
+        path.write_text(json.dumps(config))
+        return path
+
+    def test_load_keys_expands_accounts(self, tmp_path):
+        path = self.write_keys(
+            tmp_path, {"nonprod": {"dev": "key1", "qa": "key2"}, "prod": "key3"}
+        )
+
+        keys = cpv.load_keys(path)
+
+        assert keys == {
+            ("nonprod", "dev"): "key1",
+            ("nonprod", "qa"): "key2",
+            **{("prod", env): "key3" for env in cpv.ENVS},
+        }
+
+    @pytest.mark.parametrize(
+        "config", [{"staging": "key"}, {"nonprod": {"uat": "key"}}]
+    )
+    def test_load_keys_rejects_unknown_accounts_and_envs(self, tmp_path, config):
+        with pytest.raises(ValueError):
+            cpv.load_keys(self.write_keys(tmp_path, config))
+
+    def test_pairs_are_fetched_at_once(self, dashboard):
+        dashboard.delay = 0.5
+        keys = {("nonprod", env): f"key-{env}" for env in cpv.ENVS}
+        for env in cpv.ENVS:
+            dashboard.payloads[(cpv.ENDPOINTS["nonprod"], env)] = "[]"
+
+        start = time.monotonic()
+        results, failures = cpv.fetch_versions(keys)
+        elapsed = time.monotonic() - start
+
+        assert failures == {}
+        assert set(results) == set(keys)
+        # one at a time would take 2s
+        assert elapsed < 1.5
+        assert sorted(key for _, _, key, _ in dashboard.requests) == sorted(
+            keys.values()
+        )
+
+    def test_metadata_is_namespaced_by_account_and_env(self, dashboard, agent):
+        dashboard.payloads[(cpv.ENDPOINTS["nonprod"], "dev")] = json.dumps(
+            [service("a", "1.0")]
+        )
+        dashboard.payloads[(cpv.ENDPOINTS["prod"], "prod")] = json.dumps(
+            [service("a", "2.0")]
+        )
+
+        cpv.store_all_versions({("nonprod", "dev"): "k1", ("prod", "prod"): "k2"})
+
+        assert stored(agent) == {
+            "nonprod_dev_a_version": "1.0",
+            "nonprod_dev_a_cf_friendly_version": "1-0",
+            "prod_prod_a_version": "2.0",
+            "prod_prod_a_cf_friendly_version": "2-0",
+        }
+
+    def test_failed_pairs_are_raised_after_storing_the_rest(self, dashboard, agent):
+        dashboard.payloads[(cpv.ENDPOINTS["nonprod"], "dev")] = json.dumps(
+            [service("a", "1.0")]
+        )
+        dashboard.payloads[(cpv.ENDPOINTS["nonprod"], "qa")] = 500
+        dashboard.payloads[(cpv.ENDPOINTS["prod"], "prod")] = json.dumps(
+            {"message": "Internal server error"}
+        )
+
+        with pytest.raises(cpv.FetchError) as e:
+            cpv.store_all_versions(
+                {
+                    ("nonprod", "dev"): "k1",
+                    ("nonprod", "qa"): "k2",
+                    ("prod", "prod"): "k3",
+                }
+            )
+
+        assert set(e.value.failures) == {("nonprod", "qa"), ("prod", "prod")}
+        assert stored(agent) == {
+            "nonprod_dev_a_version": "1.0",
+            "nonprod_dev_a_cf_friendly_version": "1-0",
+        }
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestResponseCache:
+    endpoint = cpv.ENDPOINTS["nonprod"]
+    v1 = json.dumps([service("device-service", "1.0.0")])
+    v2 = json.dumps([service("device-service", "2.0.0")])
+
+    @pytest.fixture
+    def cache(self, tmp_path):
+        return cpv.ResponseCache(tmp_path / "cache", ttl=60, clock=Clock())
+
+    def fetch(self, cache, key="secret-key"):
+        return cpv.get_service_request(self.endpoint, "dev", key, cache=cache)
+
+    def test_fresh_entry_makes_no_call(self, dashboard, cache):
+        dashboard.payloads[(self.endpoint, "dev")] = self.v1
+
+        first = self.fetch(cache)
+        cache.clock.now += 59
+        second = self.fetch(cache)
+
+        assert first.text == second.text == self.v1
+        assert len(dashboard.requests) == 1
+
+    def test_stale_entry_is_revalidated_with_its_etag(self, dashboard, cache):
+        dashboard.payloads[(self.endpoint, "dev")] = self.v1
+        dashboard.etags[(self.endpoint, "dev")] = '"v1"'
+
+        self.fetch(cache)
+        cache.clock.now += 61
+        revalidated = self.fetch(cache)
+
+        assert [etag for *_, etag in dashboard.requests] == [None, '"v1"']
+        assert revalidated.status_code == 200
+        assert revalidated.text == self.v1
+        # the 304 refreshed the entry, so it's fresh again
+        assert (
+            cache.get(self.endpoint, "dev", "secret-key")["fetched"] == cache.clock.now
+        )
+        self.fetch(cache)
+        assert len(dashboard.requests) == 2
+
+    def test_changed_payload_replaces_the_entry(self, dashboard, cache):
+        dashboard.payloads[(self.endpoint, "dev")] = self.v1
+        dashboard.etags[(self.endpoint, "dev")] = '"v1"'
+
+        self.fetch(cache)
+        dashboard.payloads[(self.endpoint, "dev")] = self.v2
+        dashboard.etags[(self.endpoint, "dev")] = '"v2"'
+        cache.clock.now += 61
+
+        assert self.fetch(cache).text == self.v2
+        assert cache.get(self.endpoint, "dev", "secret-key")["etag"] == '"v2"'
+
+    def test_api_key_never_lands_in_the_cache(self, dashboard, cache):
+        dashboard.payloads[(self.endpoint, "dev")] = self.v1
+
+        self.fetch(cache)
+
+        files = list(cache.directory.iterdir())
+        assert files
+        # and every write was renamed into place, not left behind half done
+        assert not [file for file in files if file.suffix == ".tmp"]
+        for file in files:
+            assert b"secret-key" not in file.read_bytes()
+
+    def test_entries_are_kept_per_api_key(self, dashboard, cache):
+        dashboard.payloads[(self.endpoint, "dev")] = self.v1
+
+        self.fetch(cache)
+        self.fetch(cache, key="other-key")
+
+        assert [key for _, _, key, _ in dashboard.requests] == [
+            "secret-key",
+            "other-key",
+        ]
+
+    @pytest.mark.parametrize(
+        "payload",
+        [
+            '{"message": "Forbidden"}',
+            "[]",
+            '[{"name": "device-service"}]',
+            '[{"name": "device-service", "ins',
+        ],
+    )
+    def test_bad_payloads_are_not_cached(self, dashboard, cache, payload):
+        dashboard.payloads[(self.endpoint, "dev")] = payload
+
+        assert self.fetch(cache).text == payload
+        self.fetch(cache)
+
+        assert len(dashboard.requests) == 2
+        assert cache.get(self.endpoint, "dev", "secret-key") is None
+
+    def test_concurrent_misses_call_once(self, dashboard, cache):
+        dashboard.payloads[(self.endpoint, "dev")] = self.v1
+        dashboard.delay = 0.3
+
+        threads = [threading.Thread(target=self.fetch, args=(cache,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(dashboard.requests) == 1
@@ -2,31 +2,285 @@
 # tested against python3.7+ specifically
 
 import argparse
+import json
 import logging
+import math
+import os
+import random
+import statistics
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 import boto3
 from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
+# Per-call item limits imposed by the AWS APIs
+DESCRIBE_CONTAINER_INSTANCES_MAX = 100
+DESCRIBE_TASKS_MAX = 100
+UPDATE_CONTAINER_INSTANCES_MAX = 10
+DESCRIBE_ASG_INSTANCES_MAX = 50
+DETACH_INSTANCES_MAX = 20
+
+# Default cap on concurrent API calls made from a single rotation
+MAX_WORKERS = 8
+
+# Default cap on clusters rotated at once by fleet()
+FLEET_WORKERS = 4
+
+# Default wall-clock seconds each waiting phase is allowed to take
+PROVISION_DEADLINE = 600
+DRAIN_DEADLINE = 1200
+
+# Where observed phase durations are kept, and what is assumed without any
+HISTORY = os.path.expanduser("~/.rotate_ecs_ami_history.jsonl")
+DEFAULT_DURATIONS = {"provisioning": 300, "draining": 600}
+
+
+def chunks(l, n):
+    """Yield successive n-sized chunks from l."""
+    for i in range(0, len(l), n):
+        yield l[i : i + n]
+
+
+class ClusterInventory:
+    """
+    Cached view of the container instances in a cluster, split by whether they are
+    running the AMI specified at runtime. List calls are paged through, and describe
+    calls are batched to the maximum size the API allows.
+
+    Lookups are lazy and cached until refresh() is called, so each poll cycle only
+    lists the cluster once no matter how many phase functions read from it.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.refresh()
+
+    def refresh(self):
+        """Drops cached results so the next lookup goes back to ECS"""
+        self._arns = {}
+        self._outdated = None
+        self._task_hosts = None
+
+    def _list(self, operator):
+        if operator not in self._arns:
+            paginator = self.session.clients["ecs"].get_paginator(
+                "list_container_instances"
+            )
+            pages = paginator.paginate(
+                cluster=self.session.cluster,
+                filter=f"attribute:ecs.ami-id {operator} {self.session.ami}",
+            )
+            self._arns[operator] = [
+                arn for page in pages for arn in page["containerInstanceArns"]
+            ]
+        return self._arns[operator]
+
+    @property
+    def outdated_arns(self):
+        """Container instance ARNs not running the target AMI"""
+        return self._list("!=")
+
+    @property
+    def current_arns(self):
+        """Container instance ARNs already running the target AMI"""
+        return self._list("==")
+
+    @property
+    def outdated(self):
+        """Container instance descriptions for outdated_arns"""
+        if self._outdated is None:
+            self._outdated = self.describe(self.outdated_arns)
+        return self._outdated
+
+    def arns_for(self, instance_ids=None):
+        """
+        Outdated container instance ARNs, limited to the given EC2 instance IDs when
+        they are passed in
+        """
+        if instance_ids is None:
+            return self.outdated_arns
+        return [
+            item["containerInstanceArn"]
+            for item in self.outdated
+            if item["ec2InstanceId"] in instance_ids
+        ]
+
+    def describe(self, arns):
+        descriptions = []
+        for batch in chunks(arns, DESCRIBE_CONTAINER_INSTANCES_MAX):
+            response = self.session.clients["ecs"].describe_container_instances(
+                cluster=self.session.cluster, containerInstances=batch
+            )
+            descriptions.extend(response["containerInstances"])
+        return descriptions
+
+    @property
+    def task_hosts(self):
+        """
+        Container instance ARNs hosting at least one RUNNING task, worked out from a
+        single paged list_tasks call for the whole cluster
+        """
+        if self._task_hosts is None:
+            paginator = self.session.clients["ecs"].get_paginator("list_tasks")
+            pages = paginator.paginate(
+                cluster=self.session.cluster, desiredStatus="RUNNING"
+            )
+            task_arns = [arn for page in pages for arn in page["taskArns"]]
+
+            self._task_hosts = set()
+            for batch in chunks(task_arns, DESCRIBE_TASKS_MAX):
+                response = self.session.clients["ecs"].describe_tasks(
+                    cluster=self.session.cluster, tasks=batch
+                )
+                self._task_hosts.update(
+                    task["containerInstanceArn"]
+                    for task in response["tasks"]
+                    if "containerInstanceArn" in task
+                )
+        return self._task_hosts
+
+    def update_state(self, arns, status):
+        responses = []
+        for batch in chunks(arns, UPDATE_CONTAINER_INSTANCES_MAX):
+            responses.append(
+                self.session.clients["ecs"].update_container_instances_state(
+                    cluster=self.session.cluster,
+                    containerInstances=batch,
+                    status=status,
+                )
+            )
+        return responses
+
+
+class ClientFactory:
+    """
+    Process-wide cache of boto3 clients, keyed on service, region and config. Every
+    client comes from one shared boto3 session, so service models and endpoint data
+    are only loaded once no matter how many clusters are rotated.
+
+    How long the session and each client took to create is kept in timings.
+    """
+
+    services = ("ecs", "ec2", "autoscaling")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._clients = {}
+        self.timings = {}
+
+    def client(self, service, region, **config):
+        """
+        :param service: The AWS service name
+        :param region: The AWS region name
+        :param config: Options for botocore's Config, on top of the 15 retries
+        :return: A boto3 client
+        """
+        options = dict(retries=dict(max_attempts=15))
+        options.update(config)
+        key = (service, region, json.dumps(options, sort_keys=True))
+
+        # boto3 sessions aren't thread safe, so clients are made one at a time
+        with self._lock:
+            if key not in self._clients:
+                if self._session is None:
+                    started = time.perf_counter()
+                    self._session = boto3.session.Session()
+                    self.timings["boto3 session"] = time.perf_counter() - started
+
+                started = time.perf_counter()
+                self._clients[key] = self._session.client(
+                    service, region_name=region, config=Config(**options)
+                )
+                name = f"{service} client ({region})"
+                self.timings[name] = time.perf_counter() - started
+                logging.debug("Created %s in %.3fs", name, self.timings[name])
+            return self._clients[key]
+
+    def clients(self, region, max_pool_connections=MAX_WORKERS):
+        """
+        :param region: The AWS region name
+        :param max_pool_connections: Sized to the number of concurrent calls expected
+        :return: A dict of the clients a Session needs
+        """
+        return {
+            service: self.client(
+                service, region, max_pool_connections=max_pool_connections
+            )
+            for service in self.services
+        }
+
+
+CLIENTS = ClientFactory()
+
 
 class Session:
-    def __init__(self, region="ap-southeast-2", clients=None):
+    def __init__(
+        self, region="ap-southeast-2", clients=None, max_pool_connections=MAX_WORKERS
+    ):
         self.region = region
+        self._inventory = None
+        self.instances = set()
+        self.journal = None
+        self.progress = None
+        self.history = None
 
         if not clients:
-            config = Config(retries=dict(max_attempts=15))
-            self.clients = {
-                "ecs": boto3.client("ecs", region_name=self.region, config=config),
-                "ec2": boto3.client("ec2", region_name=self.region, config=config),
-                "autoscaling": boto3.client(
-                    "autoscaling", region_name=self.region, config=config
-                ),
-            }
+            self.clients = CLIENTS.clients(
+                self.region, max_pool_connections=max_pool_connections
+            )
         else:
             self.clients = clients
 
+    @property
+    def inventory(self):
+        if self._inventory is None:
+            self._inventory = ClusterInventory(self)
+        return self._inventory
+
+
+def outdated_by_asg(session):
+    """
+    Given the cluster specified at runtime, will find any EC2 instances attached that do
+    not have the AMI ID specified at runtime, grouped by the autoscaling group they
+    belong to.
+
+    :param session: An object containing boto3 sessions, cluster, and AMI information
+    :return: a dict of ASG names to sorted lists of EC2 instance IDs
+    """
+    logging.info("Finding old instances")
+
+    instance_ids = [item["ec2InstanceId"] for item in session.inventory.outdated]
+
+    return attached_by_asg(session, instance_ids)
+
+
+def attached_by_asg(session, instance_ids):
+    """
+    Groups EC2 instances by the autoscaling group they are attached to. Instances that
+    are not attached to an ASG are left out.
+
+    :param session: An object containing boto3 sessions
+    :param instance_ids: A list of EC2 instance IDs
+    :return: a dict of ASG names to sorted lists of EC2 instance IDs
+    """
+    by_asg = {}
+    for batch in chunks(instance_ids, DESCRIBE_ASG_INSTANCES_MAX):
+        asg_description = session.clients[
+            "autoscaling"
+        ].describe_auto_scaling_instances(InstanceIds=batch)
+        for blob in asg_description["AutoScalingInstances"]:
+            by_asg.setdefault(blob["AutoScalingGroupName"], []).append(
+                blob["InstanceId"]
+            )
+
+    return {asg: sorted(ids) for asg, ids in by_asg.items()}
+
 
 def find_outdated_asg(session):
     """
@@ -37,233 +291,1058 @@ def find_outdated_asg(session):
     :param session: An object containing boto3 sessions, cluster, and AMI information
     :return: a set of ASG names
     """
-    logging.info("Finding old instances")
+    return set(outdated_by_asg(session))
 
-    instances = session.clients["ecs"].list_container_instances(
-        cluster=session.cluster, filter=f"attribute:ecs.ami-id != {session.ami}"
-    )
-    instance_description = session.clients["ecs"].describe_container_instances(
-        cluster=session.cluster, containerInstances=instances["containerInstanceArns"]
+
+class DetachError(Exception):
+    """
+    Raised when one or more ASGs could not be fully detached. Holds the per-ASG
+    failures, and the instances that were detached before they happened.
+    """
+
+    def __init__(self, failures, detached):
+        self.failures = failures
+        self.detached = detached
+        super().__init__(
+            "Failed to detach instances from: " + ", ".join(sorted(failures))
+        )
+
+
+def _asg_instance_ids(session, asg_name):
+    asg_info = session.clients["autoscaling"].describe_auto_scaling_groups(
+        AutoScalingGroupNames=[asg_name], MaxRecords=100
     )
-    instance_ids = [
-        item["ec2InstanceId"] for item in instance_description["containerInstances"]
+    return [
+        instance["InstanceId"]
+        for instance in asg_info["AutoScalingGroups"][0]["Instances"]
     ]
 
-    asg_description = session.clients["autoscaling"].describe_auto_scaling_instances(
-        InstanceIds=instance_ids
-    )
 
-    # return set
-    return {
-        blob["AutoScalingGroupName"] for blob in asg_description["AutoScalingInstances"]
-    }
+def _detach_chunk(session, asg_name, group):
+    response = session.clients["autoscaling"].detach_instances(
+        InstanceIds=group,
+        AutoScalingGroupName=asg_name,
+        ShouldDecrementDesiredCapacity=False,
+    )
+    # Getting instance id from description
+    return [
+        item["Description"].split(" ")[-1]
+        for item in response["Activities"]
+        if item["Description"].startswith("Detaching")
+    ]
 
 
-def detach_outdated_instances(session):
+def detach_outdated_instances(session, max_workers=MAX_WORKERS, instances=None):
     """
     Detaches outdated EC2 instances from their ASG. Runs under the assumption that the
     launch configuration has been updated to use the new AMI (cloudformation). This
     results in new instances spinning up to replace, but still leaves the old instances
     attached to the ECS cluster.
 
+    ASGs are described, and their 20-instance detach chunks sent, in parallel on a
+    bounded thread pool. The per-ASG results are kept on session.detached.
+
     :param session: An object containing boto3 sessions, cluster, AMI, and ASG
         information
+    :param max_workers: The maximum number of concurrent autoscaling calls
+    :param instances: A dict of ASG names to the instance IDs to detach from each.
+        Defaults to every instance in session.asgs
     :return: a set of detached EC2 instance IDs that have been detached from their ASG
     """
     logging.info("Detaching old instances")
-    detached_instances = []
+    asg_names = sorted(session.asgs if instances is None else instances)
+    detached = {asg_name: set() for asg_name in asg_names}
+    failures = {}
 
-    for asg_name in session.asgs:
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        if instances is None:
+            described = [
+                (asg_name, pool.submit(_asg_instance_ids, session, asg_name))
+                for asg_name in asg_names
+            ]
+            targets = {}
+            for asg_name, future in described:
+                try:
+                    targets[asg_name] = future.result()
+                except (BotoCoreError, ClientError) as e:
+                    failures[asg_name] = e
+        else:
+            targets = {asg_name: list(instances[asg_name]) for asg_name in asg_names}
 
-        asg_info = session.clients["autoscaling"].describe_auto_scaling_groups(
-            AutoScalingGroupNames=[asg_name], MaxRecords=100
-        )
-        instance_ids = [
-            instance["InstanceId"]
-            for instance in asg_info["AutoScalingGroups"][0]["Instances"]
+        detaching = [
+            (asg_name, pool.submit(_detach_chunk, session, asg_name, group))
+            for asg_name, instance_ids in targets.items()
+            for group in chunks(instance_ids, DETACH_INSTANCES_MAX)
         ]
 
-        # detach_instances can only handle max 20 instances in a call
-        def chunks(l, n):
-            """Yield successive n-sized chunks from l."""
-            for i in range(0, len(l), n):
-                yield l[i : i + n]
+        for asg_name, future in detaching:
+            try:
+                detached[asg_name].update(future.result())
+            except (BotoCoreError, ClientError) as e:
+                failures.setdefault(asg_name, e)
 
-        id_groups = list(chunks(instance_ids, 20))
+    session.detached = detached
+    for asg_name in asg_names:
+        if asg_name in failures:
+            logging.error("%s: detach failed - %s", asg_name, failures[asg_name])
+        else:
+            logging.info("%s: detached %s instances", asg_name, len(detached[asg_name]))
 
-        for group in id_groups:
-            response = session.clients["autoscaling"].detach_instances(
-                InstanceIds=group,
-                AutoScalingGroupName=asg_name,
-                ShouldDecrementDesiredCapacity=False,
-            )
-            # Getting instance id from description
-            for item in response["Activities"]:
-                if item["Description"].startswith("Detaching"):
-                    detached_instances.append(item["Description"].split(" ")[-1])
+    if failures:
+        raise DetachError(failures, detached)
 
-    return set(detached_instances)
+    return set().union(*detached.values())
 
 
-def can_drain_instances(session):
+def pending_provisioning(session, expected=None):
     """
-    Returns true when the ASG has registered the minimum number of instances and they've
-    also successfully joined the cluster specified at runtime
+    Works out what is holding up the ASGs from having registered the minimum number of
+    healthy instances, and those instances joining the cluster specified at runtime.
 
     :param session:  An object containing boto3 sessions, cluster, AMI, and ASG
         information
-    :return: bool
+    :param expected: The number of instances on the new AMI the cluster should have
+        once provisioning is done, if more than each ASG's minimum
+    :return: a set of lagging instance IDs, or ASG names with their instance counts
     """
+    lagging = set()
+
+    if expected is not None:
+        registered = len(session.inventory.current_arns)
+        if not registered >= expected:
+            lagging.add(f"{session.cluster} ({registered}/{expected} registered)")
+
     for asg in session.asgs:
         asg_result = session.clients["autoscaling"].describe_auto_scaling_groups(
             AutoScalingGroupNames=[asg]
         )
 
         min_num = asg_result["AutoScalingGroups"][0]["MinSize"]
+        instances = asg_result["AutoScalingGroups"][0]["Instances"]
 
-        if not len(asg_result["AutoScalingGroups"][0]["Instances"]) >= min_num:
-            return False
+        if not len(instances) >= min_num:
+            lagging.add(f"{asg} ({len(instances)}/{min_num} instances)")
+            continue
 
-        for instance in asg_result["AutoScalingGroups"][0]["Instances"]:
-            if (
-                not instance["LifecycleState"] == "InService"
-                or not instance["HealthStatus"] == "Healthy"
-            ):
-                return False
+        unhealthy = {
+            instance["InstanceId"]
+            for instance in instances
+            if not instance["LifecycleState"] == "InService"
+            or not instance["HealthStatus"] == "Healthy"
+        }
+        if unhealthy:
+            lagging.update(unhealthy)
+            continue
 
-        list_result = session.clients["ecs"].list_container_instances(
-            cluster=session.cluster, filter=f"attribute:ecs.ami-id == {session.ami}"
-        )
+        registered = len(session.inventory.current_arns)
+        if not registered >= min_num:
+            lagging.add(f"{asg} ({registered}/{min_num} registered)")
 
-        if not len(list_result["containerInstanceArns"]) >= min_num:
-            return False
+    return lagging
 
-    return True
+
+def can_drain_instances(session):
+    """
+    Returns true when the ASG has registered the minimum number of instances and they've
+    also successfully joined the cluster specified at runtime
+
+    :param session:  An object containing boto3 sessions, cluster, AMI, and ASG
+        information
+    :return: bool
+    """
+    return not pending_provisioning(session)
 
 
-def drain_instances(session):
+def drain_instances(session, instances=None):
     """
     Sets the container instance to the DRAINING state. Default behaviour will wait till
     new containers have been provisioned on another instance before removing.
 
-    Note: Not sure what the max number of instances a single call can update. AWS docs
-    don't specify
+    Updates are sent in batches of 10, the most a single call will accept.
 
     :param session: An object containing boto3 sessions, cluster, and AMI information
-    :return: Dict response of a drain instance call
+    :param instances: EC2 instance IDs to limit the drain to. Defaults to all outdated
+    :return: List of dict responses, one per drain instance call
     """
     logging.info("Draining instances")
 
-    response = session.clients["ecs"].list_container_instances(
-        cluster=session.cluster, filter=f"attribute:ecs.ami-id != {session.ami}"
+    return session.inventory.update_state(
+        session.inventory.arns_for(instances), "DRAINING"
     )
 
-    return session.clients["ecs"].update_container_instances_state(
-        cluster=session.cluster,
-        containerInstances=response["containerInstanceArns"],
-        status="DRAINING",
-    )
+
+def busy_instances(session, census="instances", instances=None):
+    """
+    Works out which outdated container instances still hold tasks, using one bulk
+    census of the cluster rather than a list_tasks call per instance.
+
+    census="instances" reads runningTasksCount and pendingTasksCount from the batched
+    describe_container_instances results. census="tasks" lists the cluster's RUNNING
+    tasks once and maps them back to their container instances.
+
+    :param session: An object containing boto3 sessions, cluster, and AMI information
+    :param census: Either "instances" or "tasks"
+    :param instances: EC2 instance IDs to limit the census to. Defaults to all outdated
+    :return: a set of container instance ARNs
+    """
+    if census == "instances":
+        return {
+            item["containerInstanceArn"]
+            for item in session.inventory.outdated
+            if (instances is None or item["ec2InstanceId"] in instances)
+            and (item.get("runningTasksCount", 0) or item.get("pendingTasksCount", 0))
+        }
+    if census == "tasks":
+        outdated = set(session.inventory.arns_for(instances))
+        return outdated & session.inventory.task_hosts if outdated else set()
+
+    raise ValueError(f"Unknown census mode: {census}")
 
 
-def can_deregister(session):
+def can_deregister(session, census="instances", instances=None):
     """
     Returns True when detached instances no longer have containers running on them,
     meaning they can successfully be removed from the cluster without dropping
     connections.
 
     :param session: An object containing boto3 sessions, cluster, and AMI information
+    :param census: How to count tasks, see busy_instances
+    :param instances: EC2 instance IDs to limit the check to. Defaults to all outdated
     :return: bool
     """
-    result = session.clients["ecs"].list_container_instances(
-        cluster=session.cluster, filter=f"attribute:ecs.ami-id != {session.ami}"
-    )
-
-    container_ids = [arn.split("/")[-1] for arn in result["containerInstanceArns"]]
+    return not busy_instances(session, census=census, instances=instances)
 
-    for instance in container_ids:
-        task_results = session.clients["ecs"].list_tasks(
-            cluster=session.cluster, containerInstance=instance, desiredStatus="RUNNING"
-        )
-        if task_results["taskArns"]:
-            return False
-
-    return True
 
-
-def deregister(session):
+def deregister(session, instances=None):
     """
     Will remove EC2 instances from the cluster
 
     :param session: An object containing boto3 sessions, cluster, and AMI information
+    :param instances: EC2 instance IDs to limit this to. Defaults to all outdated
     :return: None
     """
     logging.info("Deregistering instances")
-    result = session.clients["ecs"].list_container_instances(
-        cluster=session.cluster, filter=f"attribute:ecs.ami-id != {session.ami}"
-    )
-    for instance in result["containerInstanceArns"]:
+    for instance in session.inventory.arns_for(instances):
         session.clients["ecs"].deregister_container_instance(
             cluster=session.cluster, containerInstance=instance, force=False
         )
 
 
-def terminate(session):
+def terminate(session, instances=None):
     """
     Will terminate EC2 instances
 
     :param session: An object containing boto3 sessions, and EC2 instance information
+    :param instances: EC2 instance IDs to terminate. Defaults to session.instances
     :return:
     """
     logging.info("Terminating instances")
-    session.clients["ec2"].terminate_instances(InstanceIds=list(session.instances))
+    if instances is None:
+        instances = session.instances
+    session.clients["ec2"].terminate_instances(InstanceIds=sorted(instances))
 
 
-def main(ami, cluster, region="ap-southeast-2", clients=None, snooze=60):
+class RotationTimeout(Exception):
+    """
+    Raised when a phase runs past its deadline. Holds the phase name, and whatever was
+    still lagging at the last poll.
+    """
+
+    def __init__(self, phase, lagging, elapsed):
+        self.phase = phase
+        self.lagging = lagging
+        self.elapsed = elapsed
+        super().__init__(
+            f"{phase} timed out after {elapsed:.0f} seconds waiting on: "
+            + ", ".join(sorted(lagging))
+        )
+
+
+class Waiter:
+    """
+    Polls a phase until nothing is left pending, or its deadline passes.
+
+    The interval backs off exponentially (with jitter) while the pending set stays the
+    same, and drops back to the initial interval as soon as it changes, so a phase that
+    is making progress gets checked again quickly.
+
+    :param initial: The shortest sleep in seconds between polls
+    :param maximum: The longest sleep in seconds between polls
+    :param factor: What the interval is multiplied by after a poll with no change
+    :param jitter: The fraction each sleep is randomly varied by
+    :param clock: Returns the current time in seconds, swapped out in tests
+    :param sleep: Sleeps for a number of seconds, swapped out in tests
+    """
+
+    def __init__(
+        self,
+        initial=5,
+        maximum=60,
+        factor=2,
+        jitter=0.2,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.clock = clock
+        self.sleep = sleep
+
+    def wait(self, session, phase, pending, deadline):
+        """
+        Refreshes the cluster inventory and calls pending(session) until it returns an
+        empty set.
+
+        :param session: An object containing boto3 sessions, cluster, and AMI information
+        :param phase: The phase name, for logging and errors
+        :param pending: A callable that returns the set of things still lagging
+        :param deadline: The wall-clock seconds the phase is allowed to take
+        :return: The number of seconds the phase took
+        """
+        start = self.clock()
+        delay = self.initial
+        previous = None
+
+        while True:
+            session.inventory.refresh()
+            lagging = pending(session)
+            elapsed = self.clock() - start
+
+            if not lagging:
+                logging.info("%s finished after %.0f seconds", phase, elapsed)
+                return elapsed
+            if elapsed >= deadline:
+                raise RotationTimeout(phase, lagging, elapsed)
+
+            if previous is not None:
+                if lagging == previous:
+                    delay = min(delay * self.factor, self.maximum)
+                else:
+                    delay = self.initial
+            previous = lagging
+
+            pause = delay * (1 + self.jitter * random.uniform(-1, 1))
+            pause = min(pause, deadline - elapsed)
+            logging.info(
+                "%s waiting on %s. Sleeping for %.1f", phase, len(lagging), pause
+            )
+            self.sleep(pause)
+
+
+class JournalError(Exception):
+    """Raised when a journal can't be started or resumed from"""
+
+
+class Journal:
+    """
+    Append-only JSON lines record of a rotation, so an interrupted one can be picked
+    back up with resume() instead of hunting down detached instances by hand.
+
+    The first line is the plan (cluster, AMI, and the waves). Every line after that is
+    a phase transition for one wave, along with the instance IDs it touched. Each line
+    is flushed to disk before the rotation moves on.
+
+    :param path: Where the journal file lives
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, phase, **fields):
+        entry = {"time": time.time(), "phase": phase}
+        for key, value in fields.items():
+            entry[key] = sorted(value) if isinstance(value, (set, frozenset)) else value
+
+        line = json.dumps(entry) + "\n"
+        if self._partial():
+            line = "\n" + line
+
+        with open(self.path, "a") as journal:
+            journal.write(line)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def _partial(self):
+        """Whether the last line was cut short by the process dying mid-write"""
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            return False
+        with open(self.path, "rb") as journal:
+            journal.seek(-1, os.SEEK_END)
+            return journal.read(1) != b"\n"
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return []
+
+        entries = []
+        with open(self.path) as journal:
+            for line in journal:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # a line cut short by the process dying mid-write
+                    logging.warning("Skipping partial journal line: %r", line)
+        return entries
+
+    def state(self):
+        """
+        :return: a tuple of the plan entry (or None), a dict of wave numbers to their
+            latest entry, and whether the rotation finished
+        """
+        plan, latest, finished = None, {}, False
+        for entry in self.entries():
+            if entry["phase"] == "planned":
+                plan, latest, finished = entry, {}, False
+            elif entry["phase"] == "finished":
+                finished = True
+            elif "wave" in entry:
+                latest[entry["wave"]] = entry
+        return plan, latest, finished
+
+    def start(self, **plan):
+        """Starts a new journal, refusing to clobber an unfinished rotation"""
+        previous, _, finished = self.state()
+        if previous is not None and not finished:
+            raise JournalError(
+                f"{self.path} holds an unfinished rotation of {previous['cluster']}."
+                " Resume it with --resume, or move the file out of the way"
+            )
+        open(self.path, "w").close()
+        self.record("planned", **plan)
+
+
+def wave_size(size, total):
+    """
+    Works out how many instances go in each wave for an ASG
+
+    :param size: A count (3 or "3"), a percentage ("25%"), or None for a single wave
+    :param total: The number of outdated instances in the ASG
+    :return: int
+    """
+    if size is None:
+        return max(1, total)
+    if isinstance(size, str) and size.endswith("%"):
+        return max(1, math.ceil(total * float(size[:-1]) / 100))
+    return max(1, int(size))
+
+
+def plan_waves(by_asg, size=None, canary=0):
+    """
+    Splits outdated instances into the waves they will be rotated in. Each wave takes
+    up to size instances from every ASG, with an optional canary wave of canary
+    instances per ASG first.
+
+    :param by_asg: A dict of ASG names to lists of outdated EC2 instance IDs
+    :param size: The wave size per ASG, see wave_size
+    :param canary: The number of instances per ASG in the canary wave, 0 for none
+    :return: a list of dicts of ASG names to lists of EC2 instance IDs
+    """
+    remaining = {asg: list(ids) for asg, ids in sorted(by_asg.items()) if ids}
+    sizes = {asg: wave_size(size, len(ids)) for asg, ids in remaining.items()}
+    waves = []
+
+    if canary:
+        waves.append({asg: ids[:canary] for asg, ids in remaining.items()})
+        remaining = {asg: ids[canary:] for asg, ids in remaining.items()}
+
+    while any(remaining.values()):
+        waves.append({asg: ids[: sizes[asg]] for asg, ids in remaining.items() if ids})
+        remaining = {asg: ids[sizes[asg] :] for asg, ids in remaining.items()}
+
+    return waves
+
+
+class History:
+    """
+    Local JSON lines record of how long each wave took to provision and drain, used to
+    estimate how long future rotations will take
+
+    :param path: Where the history file lives
+    """
+
+    def __init__(self, path=HISTORY):
+        self.path = path
+
+    def record(self, cluster, phase, seconds, instances):
+        with open(self.path, "a") as history:
+            history.write(
+                json.dumps(
+                    {
+                        "time": time.time(),
+                        "cluster": cluster,
+                        "phase": phase,
+                        "seconds": seconds,
+                        "instances": instances,
+                    }
+                )
+                + "\n"
+            )
+
+    def observations(self, phase):
+        if not os.path.exists(self.path):
+            return []
+
+        observations = []
+        with open(self.path) as history:
+            for line in history:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("phase") == phase:
+                    observations.append(entry)
+        return observations
+
+    def estimate(self, cluster, phase):
+        """
+        The median seconds a wave took for this cluster, falling back to every cluster,
+        then to DEFAULT_DURATIONS
+
+        :return: a tuple of seconds and the number of observations it was based on
+        """
+        observations = self.observations(phase)
+        own = [entry for entry in observations if entry["cluster"] == cluster]
+        seconds = [entry["seconds"] for entry in own or observations]
+        if not seconds:
+            return DEFAULT_DURATIONS[phase], 0
+        return statistics.median(seconds), len(seconds)
+
+
+def plan_rotation(session, waves, canary=False, history=None):
+    """
+    Works out what rotating the waves would do, without changing anything
+
+    :param session: An object containing boto3 sessions, cluster, and AMI information
+    :param waves: A list of dicts of ASG names to EC2 instance IDs, see plan_waves
+    :param canary: Whether the first wave is a canary
+    :param history: A History of previous rotations, used for the duration estimate
+    :return: a dict describing the rotation
+    """
+    history = history or History()
+    sizes = [sum(map(len, wave.values())) for wave in waves]
+    instances = {i for wave in waves for ids in wave.values() for i in ids}
+    tasks = sum(
+        item.get("runningTasksCount", 0) + item.get("pendingTasksCount", 0)
+        for item in session.inventory.outdated
+        if item["ec2InstanceId"] in instances
+    )
+
+    # the next wave provisions while the previous drains, except after a canary
+    overlapping = sizes[1:] if canary else sizes
+    surge = max([a + b for a, b in zip(overlapping, overlapping[1:])] + sizes + [0])
+
+    provisioning, provisioning_runs = history.estimate(session.cluster, "provisioning")
+    draining, draining_runs = history.estimate(session.cluster, "draining")
+    steps = len(overlapping)
+    total = (provisioning + draining) * (len(sizes) - steps)
+    if steps:
+        total += provisioning + (steps - 1) * max(provisioning, draining) + draining
+
+    return {
+        "region": session.region,
+        "cluster": session.cluster,
+        "ami": session.ami,
+        "asgs": {
+            asg: sorted(i for wave in waves for i in wave.get(asg, []))
+            for asg in sorted({asg for wave in waves for asg in wave})
+        },
+        "waves": waves,
+        "instances": len(instances),
+        "surge_instances": surge,
+        "tasks_to_reschedule": tasks,
+        "estimate": {
+            "provisioning_seconds": provisioning,
+            "draining_seconds": draining,
+            "total_seconds": total,
+            "observations": min(provisioning_runs, draining_runs),
+        },
+    }
+
+
+def format_plan(plan):
+    """Renders plan_rotation's result as a table"""
+    estimate = plan["estimate"]
+    lines = [
+        f"Cluster:  {plan['cluster']} ({plan['region']})",
+        f"AMI:      {plan['ami']}",
+        f"Rotating {plan['instances']} instances in {len(plan['waves'])} waves,"
+        f" up to {plan['surge_instances']} surge instances at once",
+        f"Rescheduling {plan['tasks_to_reschedule']} tasks",
+        f"Estimated {estimate['total_seconds'] / 60:.0f} minutes"
+        f" ({estimate['provisioning_seconds']:.0f}s provisioning,"
+        f" {estimate['draining_seconds']:.0f}s draining per wave,"
+        f" from {estimate['observations'] or 'no'} previous waves)",
+        "",
+    ]
+
+    rows = [("WAVE", "ASG", "INSTANCES")]
+    for number, wave in enumerate(plan["waves"], 1):
+        for asg, ids in sorted(wave.items()):
+            rows.append((str(number), asg, " ".join(ids)))
+    widths = [max(len(row[i]) for row in rows) for i in range(2)]
+    lines.extend(
+        f"{row[0].ljust(widths[0])}  {row[1].ljust(widths[1])}  {row[2]}"
+        for row in rows
+    )
+    return "\n".join(lines)
+
+
+def _record(session, phase, **fields):
+    if session.journal is not None:
+        session.journal.record(phase, **fields)
+    if session.progress is not None:
+        session.progress(phase, **fields)
+
+
+def _observe(session, phase, seconds, instances):
+    if session.history is not None:
+        session.history.record(session.cluster, phase, seconds, len(instances))
+
+
+def _finish_wave(session, number, name, instances, waiter, census, deadline):
+    elapsed = waiter.wait(
+        session,
+        f"{name} draining",
+        lambda s: busy_instances(s, census=census, instances=instances),
+        deadline,
+    )
+    _observe(session, "draining", elapsed, instances)
+    deregister(session, instances=instances)
+    _record(session, "deregistered", wave=number, instances=instances)
+    terminate(session, instances=instances)
+    _record(session, "terminated", wave=number, instances=instances)
+
+
+def rotate_in_waves(
+    session,
+    waves,
+    waiter,
+    census="instances",
+    max_workers=MAX_WORKERS,
+    canary=False,
+    provision_deadline=PROVISION_DEADLINE,
+    drain_deadline=DRAIN_DEADLINE,
+    start=1,
+):
+    """
+    Rotates each wave in turn: detach, wait for the replacements to join the cluster,
+    drain, wait for the tasks to move, then deregister and terminate.
+
+    Waves overlap, so the next wave is detached and provisioned while the previous one
+    drains. This keeps at most two waves of surge capacity out at once. If canary is
+    set, the first wave is rotated all the way through before the rest begin.
+
+    :param session: An object containing boto3 sessions, cluster, AMI, and ASG
+        information
+    :param waves: A list of dicts of ASG names to EC2 instance IDs, see plan_waves
+    :param waiter: A Waiter used to poll each phase
+    :param census: How to count tasks on draining instances, see busy_instances
+    :param max_workers: The maximum number of concurrent calls when detaching
+    :param canary: Whether the first wave is a canary
+    :param provision_deadline: Seconds allowed for each wave's replacements to join
+    :param drain_deadline: Seconds allowed for containers to move off each wave
+    :param start: The number of the first wave, when resuming part way through
+    :return: None
+    """
+    total = start - 1 + len(waves)
+    # new instances the cluster should have once the current wave is provisioned
+    expected = len(session.inventory.current_arns)
+    draining = None
+
+    for number, wave in enumerate(waves, start):
+        name = f"Wave {number}/{total}"
+        logging.info("%s: rotating %s instances", name, sum(map(len, wave.values())))
+
+        planned = [i for ids in wave.values() for i in ids]
+        # recorded up front so a resume can wait on the same count
+        _record(
+            session,
+            "detaching",
+            wave=number,
+            instances=planned,
+            expected=expected + len(planned),
+        )
+        instances = detach_outdated_instances(
+            session, max_workers=max_workers, instances=wave
+        )
+        session.instances |= instances
+        expected += len(instances)
+        _record(
+            session, "detached", wave=number, instances=instances, expected=expected
+        )
+
+        elapsed = waiter.wait(
+            session,
+            f"{name} provisioning",
+            lambda s: pending_provisioning(s, expected=expected),
+            provision_deadline,
+        )
+        _observe(session, "provisioning", elapsed, instances)
+        _record(session, "provisioned", wave=number, instances=instances)
+
+        if draining:
+            _finish_wave(session, *draining, waiter, census, drain_deadline)
+            draining = None
+
+        drain_instances(session, instances=instances)
+        _record(session, "draining", wave=number, instances=instances)
+        if canary and number == 1:
+            _finish_wave(
+                session, number, name, instances, waiter, census, drain_deadline
+            )
+        else:
+            draining = (number, name, instances)
+
+    if draining:
+        _finish_wave(session, *draining, waiter, census, drain_deadline)
+
+
+def main(
+    ami,
+    cluster,
+    region="ap-southeast-2",
+    clients=None,
+    census="instances",
+    max_workers=MAX_WORKERS,
+    waiter=None,
+    provision_deadline=PROVISION_DEADLINE,
+    drain_deadline=DRAIN_DEADLINE,
+    size=None,
+    canary=0,
+    journal=None,
+    progress=None,
+    history=None,
+):
     """
     Linking all functions together in a useful manner. First get the ASG info for any
     instances attached to the cluster that do not match the AMI ID. Then detach them and
     wait till they are replaced by fresh instances.
     After replacement, drain the containers, and deregister and terminate them once
-    complete
+    complete. Instances are rotated in waves of size per ASG if it is set
 
     :param ami: The AMI ID to rotate to
     :param cluster: The cluster ARN to rotate instances in
     :param region: The AWS region name
     :param clients: A dict of boto3 clients (ecs, autoscaling, ec2)
-    :param snooze: The sleep length in seconds between successive wait calls
+    :param census: How to count tasks on draining instances, see busy_instances
+    :param max_workers: The maximum number of concurrent calls when detaching
+    :param waiter: A Waiter used to poll each phase
+    :param provision_deadline: Seconds allowed for new instances to join the cluster
+    :param drain_deadline: Seconds allowed for containers to move off old instances
+    :param size: The wave size per ASG, as a count or percentage. Defaults to one wave
+    :param canary: The number of instances per ASG to rotate first as a canary
+    :param journal: A path to record progress to, so the rotation can be resumed
+    :param progress: Called with each phase transition, as progress(phase, **fields)
+    :param history: A path to record how long each phase took, for dry_run estimates
     :return: None
     """
-    session = Session(region=region, clients=clients)
+    session = Session(region=region, clients=clients, max_pool_connections=max_workers)
     session.ami = ami
     session.cluster = cluster
+    session.progress = progress
+    session.history = History(history) if history else None
+    waiter = waiter or Waiter()
+
+    by_asg = outdated_by_asg(session)
+    session.asgs = set(by_asg)
+    if not by_asg:
+        logging.info("No instances to rotate")
+        return
+
+    waves = plan_waves(by_asg, size=size, canary=canary)
+    if journal:
+        session.journal = Journal(journal)
+        session.journal.start(
+            ami=ami,
+            cluster=cluster,
+            region=region,
+            census=census,
+            canary=bool(canary),
+            waves=waves,
+        )
 
-    session.asgs = find_outdated_asg(session)
-    session.instances = detach_outdated_instances(session)
+    rotate_in_waves(
+        session,
+        waves,
+        waiter,
+        census=census,
+        max_workers=max_workers,
+        canary=bool(canary),
+        provision_deadline=provision_deadline,
+        drain_deadline=drain_deadline,
+    )
+    _record(session, "finished")
 
-    logging.info("Checking to see if instances are added to the ASG")
-    total_sleep = 0
-    while not can_drain_instances(session):
-        if total_sleep >= 10:
-            raise Exception  # TODO - make a better exception
-        logging.info("ASG still provisioning instances. Sleeping for %s", snooze)
-        time.sleep(snooze)
-        total_sleep += 1
-    logging.info("Took %s minutes to provision new instances", total_sleep)
 
-    drain_instances(session)
+def dry_run(
+    ami,
+    cluster,
+    region="ap-southeast-2",
+    clients=None,
+    size=None,
+    canary=0,
+    history=HISTORY,
+    max_workers=MAX_WORKERS,
+):
+    """
+    Plans a rotation the same way main() would, using only read calls, and estimates
+    how long it will take from the durations of previous rotations
+
+    :param ami: The AMI ID to rotate to
+    :param cluster: The cluster ARN to rotate instances in
+    :param region: The AWS region name
+    :param clients: A dict of boto3 clients (ecs, autoscaling, ec2)
+    :param size: The wave size per ASG, as a count or percentage. Defaults to one wave
+    :param canary: The number of instances per ASG to rotate first as a canary
+    :param history: The path previous rotations recorded their durations to
+    :param max_workers: Sizes the connection pool, so main() can reuse the clients
+    :return: a dict describing the rotation, see plan_rotation
+    """
+    session = Session(region=region, clients=clients, max_pool_connections=max_workers)
+    session.ami = ami
+    session.cluster = cluster
 
-    logging.info("Checking to see if instances can be removed from the cluster")
-    total_sleep = 0
-    while not can_deregister(session):
-        if total_sleep >= 20:
-            raise Exception  # TODO - make a better exception
-        logging.info("Containers still running on instances. Sleeping for %s", snooze)
-        time.sleep(snooze)
-        total_sleep += 1
-    logging.info("Took %s minutes to rotate containers", total_sleep)
+    by_asg = outdated_by_asg(session)
+    session.asgs = set(by_asg)
+    return plan_rotation(
+        session,
+        plan_waves(by_asg, size=size, canary=canary),
+        canary=bool(canary),
+        history=History(history),
+    )
 
-    deregister(session)
-    terminate(session)
+
+def resume(
+    journal,
+    clients=None,
+    waiter=None,
+    max_workers=MAX_WORKERS,
+    provision_deadline=PROVISION_DEADLINE,
+    drain_deadline=DRAIN_DEADLINE,
+):
+    """
+    Picks an interrupted rotation back up from its journal. Waves that were part way
+    through carry on from their last recorded phase using the instance IDs in the
+    journal, then the waves that hadn't started are rotated as normal. The cluster is
+    not searched for outdated instances again.
+
+    :param journal: The path to the journal of the interrupted rotation
+    :param clients: A dict of boto3 clients (ecs, autoscaling, ec2)
+    :param waiter: A Waiter used to poll each phase
+    :param max_workers: The maximum number of concurrent calls when detaching
+    :param provision_deadline: Seconds allowed for new instances to join the cluster
+    :param drain_deadline: Seconds allowed for containers to move off old instances
+    :return: None
+    """
+    journal = Journal(journal)
+    plan, latest, finished = journal.state()
+    if plan is None:
+        raise JournalError(f"{journal.path} has no rotation to resume")
+    if finished:
+        logging.info("Rotation in %s already finished", journal.path)
+        return
+
+    session = Session(
+        region=plan["region"], clients=clients, max_pool_connections=max_workers
+    )
+    session.ami = plan["ami"]
+    session.cluster = plan["cluster"]
+    session.journal = journal
+    waves = plan["waves"]
+    session.asgs = {asg for wave in waves for asg in wave}
+    census = plan["census"]
+    waiter = waiter or Waiter()
+
+    logging.info("Resuming rotation of %s from %s", session.cluster, journal.path)
+    next_wave = len(waves) + 1
+    for number, wave in enumerate(waves, 1):
+        entry = latest.get(number)
+        if entry is None:
+            next_wave = number
+            break
+
+        name = f"Wave {number}/{len(waves)}"
+        phase = entry["phase"]
+        instances = set(entry["instances"])
+        expected = entry.get("expected")
+        session.instances |= instances
+        logging.info("%s: resuming after %s", name, phase)
+
+        if phase == "detaching":
+            # the detach may have only partly gone through
+            attached = attached_by_asg(session, sorted(instances))
+            if attached:
+                detach_outdated_instances(
+                    session, max_workers=max_workers, instances=attached
+                )
+            _record(
+                session,
+                "detached",
+                wave=number,
+                instances=instances,
+                expected=expected,
+            )
+            phase = "detached"
+        if phase == "detached":
+            waiter.wait(
+                session,
+                f"{name} provisioning",
+                lambda s: pending_provisioning(s, expected=expected),
+                provision_deadline,
+            )
+            _record(session, "provisioned", wave=number, instances=instances)
+            phase = "provisioned"
+        if phase == "provisioned":
+            drain_instances(session, instances=instances)
+            _record(session, "draining", wave=number, instances=instances)
+            phase = "draining"
+        if phase == "draining":
+            _finish_wave(
+                session, number, name, instances, waiter, census, drain_deadline
+            )
+        elif phase == "deregistered":
+            terminate(session, instances=instances)
+            _record(session, "terminated", wave=number, instances=instances)
+
+    if next_wave <= len(waves):
+        rotate_in_waves(
+            session,
+            waves[next_wave - 1 :],
+            waiter,
+            census=census,
+            max_workers=max_workers,
+            canary=plan["canary"] and next_wave == 1,
+            provision_deadline=provision_deadline,
+            drain_deadline=drain_deadline,
+            start=next_wave,
+        )
+    _record(session, "finished")
+
+
+def load_manifest(path):
+    """
+    Reads a fleet manifest, a JSON list of rotation targets. Each target needs a
+    region, cluster and ami, and can set its own size and canary.
+
+    eg:
+    [{"region": "ap-southeast-2", "cluster": "some-cluster", "ami": "ami-123"}]
+
+    :param path: The path to the manifest
+    :return: a list of target dicts
+    """
+    with open(path) as manifest:
+        targets = json.load(manifest)
+
+    for target in targets:
+        missing = {"region", "cluster", "ami"} - set(target)
+        if missing:
+            raise ValueError(f"Manifest target {target} is missing {sorted(missing)}")
+    return targets
+
+
+class FleetProgress:
+    """
+    Thread-safe status board for a fleet rotation, one row per target
+
+    :param targets: A list of target dicts, see load_manifest
+    """
+
+    columns = ("region", "cluster", "ami", "status")
+
+    def __init__(self, targets):
+        self._lock = threading.Lock()
+        self.rows = [dict(target, status="queued") for target in targets]
+
+    def update(self, index, status):
+        with self._lock:
+            self.rows[index]["status"] = status
+
+    def watcher(self, index):
+        """Returns a progress callback for main() that updates a target's row"""
+
+        def progress(phase, wave=None, **fields):
+            self.update(index, f"wave {wave} {phase}" if wave else phase)
+
+        return progress
+
+    def table(self):
+        with self._lock:
+            rows = [[str(row[column]) for column in self.columns] for row in self.rows]
+
+        header = [column.upper() for column in self.columns]
+        widths = [max(map(len, cells)) for cells in zip(header, *rows)]
+        return "\n".join(
+            "  ".join(cell.ljust(width) for cell, width in zip(cells, widths)).rstrip()
+            for cells in [header] + rows
+        )
+
+
+def fleet(
+    targets,
+    clients=None,
+    concurrency=FLEET_WORKERS,
+    journal_dir=None,
+    report_interval=60,
+    **options,
+):
+    """
+    Rotates many clusters, across regions, at once. One set of boto3 clients is built
+    per region and shared by every cluster in it, and at most concurrency clusters are
+    rotated at a time. A progress table is printed every report_interval seconds, and
+    once everything is done.
+
+    :param targets: A list of target dicts, see load_manifest
+    :param clients: A dict of region names to dicts of boto3 clients
+    :param concurrency: The maximum number of clusters rotated at once
+    :param journal_dir: A directory to keep a journal per cluster in
+    :param report_interval: Seconds between progress tables
+    :param options: Passed through to main() for every target, unless overridden by
+        the target itself
+    :return: a list of the exception each target failed with, or None
+    """
+    # every cluster in a region shares its clients, so size their pools to match
+    pool_size = options.get("max_workers", MAX_WORKERS) * concurrency
+    clients = dict(clients or {})
+    for region in {target["region"] for target in targets}:
+        if region not in clients:
+            clients[region] = CLIENTS.clients(region, max_pool_connections=pool_size)
+
+    progress = FleetProgress(targets)
+    results = [None] * len(targets)
+
+    def rotate(index, target):
+        progress.update(index, "starting")
+        kwargs = dict(options)
+        kwargs.update(target)
+        if journal_dir:
+            name = target["cluster"].split("/")[-1]
+            kwargs["journal"] = os.path.join(
+                journal_dir, f"{target['region']}.{name}.rotation.jsonl"
+            )
+        try:
+            main(
+                clients=clients[target["region"]],
+                progress=progress.watcher(index),
+                **kwargs,
+            )
+        except Exception as e:
+            logging.exception("Rotating %s failed", target["cluster"])
+            progress.update(index, f"failed: {e}")
+            results[index] = e
+        else:
+            progress.update(index, "done")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = {
+            pool.submit(rotate, index, target) for index, target in enumerate(targets)
+        }
+        while pending:
+            _, pending = wait(pending, timeout=report_interval)
+            print(progress.table(), flush=True)
+
+    return results
 
 
 if __name__ == "__main__":
@@ -271,10 +1350,148 @@ if __name__ == "__main__":
         description="Rotate old AMIs in a given ECS cluster"
     )
     parser.add_argument(
-        "ami", help="The updated AMI ID that instances will be rotated to"
+        "ami", nargs="?", help="The updated AMI ID that instances will be rotated to"
     )
-    parser.add_argument("cluster", help="The cluster name to rotate in")
+    parser.add_argument("cluster", nargs="?", help="The cluster name to rotate in")
     parser.add_argument("--region", dest="region", default="ap-southeast-2")
+    parser.add_argument(
+        "--census",
+        choices=["instances", "tasks"],
+        default="instances",
+        help="how to check draining instances for remaining tasks",
+    )
+    parser.add_argument(
+        "--max-workers",
+        dest="max_workers",
+        type=int,
+        default=MAX_WORKERS,
+        help="cap on concurrent calls when detaching across ASGs",
+    )
+    parser.add_argument(
+        "--provision-deadline",
+        dest="provision_deadline",
+        type=int,
+        default=PROVISION_DEADLINE,
+        help="seconds allowed for new instances to join the cluster",
+    )
+    parser.add_argument(
+        "--drain-deadline",
+        dest="drain_deadline",
+        type=int,
+        default=DRAIN_DEADLINE,
+        help="seconds allowed for containers to move off old instances",
+    )
+    parser.add_argument(
+        "--wave-size",
+        dest="size",
+        help="instances per ASG to rotate at once, as a count or a percentage (25%%)",
+    )
+    parser.add_argument(
+        "--canary",
+        type=int,
+        default=0,
+        help="instances per ASG to rotate fully before the remaining waves",
+    )
+    parser.add_argument(
+        "--journal",
+        help="file to record progress to (default: <cluster name>.rotation.jsonl),"
+        " or the directory to keep them in with --fleet",
+    )
+    parser.add_argument(
+        "--resume",
+        metavar="JOURNAL",
+        help="resume an interrupted rotation from its journal",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="only print what the rotation would do and how long it should take",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["table", "json"],
+        default="table",
+        help="how to print the --plan output",
+    )
+    parser.add_argument(
+        "--history",
+        default=HISTORY,
+        help="file to record phase durations to, for --plan estimates",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="log how long the boto3 session and clients took to create",
+    )
+    parser.add_argument(
+        "--fleet",
+        metavar="MANIFEST",
+        help="rotate every (region, cluster, ami) target in a JSON manifest",
+    )
+    parser.add_argument(
+        "--fleet-workers",
+        dest="fleet_workers",
+        type=int,
+        default=FLEET_WORKERS,
+        help="cap on clusters rotated at once with --fleet",
+    )
     args = parser.parse_args()
 
-    main(ami=args.ami, cluster=args.cluster, region=args.region)
+    failed = False
+    if args.resume:
+        resume(
+            args.resume,
+            max_workers=args.max_workers,
+            provision_deadline=args.provision_deadline,
+            drain_deadline=args.drain_deadline,
+        )
+    elif args.fleet:
+        results = fleet(
+            load_manifest(args.fleet),
+            concurrency=args.fleet_workers,
+            journal_dir=args.journal or ".",
+            census=args.census,
+            max_workers=args.max_workers,
+            provision_deadline=args.provision_deadline,
+            drain_deadline=args.drain_deadline,
+            size=args.size,
+            canary=args.canary,
+            history=args.history,
+        )
+        failed = any(results)
+    elif not args.ami or not args.cluster:
+        parser.error("ami and cluster are required unless resuming")
+    elif args.plan:
+        plan = dry_run(
+            ami=args.ami,
+            cluster=args.cluster,
+            region=args.region,
+            size=args.size,
+            canary=args.canary,
+            history=args.history,
+            max_workers=args.max_workers,
+        )
+        if args.format == "json":
+            print(json.dumps(plan, indent=2))
+        else:
+            print(format_plan(plan))
+    else:
+        main(
+            ami=args.ami,
+            cluster=args.cluster,
+            region=args.region,
+            census=args.census,
+            max_workers=args.max_workers,
+            provision_deadline=args.provision_deadline,
+            drain_deadline=args.drain_deadline,
+            size=args.size,
+            canary=args.canary,
+            journal=args.journal or f"{args.cluster.split('/')[-1]}.rotation.jsonl",
+            history=args.history,
+        )
+
+    if args.timings:
+        for key, seconds in CLIENTS.timings.items():
+            logging.info("Created %s in %.3f seconds", key, seconds)
+    if failed:
+        raise SystemExit(1)
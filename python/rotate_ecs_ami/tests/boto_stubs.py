@@ -0,0 +1,120 @@
+"""Canned boto3 responses for the Stubber tests, trimmed from real API calls"""
+
+import datetime
+
+CLUSTER = "arn:aws:ecs:ap-southeast-2:111111111111:cluster/some-cluster"
+ASG = "some-cluster-ECSAutoScalingGroup-ASDF1234"
+INSTANCE_IDS = ["i-11111b1b1bb1bbb1b", "i-111a1a1aaa1a1aa11"]
+CONTAINER_INSTANCE_ARNS = [
+    "arn:aws:ecs:ap-southeast-2:111111111111:container-instance/some-cluster/a99b9853b6114c87af46c7501a3a6ba8",
+    "arn:aws:ecs:ap-southeast-2:111111111111:container-instance/some-cluster/e338a4bea54e4e06b664530a30ae02dd",
+]
+STARTED = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def container_instance(arn, instance_id):
+    return {
+        "containerInstanceArn": arn,
+        "ec2InstanceId": instance_id,
+        "version": 1,
+        "status": "ACTIVE",
+        "agentConnected": True,
+        "runningTasksCount": 2,
+        "pendingTasksCount": 0,
+        "attributes": [{"name": "ecs.ami-id", "value": "ami-00000000000000000"}],
+        "registeredAt": STARTED,
+    }
+
+
+list_container_instances = {"containerInstanceArns": list(CONTAINER_INSTANCE_ARNS)}
+
+describe_container_instances = {
+    "containerInstances": [
+        container_instance(arn, instance_id)
+        for arn, instance_id in zip(CONTAINER_INSTANCE_ARNS, INSTANCE_IDS)
+    ],
+    "failures": [],
+}
+
+describe_autoscaling_instances = {
+    "AutoScalingInstances": [
+        {
+            "InstanceId": instance_id,
+            "InstanceType": "m5.large",
+            "AutoScalingGroupName": ASG,
+            "AvailabilityZone": "ap-southeast-2a",
+            "LifecycleState": "InService",
+            "HealthStatus": "HEALTHY",
+            "ProtectedFromScaleIn": False,
+        }
+        for instance_id in INSTANCE_IDS
+    ]
+}
+
+describe_autoscaling_group = {
+    "AutoScalingGroups": [
+        {
+            "AutoScalingGroupName": ASG,
+            "AutoScalingGroupARN": f"arn:aws:autoscaling:ap-southeast-2:111111111111:autoScalingGroup:00000000-0000-0000-0000-000000000000:autoScalingGroupName/{ASG}",
+            "MinSize": 2,
+            "MaxSize": 4,
+            "DesiredCapacity": 2,
+            "DefaultCooldown": 300,
+            "AvailabilityZones": ["ap-southeast-2a"],
+            "HealthCheckType": "EC2",
+            "HealthCheckGracePeriod": 0,
+            "CreatedTime": STARTED,
+            "Instances": [
+                {
+                    "InstanceId": instance_id,
+                    "InstanceType": "m5.large",
+                    "AvailabilityZone": "ap-southeast-2a",
+                    "LifecycleState": "InService",
+                    "HealthStatus": "Healthy",
+                    "ProtectedFromScaleIn": False,
+                }
+                for instance_id in INSTANCE_IDS
+            ],
+        }
+    ]
+}
+
+detach_instances = {
+    "Activities": [
+        {
+            "ActivityId": f"00000000-0000-0000-0000-00000000000{index}",
+            "AutoScalingGroupName": ASG,
+            "Description": f"Detaching EC2 instance: {instance_id}",
+            "Cause": "At 2020-01-01T00:00:00Z instance was detached in response to a user request.",
+            "StartTime": STARTED,
+            "StatusCode": "InProgress",
+            "Progress": 50,
+        }
+        for index, instance_id in enumerate(INSTANCE_IDS)
+    ]
+}
+
+update_container_instances_state = {
+    "containerInstances": [
+        dict(instance, status="DRAINING")
+        for instance in describe_container_instances["containerInstances"]
+    ],
+    "failures": [],
+}
+
+deregister_container_instance = {
+    "containerInstance": dict(
+        describe_container_instances["containerInstances"][0], status="INACTIVE"
+    )
+}
+
+terminate_instances = {
+    "TerminatingInstances": [
+        {
+            "InstanceId": instance_id,
+            "CurrentState": {"Code": 32, "Name": "shutting-down"},
+            "PreviousState": {"Code": 16, "Name": "running"},
+        }
+        for instance_id in INSTANCE_IDS
+    ]
+}
@@ -1,11 +1,10 @@
-from scripts import rotate_ecs_ami as rot
+import rotate_ecs_ami as rot
 from .boto_stubs import deregister_container_instance as dereg_con_inst_result
 from .boto_stubs import describe_autoscaling_group as des_asg_grp_result
 from .boto_stubs import describe_autoscaling_instances as desc_asg_inst_result
 from .boto_stubs import describe_container_instances as desc_cont_result
 from .boto_stubs import detach_instances as det_inst_result
 from .boto_stubs import list_container_instances as list_cont_result
-from .boto_stubs import list_tasks as list_task_result
 from .boto_stubs import terminate_instances as terminate_result
 from .boto_stubs import update_container_instances_state as update_cont_result
 import copy
@@ -75,6 +74,65 @@ def test_find_outdated_asg(boto3_clients):
         stub.deactivate()
 
 
+def test_inventory_pages_and_batches(boto3_clients):
+    session = rot.Session(clients=boto3_clients)
+    session.ami = AMI
+    session.cluster = CLUSTER
+
+    arns = [
+        f"arn:aws:ecs:ap-southeast-2:111111111111:container-instance/some-cluster/{i:032x}"
+        for i in range(150)
+    ]
+    first_page = {"containerInstanceArns": arns[:100], "nextToken": "page-2"}
+    second_page = {"containerInstanceArns": arns[100:]}
+
+    with Stubber(boto3_clients["ecs"]) as stubber:
+        stubber.add_response(
+            method="list_container_instances",
+            service_response=first_page,
+            expected_params={
+                "cluster": CLUSTER,
+                "filter": f"attribute:ecs.ami-id != {AMI}",
+            },
+        )
+        stubber.add_response(
+            method="list_container_instances",
+            service_response=second_page,
+            expected_params={
+                "cluster": CLUSTER,
+                "filter": f"attribute:ecs.ami-id != {AMI}",
+                "nextToken": "page-2",
+            },
+        )
+        stubber.add_response(
+            method="describe_container_instances",
+            service_response={"containerInstances": [], "failures": []},
+            expected_params={"cluster": CLUSTER, "containerInstances": arns[:100]},
+        )
+        stubber.add_response(
+            method="describe_container_instances",
+            service_response={"containerInstances": [], "failures": []},
+            expected_params={"cluster": CLUSTER, "containerInstances": arns[100:]},
+        )
+        for i in range(0, 150, 10):
+            stubber.add_response(
+                method="update_container_instances_state",
+                service_response=update_cont_result,
+                expected_params={
+                    "cluster": CLUSTER,
+                    "containerInstances": arns[i : i + 10],
+                    "status": "DRAINING",
+                },
+            )
+
+        assert session.inventory.outdated_arns == arns
+        assert session.inventory.outdated == []
+        # cached until refreshed, so no further list calls
+        assert len(rot.drain_instances(session)) == 15
+
+        stubber.assert_no_pending_responses()
+
+
 def test_detach_outdated_instances(boto3_clients):
 
     session = rot.Session(clients=boto3_clients)
@@ -104,6 +162,75 @@ def test_detach_outdated_instances(boto3_clients):
 
         stubber.assert_no_pending_responses()
 
+    assert session.detached == {list(ASGS)[0]: desired_result}
+
+
+def test_detach_reports_per_asg(boto3_clients):
+    session = rot.Session(clients=boto3_clients)
+    session.asgs = {"asg-a", "asg-b", "asg-c"}
+
+    ids = [f"i-{i:017x}" for i in range(25)]
+
+    def asg_result(name, instance_ids):
+        result = copy.deepcopy(des_asg_grp_result)
+        group = result["AutoScalingGroups"][0]
+        group["AutoScalingGroupName"] = name
+        template = group["Instances"][0]
+        group["Instances"] = [dict(template, InstanceId=i) for i in instance_ids]
+        return result
+
+    def detach_result(instance_ids):
+        template = det_inst_result["Activities"][0]
+        return {
+            "Activities": [
+                dict(template, Description=f"Detaching EC2 instance: {i}")
+                for i in instance_ids
+            ]
+        }
+
+    with Stubber(boto3_clients["autoscaling"]) as stubber:
+        # a single worker keeps the order of calls deterministic
+        stubber.add_response(
+            method="describe_auto_scaling_groups",
+            service_response=asg_result("asg-a", ids),
+            expected_params={"AutoScalingGroupNames": ["asg-a"], "MaxRecords": 100},
+        )
+        stubber.add_client_error(
+            method="describe_auto_scaling_groups", service_error_code="Throttling"
+        )
+        stubber.add_response(
+            method="describe_auto_scaling_groups",
+            service_response=asg_result("asg-c", ids[:1]),
+            expected_params={"AutoScalingGroupNames": ["asg-c"], "MaxRecords": 100},
+        )
+        for name, group in (
+            ("asg-a", ids[:20]),
+            ("asg-a", ids[20:]),
+            ("asg-c", ids[:1]),
+        ):
+            stubber.add_response(
+                method="detach_instances",
+                service_response=detach_result(group),
+                expected_params={
+                    "InstanceIds": group,
+                    "AutoScalingGroupName": name,
+                    "ShouldDecrementDesiredCapacity": False,
+                },
+            )
+
+        with pytest.raises(rot.DetachError) as error:
+            rot.detach_outdated_instances(session, max_workers=1)
+
+        stubber.assert_no_pending_responses()
+
+    assert set(error.value.failures) == {"asg-b"}
+    assert error.value.detached == {
+        "asg-a": set(ids),
+        "asg-b": set(),
+        "asg-c": {ids[0]},
+    }
+    assert session.detached == error.value.detached
+
 
 def test_drain_instances(boto3_clients):
     session = rot.Session(clients=boto3_clients)
@@ -195,8 +322,11 @@ def test_can_update_service(boto3_clients):
         stub.activate()
 
     assert rot.can_drain_instances(session) is False
+    session.inventory.refresh()
     assert rot.can_drain_instances(session) is False
+    session.inventory.refresh()
     assert rot.can_drain_instances(session) is False
+    session.inventory.refresh()
     assert rot.can_drain_instances(session) is True
 
     for stub in stubs.values():
@@ -214,35 +344,157 @@ def test_can_deregister(boto3_clients):
     containers["containerInstanceArns"] = [
         "arn:aws:ecs:ap-southeast-2:111111111111:container-instance/some-cluster/a99b9853b6114c87af46c7501a3a6ba8"
     ]
-    success_result = copy.deepcopy(list_task_result)
-    success_result["taskArns"] = []
+    busy_result = copy.deepcopy(desc_cont_result)
+    busy_result["containerInstances"] = busy_result["containerInstances"][:1]
+    busy_result["containerInstances"][0]["containerInstanceArn"] = containers[
+        "containerInstanceArns"
+    ][0]
+    busy_result["containerInstances"][0]["runningTasksCount"] = 1
+    busy_result["containerInstances"][0]["pendingTasksCount"] = 0
+    success_result = copy.deepcopy(busy_result)
+    success_result["containerInstances"][0]["runningTasksCount"] = 0
+
+    with Stubber(boto3_clients["ecs"]) as stubber:
+        for response in (busy_result, success_result):
+            stubber.add_response(
+                method="list_container_instances",
+                service_response=containers,
+                expected_params={
+                    "cluster": CLUSTER,
+                    "filter": f"attribute:ecs.ami-id != {AMI}",
+                },
+            )
+            stubber.add_response(
+                method="describe_container_instances",
+                service_response=response,
+                expected_params={
+                    "cluster": CLUSTER,
+                    "containerInstances": containers["containerInstanceArns"],
+                },
+            )
+
+        assert rot.can_deregister(session) is False
+        session.inventory.refresh()
+        assert rot.can_deregister(session) is True
+
+        stubber.assert_no_pending_responses()
+
+
+def test_can_deregister_task_census(boto3_clients):
+    session = rot.Session(clients=boto3_clients)
+    session.ami = AMI
+    session.cluster = CLUSTER
+
+    busy_arn = list_cont_result["containerInstanceArns"][0]
+    task_arn = "arn:aws:ecs:ap-southeast-2:111111111111:task/some-cluster/1234"
 
     with Stubber(boto3_clients["ecs"]) as stubber:
         stubber.add_response(
-            method="list_container_instances",
-            service_response=containers,
-            expected_params={
-                "cluster": CLUSTER,
-                "filter": f"attribute:ecs.ami-id != {AMI}",
-            },
+            method="list_container_instances", service_response=list_cont_result
         )
-        stubber.add_response(method="list_tasks", service_response=list_task_result)
-
         stubber.add_response(
-            method="list_container_instances",
-            service_response=containers,
-            expected_params={
-                "cluster": CLUSTER,
-                "filter": f"attribute:ecs.ami-id != {AMI}",
+            method="list_tasks",
+            service_response={"taskArns": [task_arn]},
+            expected_params={"cluster": CLUSTER, "desiredStatus": "RUNNING"},
+        )
+        stubber.add_response(
+            method="describe_tasks",
+            service_response={
+                "tasks": [{"taskArn": task_arn, "containerInstanceArn": busy_arn}],
+                "failures": [],
             },
+            expected_params={"cluster": CLUSTER, "tasks": [task_arn]},
         )
-        stubber.add_response(method="list_tasks", service_response=success_result)
 
-        assert rot.can_deregister(session) is False
-        assert rot.can_deregister(session) is True
+        assert rot.busy_instances(session, census="tasks") == {busy_arn}
+        assert rot.can_deregister(session, census="tasks") is False
+
+        stubber.assert_no_pending_responses()
+
+
+def count_calls(client):
+    """Returns a dict that is updated with a count of each API call the client makes"""
+    counts = {}
+
+    def counter(model, **kwargs):
+        counts[model.name] = counts.get(model.name, 0) + 1
+
+    client.meta.events.register("before-parameter-build", counter)
+    return counts
+
+
+@pytest.mark.parametrize(
+    "census, expected",
+    [
+        ("instances", {"ListContainerInstances": 3, "DescribeContainerInstances": 3}),
+        (
+            "tasks",
+            {"ListContainerInstances": 3, "ListTasks": 2, "DescribeTasks": 2},
+        ),
+    ],
+)
+def test_census_api_calls_per_poll(boto3_clients, census, expected):
+    session = rot.Session(clients=boto3_clients)
+    session.ami = AMI
+    session.cluster = CLUSTER
+
+    arns = [
+        f"arn:aws:ecs:ap-southeast-2:111111111111:container-instance/some-cluster/{i:032x}"
+        for i in range(300)
+    ]
+    task_arns = [
+        f"arn:aws:ecs:ap-southeast-2:111111111111:task/some-cluster/{i:032x}"
+        for i in range(150)
+    ]
+    counts = count_calls(boto3_clients["ecs"])
+
+    with Stubber(boto3_clients["ecs"]) as stubber:
+        for i in range(0, 300, 100):
+            page = {"containerInstanceArns": arns[i : i + 100]}
+            if i + 100 < 300:
+                page["nextToken"] = str(i + 100)
+            stubber.add_response(
+                method="list_container_instances", service_response=page
+            )
+
+        if census == "instances":
+            for i in range(0, 300, 100):
+                stubber.add_response(
+                    method="describe_container_instances",
+                    service_response={
+                        "containerInstances": [
+                            {"containerInstanceArn": arn, "runningTasksCount": 0}
+                            for arn in arns[i : i + 100]
+                        ],
+                        "failures": [],
+                    },
+                )
+        else:
+            stubber.add_response(
+                method="list_tasks",
+                service_response={"taskArns": task_arns[:100], "nextToken": "100"},
+            )
+            stubber.add_response(
+                method="list_tasks", service_response={"taskArns": task_arns[100:]}
+            )
+            for i in range(0, 150, 100):
+                stubber.add_response(
+                    method="describe_tasks",
+                    service_response={
+                        "tasks": [
+                            {"taskArn": arn, "containerInstanceArn": "elsewhere"}
+                            for arn in task_arns[i : i + 100]
+                        ],
+                        "failures": [],
+                    },
+                )
+
+        assert rot.can_deregister(session, census=census) is True
 
         stubber.assert_no_pending_responses()
 
+    assert counts == expected
+
 
 def test_deregister(boto3_clients):
     session = rot.Session(clients=boto3_clients)
@@ -293,6 +545,442 @@ def test_terminate(boto3_clients):
         stubber.assert_no_pending_responses()
 
 
+@pytest.mark.parametrize(
+    "size, canary, expected",
+    [
+        (None, 0, [{"asg-a": ["a1", "a2", "a3", "a4"], "asg-b": ["b1"]}]),
+        (2, 0, [{"asg-a": ["a1", "a2"], "asg-b": ["b1"]}, {"asg-a": ["a3", "a4"]}]),
+        (
+            "50%",
+            1,
+            [
+                {"asg-a": ["a1"], "asg-b": ["b1"]},
+                {"asg-a": ["a2", "a3"]},
+                {"asg-a": ["a4"]},
+            ],
+        ),
+    ],
+)
+def test_plan_waves(size, canary, expected):
+    by_asg = {"asg-b": ["b1"], "asg-a": ["a1", "a2", "a3", "a4"]}
+
+    assert rot.plan_waves(by_asg, size=size, canary=canary) == expected
+
+
+class FakeInventory:
+    current_arns = []
+    outdated = []
+
+    def refresh(self):
+        pass
+
+
+@pytest.mark.parametrize(
+    "canary, expected",
+    [
+        (
+            False,
+            [
+                ("detach", {"i-1"}),
+                ("drain", {"i-1"}),
+                ("detach", {"i-2"}),
+                ("deregister", {"i-1"}),
+                ("terminate", {"i-1"}),
+                ("drain", {"i-2"}),
+                ("deregister", {"i-2"}),
+                ("terminate", {"i-2"}),
+            ],
+        ),
+        (
+            True,
+            [
+                ("detach", {"i-1"}),
+                ("drain", {"i-1"}),
+                ("deregister", {"i-1"}),
+                ("terminate", {"i-1"}),
+                ("detach", {"i-2"}),
+                ("drain", {"i-2"}),
+                ("deregister", {"i-2"}),
+                ("terminate", {"i-2"}),
+            ],
+        ),
+    ],
+)
+def test_rotate_in_waves_overlaps(boto3_clients, monkeypatch, canary, expected):
+    session = rot.Session(clients=boto3_clients)
+    session._inventory = FakeInventory()
+    events = []
+
+    def record(name):
+        def phase(session, instances, **kwargs):
+            events.append((name, set(instances)))
+            return set(instances)
+
+        return phase
+
+    def detach(session, max_workers, instances):
+        return record("detach")(session, set().union(*instances.values()))
+
+    monkeypatch.setattr(rot, "detach_outdated_instances", detach)
+    monkeypatch.setattr(rot, "drain_instances", record("drain"))
+    monkeypatch.setattr(rot, "deregister", record("deregister"))
+    monkeypatch.setattr(rot, "terminate", record("terminate"))
+    monkeypatch.setattr(rot, "pending_provisioning", lambda s, expected: set())
+    monkeypatch.setattr(rot, "busy_instances", lambda s, census, instances: set())
+
+    clock = FakeClock()
+    waiter = rot.Waiter(clock=clock, sleep=clock.sleep)
+    waves = [{"asg-a": ["i-1"]}, {"asg-a": ["i-2"]}]
+    rot.rotate_in_waves(session, waves, waiter, canary=canary)
+
+    assert events == expected
+    assert session.instances == {"i-1", "i-2"}
+
+
+def test_journal_records_and_replays(tmp_path):
+    path = tmp_path / "rotation.jsonl"
+    journal = rot.Journal(path)
+    journal.start(ami=AMI, cluster=CLUSTER, waves=[{"asg-a": ["i-1"]}])
+    journal.record("detached", wave=1, instances={"i-1"}, expected=1)
+    journal.record("draining", wave=1, instances={"i-1"})
+    # the process dying mid-write leaves a partial line behind
+    with open(path, "a") as f:
+        f.write('{"phase": "deregis')
+
+    plan, latest, finished = journal.state()
+
+    assert plan["cluster"] == CLUSTER
+    assert plan["waves"] == [{"asg-a": ["i-1"]}]
+    assert latest[1]["phase"] == "draining"
+    assert latest[1]["instances"] == ["i-1"]
+    assert finished is False
+
+    with pytest.raises(rot.JournalError):
+        rot.Journal(path).start(ami=AMI, cluster=CLUSTER, waves=[])
+
+    journal.record("finished")
+    rot.Journal(path).start(ami=AMI, cluster=CLUSTER, waves=[])
+    assert len(journal.entries()) == 1
+
+
+def test_resume_picks_up_from_last_phase(boto3_clients, monkeypatch, tmp_path):
+    path = tmp_path / "rotation.jsonl"
+    journal = rot.Journal(path)
+    journal.start(
+        ami=AMI,
+        cluster=CLUSTER,
+        region="ap-southeast-2",
+        census="instances",
+        canary=False,
+        waves=[{"asg-a": ["i-1"]}, {"asg-a": ["i-2"]}, {"asg-a": ["i-3"]}],
+    )
+    journal.record("draining", wave=1, instances=["i-1"])
+    journal.record("detached", wave=2, instances=["i-2"], expected=2)
+
+    events = []
+
+    def record(name):
+        def phase(session, instances, **kwargs):
+            events.append((name, set(instances)))
+            return set(instances)
+
+        return phase
+
+    def detach(session, max_workers, instances):
+        return record("detach")(session, set().union(*instances.values()))
+
+    def no_listing(session):
+        raise AssertionError("resume should not search the cluster again")
+
+    monkeypatch.setattr(rot.Session, "inventory", FakeInventory())
+    monkeypatch.setattr(rot, "outdated_by_asg", no_listing)
+    monkeypatch.setattr(rot, "detach_outdated_instances", detach)
+    monkeypatch.setattr(rot, "drain_instances", record("drain"))
+    monkeypatch.setattr(rot, "deregister", record("deregister"))
+    monkeypatch.setattr(rot, "terminate", record("terminate"))
+    monkeypatch.setattr(rot, "pending_provisioning", lambda s, expected: set())
+    monkeypatch.setattr(rot, "busy_instances", lambda s, census, instances: set())
+
+    clock = FakeClock()
+    waiter = rot.Waiter(clock=clock, sleep=clock.sleep)
+    rot.resume(path, clients=boto3_clients, waiter=waiter)
+
+    assert events == [
+        ("deregister", {"i-1"}),
+        ("terminate", {"i-1"}),
+        ("drain", {"i-2"}),
+        ("deregister", {"i-2"}),
+        ("terminate", {"i-2"}),
+        ("detach", {"i-3"}),
+        ("drain", {"i-3"}),
+        ("deregister", {"i-3"}),
+        ("terminate", {"i-3"}),
+    ]
+    plan, latest, finished = journal.state()
+    assert finished is True
+    assert {entry["phase"] for entry in latest.values()} == {"terminated"}
+
+
+def test_resume_from_detaching_waits_for_expected(boto3_clients, monkeypatch, tmp_path):
+    path = tmp_path / "rotation.jsonl"
+    journal = rot.Journal(path)
+    journal.start(
+        ami=AMI,
+        cluster=CLUSTER,
+        region="ap-southeast-2",
+        census="instances",
+        canary=False,
+        waves=[{"asg-a": ["i-1", "i-2"]}],
+    )
+    journal.record("detaching", wave=1, instances=["i-1", "i-2"], expected=5)
+
+    detached = []
+    waited_for = []
+
+    def detach(session, max_workers, instances):
+        detached.append(instances)
+        return set().union(*instances.values())
+
+    def pending(session, expected):
+        waited_for.append(expected)
+        return set()
+
+    def done(session, instances, **kwargs):
+        return set(instances)
+
+    monkeypatch.setattr(rot.Session, "inventory", FakeInventory())
+    # i-1 was detached before the rotation was interrupted
+    monkeypatch.setattr(rot, "attached_by_asg", lambda s, ids: {"asg-a": ["i-2"]})
+    monkeypatch.setattr(rot, "detach_outdated_instances", detach)
+    monkeypatch.setattr(rot, "pending_provisioning", pending)
+    monkeypatch.setattr(rot, "drain_instances", done)
+    monkeypatch.setattr(rot, "deregister", done)
+    monkeypatch.setattr(rot, "terminate", done)
+    monkeypatch.setattr(rot, "busy_instances", lambda s, census, instances: set())
+
+    clock = FakeClock()
+    waiter = rot.Waiter(clock=clock, sleep=clock.sleep)
+    rot.resume(path, clients=boto3_clients, waiter=waiter)
+
+    assert detached == [{"asg-a": ["i-2"]}]
+    assert waited_for == [5]
+    entry = next(e for e in journal.entries() if e["phase"] == "detached")
+    assert entry["expected"] == 5
+    assert entry["instances"] == ["i-1", "i-2"]
+
+
+def test_load_manifest(tmp_path):
+    path = tmp_path / "fleet.json"
+    path.write_text('[{"region": "us-east-1", "cluster": "a", "ami": "ami-1"}]')
+
+    assert rot.load_manifest(path) == [
+        {"region": "us-east-1", "cluster": "a", "ami": "ami-1"}
+    ]
+
+    path.write_text('[{"region": "us-east-1", "cluster": "a"}]')
+    with pytest.raises(ValueError):
+        rot.load_manifest(path)
+
+
+def test_fleet_shares_clients_per_region(monkeypatch, capsys):
+    targets = [
+        {"region": "ap-southeast-2", "cluster": "a", "ami": "ami-1"},
+        {"region": "ap-southeast-2", "cluster": "b", "ami": "ami-1"},
+        {"region": "us-east-1", "cluster": "c", "ami": "ami-2", "size": "50%"},
+    ]
+    clients = {"ap-southeast-2": {"ecs": "sydney"}, "us-east-1": {"ecs": "virginia"}}
+    calls = []
+
+    def fake_main(clients, progress, **kwargs):
+        calls.append((kwargs["cluster"], clients, kwargs.get("size")))
+        progress("draining", wave=1, instances=[])
+        if kwargs["cluster"] == "b":
+            raise rot.RotationTimeout("Wave 1/1 draining", {"i-1"}, 30)
+
+    monkeypatch.setattr(rot, "main", fake_main)
+
+    results = rot.fleet(targets, clients=clients, concurrency=2, size=1)
+
+    assert sorted(calls) == [
+        ("a", {"ecs": "sydney"}, 1),
+        ("b", {"ecs": "sydney"}, 1),
+        ("c", {"ecs": "virginia"}, "50%"),
+    ]
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], rot.RotationTimeout)
+
+    table = capsys.readouterr().out.splitlines()
+    assert table[0].split() == ["REGION", "CLUSTER", "AMI", "STATUS"]
+    assert table[1].split() == ["ap-southeast-2", "a", "ami-1", "done"]
+    assert table[2].startswith("ap-southeast-2  b        ami-1  failed: Wave 1/1")
+    assert table[3].split() == ["us-east-1", "c", "ami-2", "done"]
+
+
+def test_history_estimates_from_previous_rotations(tmp_path):
+    history = rot.History(tmp_path / "history.jsonl")
+
+    assert history.estimate(CLUSTER, "draining") == (
+        rot.DEFAULT_DURATIONS["draining"],
+        0,
+    )
+
+    history.record("other-cluster", "draining", 100, 2)
+    assert history.estimate(CLUSTER, "draining") == (100, 1)
+
+    for seconds in (200, 400, 300):
+        history.record(CLUSTER, "draining", seconds, 2)
+    history.record(CLUSTER, "provisioning", 50, 2)
+    assert history.estimate(CLUSTER, "draining") == (300, 3)
+
+
+def test_plan_rotation(boto3_clients, tmp_path):
+    session = rot.Session(clients=boto3_clients)
+    session.ami = AMI
+    session.cluster = CLUSTER
+    history = rot.History(tmp_path / "history.jsonl")
+    history.record(CLUSTER, "provisioning", 100, 1)
+    history.record(CLUSTER, "draining", 200, 1)
+
+    session._inventory = FakeInventory()
+    session._inventory.outdated = [
+        {"ec2InstanceId": f"i-{i}", "runningTasksCount": 2, "pendingTasksCount": 1}
+        for i in range(6)
+    ]
+    waves = rot.plan_waves({"asg-a": [f"i-{i}" for i in range(6)]}, size=2, canary=1)
+
+    plan = rot.plan_rotation(session, waves, canary=True, history=history)
+
+    assert [sum(map(len, wave.values())) for wave in plan["waves"]] == [1, 2, 2, 1]
+    assert plan["asgs"] == {"asg-a": [f"i-{i}" for i in range(6)]}
+    assert plan["instances"] == 6
+    # the full waves overlap with each other, the canary doesn't
+    assert plan["surge_instances"] == 4
+    assert plan["tasks_to_reschedule"] == 18
+    # canary 100 + 200, then 100 + 200 + 200 + 200 for the overlapping waves
+    assert plan["estimate"]["total_seconds"] == 1000
+    assert "Rotating 6 instances in 4 waves" in rot.format_plan(plan)
+
+
+def test_dry_run_only_reads(boto3_clients, tmp_path):
+    stubs = {k: Stubber(v) for k, v in boto3_clients.items()}
+    stubs["ecs"].add_response(
+        method="list_container_instances", service_response=list_cont_result
+    )
+    stubs["ecs"].add_response(
+        method="describe_container_instances", service_response=desc_cont_result
+    )
+    stubs["autoscaling"].add_response(
+        method="describe_auto_scaling_instances", service_response=desc_asg_inst_result
+    )
+
+    for stub in stubs.values():
+        stub.activate()
+
+    plan = rot.dry_run(
+        ami=AMI,
+        cluster=CLUSTER,
+        clients=boto3_clients,
+        history=tmp_path / "history.jsonl",
+    )
+
+    for stub in stubs.values():
+        stub.assert_no_pending_responses()
+        stub.deactivate()
+
+    assert plan["asgs"] == {list(ASGS)[0]: sorted(CONTAINER_INSTANCE_IDS)}
+    assert len(plan["waves"]) == 1
+    assert plan["surge_instances"] == len(CONTAINER_INSTANCE_IDS)
+
+
+class FakeClock:
+    """Stands in for time.monotonic and time.sleep"""
+
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_waiter_returns_once_nothing_is_pending(boto3_clients):
+    session = rot.Session(clients=boto3_clients)
+    clock = FakeClock()
+    waiter = rot.Waiter(initial=5, jitter=0, clock=clock, sleep=clock.sleep)
+    polls = iter([{"i-1", "i-2"}, {"i-1", "i-2"}, {"i-1", "i-2"}, {"i-1"}, set()])
+
+    elapsed = waiter.wait(session, "Draining", lambda s: next(polls), deadline=600)
+
+    # backs off while nothing changes, then drops back once an instance finishes
+    assert clock.sleeps == [5, 10, 20, 5]
+    assert elapsed == 40
+
+
+def test_waiter_caps_backoff(boto3_clients):
+    session = rot.Session(clients=boto3_clients)
+    clock = FakeClock()
+    waiter = rot.Waiter(
+        initial=20, maximum=30, jitter=0, clock=clock, sleep=clock.sleep
+    )
+    polls = iter([{"i-1"}] * 4 + [set()])
+
+    waiter.wait(session, "Draining", lambda s: next(polls), deadline=600)
+
+    assert clock.sleeps == [20, 30, 30, 30]
+
+
+def test_waiter_jitters_sleep(boto3_clients):
+    session = rot.Session(clients=boto3_clients)
+    clock = FakeClock()
+    waiter = rot.Waiter(initial=10, jitter=0.5, clock=clock, sleep=clock.sleep)
+    polls = iter([{"i-1"}] * 20 + [set()])
+
+    waiter.wait(session, "Draining", lambda s: next(polls), deadline=10000)
+
+    assert all(5 <= pause <= 90 for pause in clock.sleeps)
+
+
+def test_waiter_raises_with_lagging_instances(boto3_clients):
+    session = rot.Session(clients=boto3_clients)
+    clock = FakeClock()
+    waiter = rot.Waiter(initial=5, jitter=0, clock=clock, sleep=clock.sleep)
+
+    with pytest.raises(rot.RotationTimeout) as error:
+        waiter.wait(session, "Provisioning", lambda s: {"i-1", "i-2"}, deadline=30)
+
+    assert error.value.phase == "Provisioning"
+    assert error.value.lagging == {"i-1", "i-2"}
+    # the last sleep is cut short so the final poll lands on the deadline
+    assert clock.sleeps == [5, 10, 15]
+    assert error.value.elapsed == 30
+    assert "i-1, i-2" in str(error.value)
+
+
+def test_pending_provisioning_reports_lagging(boto3_clients):
+    session = rot.Session(clients=boto3_clients)
+    session.ami = AMI
+    session.asgs = ASGS
+    session.cluster = CLUSTER
+
+    bad_result = copy.deepcopy(des_asg_grp_result)
+    bad_result["AutoScalingGroups"][0]["Instances"][0]["LifecycleState"] = "Pending"
+
+    with Stubber(boto3_clients["autoscaling"]) as stubber:
+        stubber.add_response(
+            method="describe_auto_scaling_groups",
+            service_response=bad_result,
+            expected_params={"AutoScalingGroupNames": list(ASGS)},
+        )
+
+        assert rot.pending_provisioning(session) == {EC2_INSTANCE_IDS[0]}
+
+        stubber.assert_no_pending_responses()
+
+
 @pytest.mark.slow
 def test_main(boto3_clients):
     stubs = {k: Stubber(v) for k, v in boto3_clients.items()}
@@ -302,52 +990,97 @@ def test_main(boto3_clients):
         "arn:aws:ecs:ap-southeast-2:111111111111:container-instance/some-cluster/a99b9853b6114c87af46c7501a3a6ba8"
     ]
 
-    success_result = copy.deepcopy(list_task_result)
-    success_result["taskArns"] = []
+    busy_result = copy.deepcopy(desc_cont_result)
+    for item in busy_result["containerInstances"]:
+        item["runningTasksCount"] = 1
+    success_result = copy.deepcopy(desc_cont_result)
+    success_result["containerInstances"] = success_result["containerInstances"][:1]
+    success_result["containerInstances"][0]["runningTasksCount"] = 0
+    success_result["containerInstances"][0]["pendingTasksCount"] = 0
 
     dereg_resp_a = copy.deepcopy(dereg_con_inst_result)
     dereg_resp_a["containerInstance"][
         "containerInstanceArn"
     ] = "arn:aws:ecs:ap-southeast-2:111111111111:container-instance/some-cluster/a99b9853b6114c87af46c7501a3a6ba8"
 
-    dereg_resp_b = copy.deepcopy(dereg_con_inst_result)
-    dereg_resp_b["containerInstance"][
-        "containerInstanceArn"
-    ] = "arn:aws:ecs:ap-southeast-2:111111111111:container-instance/some-cluster/e338a4bea54e4e06b664530a30ae02dd"
-
     bad_result_a = copy.deepcopy(des_asg_grp_result)
     bad_result_a["AutoScalingGroups"][0]["Instances"][0]["LifecycleState"] = "Pending"
     del bad_result_a["AutoScalingGroups"][0]["Instances"][1]
 
-    # find_outdated_asg
+    outdated_ids = sorted(
+        blob["InstanceId"] for blob in desc_asg_inst_result["AutoScalingInstances"]
+    )
+    outdated = {
+        "cluster": CLUSTER,
+        "filter": f"attribute:ecs.ami-id != {AMI}",
+    }
+    current = {
+        "cluster": CLUSTER,
+        "filter": f"attribute:ecs.ami-id == {AMI}",
+    }
+
+    # outdated_by_asg
     stubs["ecs"].add_response(
-        method="list_container_instances", service_response=list_cont_result
+        method="list_container_instances",
+        service_response=list_cont_result,
+        expected_params=outdated,
     )
-    # find_outdated_asg
     stubs["ecs"].add_response(
         method="describe_container_instances", service_response=desc_cont_result
     )
+    stubs["autoscaling"].add_response(
+        method="describe_auto_scaling_instances", service_response=desc_asg_inst_result
+    )
 
-    # can_update_service
+    # rotate_in_waves baseline of instances already on the new AMI
     stubs["ecs"].add_response(
         method="list_container_instances",
-        service_response=list_cont_result,
+        service_response={"containerInstanceArns": []},
+        expected_params=current,
+    )
+
+    # detach_outdated_instances
+    stubs["autoscaling"].add_response(
+        method="detach_instances",
+        service_response=det_inst_result,
         expected_params={
-            "cluster": CLUSTER,
-            "filter": f"attribute:ecs.ami-id == {AMI}",
+            "InstanceIds": outdated_ids,
+            "AutoScalingGroupName": list(ASGS)[0],
+            "ShouldDecrementDesiredCapacity": False,
         },
     )
 
-    # drain_instances
+    # pending_provisioning, first poll lagging then ready
     stubs["ecs"].add_response(
         method="list_container_instances",
         service_response=list_cont_result,
-        expected_params={
-            "cluster": CLUSTER,
-            "filter": f"attribute:ecs.ami-id != {AMI}",
-        },
+        expected_params=current,
+    )
+    stubs["autoscaling"].add_response(
+        method="describe_auto_scaling_groups",
+        service_response=bad_result_a,
+        expected_params={"AutoScalingGroupNames": list(ASGS)},
     )
+    stubs["ecs"].add_response(
+        method="list_container_instances",
+        service_response=list_cont_result,
+        expected_params=current,
+    )
+    stubs["autoscaling"].add_response(
+        method="describe_auto_scaling_groups",
+        service_response=des_asg_grp_result,
+        expected_params={"AutoScalingGroupNames": list(ASGS)},
+    )
+
     # drain_instances
+    stubs["ecs"].add_response(
+        method="list_container_instances",
+        service_response=list_cont_result,
+        expected_params=outdated,
+    )
+    stubs["ecs"].add_response(
+        method="describe_container_instances", service_response=desc_cont_result
+    )
     stubs["ecs"].add_response(
         method="update_container_instances_state",
         service_response=update_cont_result,
@@ -358,81 +1091,40 @@ def test_main(boto3_clients):
         },
     )
 
+    # busy_instances, first poll busy then empty
     stubs["ecs"].add_response(
         method="list_container_instances",
         service_response=containers,
-        expected_params={
-            "cluster": CLUSTER,
-            "filter": f"attribute:ecs.ami-id != {AMI}",
-        },
+        expected_params=outdated,
     )
-    stubs["ecs"].add_response(method="list_tasks", service_response=list_task_result)
-
     stubs["ecs"].add_response(
-        method="list_container_instances",
-        service_response=containers,
-        expected_params={
-            "cluster": CLUSTER,
-            "filter": f"attribute:ecs.ami-id != {AMI}",
-        },
+        method="describe_container_instances", service_response=busy_result
     )
-    stubs["ecs"].add_response(method="list_tasks", service_response=success_result)
     stubs["ecs"].add_response(
         method="list_container_instances",
-        service_response=list_cont_result,
-        expected_params={
-            "cluster": CLUSTER,
-            "filter": f"attribute:ecs.ami-id != {AMI}",
-        },
-    )
-    stubs["ecs"].add_response(
-        method="deregister_container_instance", service_response=dereg_resp_a
+        service_response=containers,
+        expected_params=outdated,
     )
     stubs["ecs"].add_response(
-        method="deregister_container_instance", service_response=dereg_resp_b
+        method="describe_container_instances", service_response=success_result
     )
 
-    # find_outdated_asg
-    stubs["autoscaling"].add_response(
-        method="describe_auto_scaling_instances", service_response=desc_asg_inst_result
-    )
-    # detach_outdated_instances
-    stubs["autoscaling"].add_response(
-        method="describe_auto_scaling_groups",
-        service_response=des_asg_grp_result,
-        expected_params={"AutoScalingGroupNames": list(ASGS), "MaxRecords": 100},
-    )
-    # detach_outdated_instances
-    stubs["autoscaling"].add_response(
-        method="detach_instances",
-        service_response=det_inst_result,
-        expected_params={
-            "InstanceIds": EC2_INSTANCE_IDS,
-            "AutoScalingGroupName": list(ASGS)[0],
-            "ShouldDecrementDesiredCapacity": False,
-        },
-    )
-    # can_update_service
-    stubs["autoscaling"].add_response(
-        method="describe_auto_scaling_groups",
-        service_response=bad_result_a,
-        expected_params={"AutoScalingGroupNames": list(ASGS)},
-    )
-    # can_update_service
-    stubs["autoscaling"].add_response(
-        method="describe_auto_scaling_groups",
-        service_response=des_asg_grp_result,
-        expected_params={"AutoScalingGroupNames": list(ASGS)},
+    # deregister reuses the listing from the final busy_instances poll
+    stubs["ecs"].add_response(
+        method="deregister_container_instance", service_response=dereg_resp_a
     )
-
     stubs["ec2"].add_response(
-        method="terminate_instances", service_response=terminate_result
+        method="terminate_instances",
+        service_response=terminate_result,
+        expected_params={"InstanceIds": outdated_ids},
     )
 
     for stub in stubs.values():
         stub.activate()
 
-    rot.main(ami=AMI, cluster=CLUSTER, clients=boto3_clients, snooze=1)
+    clock = FakeClock()
+    waiter = rot.Waiter(clock=clock, sleep=clock.sleep)
+    rot.main(ami=AMI, cluster=CLUSTER, clients=boto3_clients, waiter=waiter)
 
     for stub in stubs.values():
         stub.assert_no_pending_responses()
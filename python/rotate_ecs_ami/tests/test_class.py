@@ -1,4 +1,4 @@
-from scripts import rotate_ecs_ami as rot
+import rotate_ecs_ami as rot
 
 
 def test_session_init():
@@ -6,3 +6,42 @@ def test_session_init():
 
     assert session.region == "ap-southeast-2"
     assert len(session.clients) == 3
+
+
+def test_session_shares_cached_clients():
+    assert rot.Session().clients == rot.Session().clients
+    assert rot.Session().clients["ecs"] is rot.CLIENTS.client(
+        "ecs", "ap-southeast-2", max_pool_connections=rot.MAX_WORKERS
+    )
+
+
+def test_session_sizes_connection_pool():
+    session = rot.Session(max_pool_connections=32)
+
+    assert session.clients["ecs"].meta.config.max_pool_connections == 32
+    assert session.clients["autoscaling"].meta.config.max_pool_connections == 32
+
+
+def test_client_factory_caches_per_service_region_and_config():
+    factory = rot.ClientFactory()
+
+    ecs = factory.client("ecs", "ap-southeast-2")
+
+    assert factory.client("ecs", "ap-southeast-2") is ecs
+    assert factory.client("ecs", "us-east-1") is not ecs
+    assert factory.client("ecs", "ap-southeast-2", max_pool_connections=50) is not ecs
+    assert factory.client("ecs", "us-east-1").meta.region_name == "us-east-1"
+    assert set(factory.timings) == {
+        "boto3 session",
+        "ecs client (ap-southeast-2)",
+        "ecs client (us-east-1)",
+    }
+
+
+def test_client_factory_sizes_connection_pool():
+    factory = rot.ClientFactory()
+
+    clients = factory.clients("ap-southeast-2", max_pool_connections=32)
+
+    assert set(clients) == {"ecs", "ec2", "autoscaling"}
+    assert clients["ecs"].meta.config.max_pool_connections == 32
@@ -0,0 +1,109 @@
+"""
+Measures the AI opponent. Solves the game from scratch into a fresh transposition
+table, then asks best_move for every position a game can reach, first with its
+answers cache empty and then with it full, and reports moves per second and the
+memory each table holds.
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+import udp_tictactoe as ttt
+
+
+def reachable_positions():
+    """Every (xs, os) a game can reach that isn't over yet"""
+    found = set()
+    pending = [(0, 0)]
+    while pending:
+        xs, os = pending.pop()
+        if (xs, os) in found or ttt.evaluate(xs, os) != ttt.EMPTY:
+            continue
+        found.add((xs, os))
+        x_to_move = bin(xs).count("1") == bin(os).count("1")
+        for cell in range(9):
+            bit = 1 << cell
+            if not (xs | os) & bit:
+                pending.append((xs | bit, os) if x_to_move else (xs, os | bit))
+    return sorted(found)
+
+
+def traced(function, *args):
+    """Runs function, returning its result, the seconds it took and the bytes it kept"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    kept = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, elapsed, kept
+
+
+def moves_per_second(boards, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for board in boards:
+            ttt.best_move(board)
+    return rounds * len(boards) / (time.perf_counter() - start)
+
+
+def benchmark(rounds=100):
+    # timed without tracing, which would slow it down
+    start = time.perf_counter()
+    ttt.negamax(0, 0, {})
+    solve_seconds = time.perf_counter() - start
+    table = {}
+    _, _, table_bytes = traced(ttt.negamax, 0, 0, table)
+
+    boards = [ttt.Board(xs, os) for xs, os in reachable_positions()]
+    ttt.MOVES.clear()
+    cold = moves_per_second(boards, 1)
+    ttt.MOVES.clear()
+    _, _, moves_bytes = traced(moves_per_second, boards, 1)
+    warm = moves_per_second(boards, rounds)
+    return {
+        "positions": len(boards),
+        "table_entries": len(table),
+        "solve_seconds": solve_seconds,
+        "table_bytes": table_bytes,
+        "moves_entries": len(ttt.MOVES),
+        "moves_bytes": moves_bytes,
+        "outcomes_bytes": sys.getsizeof(ttt.OUTCOMES),
+        "cold_moves_per_second": cold,
+        "warm_moves_per_second": warm,
+    }
+
+
+def format_report(report):
+    return "\n".join(
+        [
+            "reachable positions   {positions}".format(**report),
+            "solve                 {:.1f}ms".format(report["solve_seconds"] * 1000),
+            "transposition table   {table_entries} entries, {table_bytes} bytes".format(
+                **report
+            ),
+            "move cache            {moves_entries} entries, {moves_bytes} bytes".format(
+                **report
+            ),
+            "outcome table         {outcomes_bytes} bytes".format(**report),
+            "moves/s, cold cache   {cold_moves_per_second:.0f} ({:.2f}us each)".format(
+                1e6 / report["cold_moves_per_second"], **report
+            ),
+            "moves/s, warm cache   {warm_moves_per_second:.0f} ({:.2f}us each)".format(
+                1e6 / report["warm_moves_per_second"], **report
+            ),
+        ]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the tic-tac-toe AI")
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=100,
+        help="times to ask for every position's move with the cache full",
+    )
+    args = parser.parse_args()
+    print(format_report(benchmark(args.rounds)))
@@ -0,0 +1,498 @@
+import udp_tictactoe as ttt
+import asyncio
+import itertools
+import json
+import socket
+import threading
+import pytest
+
+ADDRESS = ("127.0.0.1", 5000)
+
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address=None):
+        self.sent.append((data, address))
+
+
+@pytest.fixture
+def server():
+    server = ttt.GameServer(clock=lambda: 0)
+    server.connection_made(FakeTransport())
+    return server
+
+
+class Clock:
+    """Stands in for time.monotonic, moved on by hand"""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def reference_outcome(cells):
+    """The outcome of 9 EMPTY, X or O cells, worked out line by line"""
+    for player in (ttt.X, ttt.O):
+        if any(all(cells[cell] == player for cell in line) for line in ttt.LINES):
+            return player
+    return ttt.EMPTY if ttt.EMPTY in cells else ttt.TIE
+
+
+class TestEngine:
+    def test_every_position_matches_the_reference(self):
+        for cells in itertools.product((ttt.EMPTY, ttt.X, ttt.O), repeat=9):
+            board = ttt.Board.from_cells(cells)
+            expected = reference_outcome(cells)
+
+            assert board.cells() == list(cells)
+            assert ttt.position(board.xs, board.os) == sum(
+                cell * 3**index for index, cell in enumerate(cells)
+            )
+            assert ttt.evaluate(board.xs, board.os) == expected, cells
+            assert board.outcome() == expected, cells
+
+    def test_check_win_prints_the_outcome(self, capsys, monkeypatch):
+        monkeypatch.setattr(ttt, "board", ["X", "X", "X", "O", "O", "", "", "", ""])
+        assert ttt.check_win()
+        monkeypatch.setattr(ttt, "board", ["X", "O", "X", "X", "O", "O", "O", "X", "X"])
+        assert ttt.check_win()
+        monkeypatch.setattr(ttt, "board", ["X", "", "", "", "O", "", "", "", ""])
+        assert not ttt.check_win()
+
+        assert capsys.readouterr().out.split() == "Player 1 wins! It's a tie.".split()
+
+
+class TestProtocol:
+    def test_boards_round_trip(self):
+        for cells in itertools.product((ttt.EMPTY, ttt.X, ttt.O), repeat=9):
+            for status in ttt.STATUSES:
+                data = ttt.encode_board(7, cells, status, seq=9)
+
+                assert ttt.decode(data) == (ttt.BOARD, 9, 7, (list(cells), status))
+
+    def test_moves_round_trip(self):
+        for player in (ttt.X, ttt.O):
+            for cell in range(9):
+                data = ttt.encode_move(2**32 - 1, cell, player, seq=0xFFFF)
+
+                assert ttt.decode(data) == (
+                    ttt.MOVE,
+                    0xFFFF,
+                    2**32 - 1,
+                    (cell, player),
+                )
+
+    def test_other_versions_are_refused(self):
+        for data in (ttt.encode_move(1, 4, ttt.X), ttt.encode_ack(1, 1)):
+            data = bytearray(data)
+            data[0] = ttt.PROTOCOL_VERSION + 1
+
+            with pytest.raises(ValueError, match="version"):
+                ttt.decode(data)
+
+    @pytest.mark.parametrize("protocol", ["binary", "json", "legacy"])
+    def test_protocol_is_told_from_the_message(self, protocol):
+        board = ["X", "", "O", "", "", "", "", "", ""]
+
+        data = ttt.encode_game_board(board, protocol, seq=3)
+
+        assert ttt.is_json(data) == (protocol != "binary")
+        kind, seq, decoded, detected = ttt.decode_game_message(data)
+        assert (kind, decoded, detected) == (ttt.BOARD, board, protocol)
+        assert seq == (None if protocol == "legacy" else 3)
+
+    @pytest.mark.parametrize("protocol", ["binary", "json"])
+    def test_acks_are_told_from_boards(self, protocol):
+        data = ttt.encode_game_ack(5, protocol)
+
+        assert ttt.decode_game_message(data) == (ttt.ACK, 5, None, protocol)
+
+
+class TestGameServer:
+    @pytest.mark.parametrize(
+        "data",
+        [
+            ttt.encode_ack(1, 1),
+            ttt.encode_board(1, [ttt.EMPTY] * 9, seq=1),
+            ttt.encode_move(1, 4, ttt.X)[:-1],
+            b"\x01",
+            b"",
+            b"\xff" * 12,
+            b"{not json",
+            b"[1]",
+            b'{"game": [], "move": 1}',
+        ],
+    )
+    def test_stray_datagrams_are_ignored(self, server, data):
+        server.datagram_received(data, ADDRESS)
+
+        assert server.transport.sent == []
+        assert server.games == {}
+
+    def test_move_is_answered_with_the_board(self, server):
+        server.datagram_received(ttt.encode_move(7, 4, ttt.X, seq=1), ADDRESS)
+
+        ((reply, address),) = server.transport.sent
+        kind, seq, game, (cells, status) = ttt.decode(reply)
+        assert (address, kind, seq, game, status) == (ADDRESS, ttt.BOARD, 1, 7, None)
+        assert cells == [ttt.O, 0, 0, 0, ttt.X, 0, 0, 0, 0]
+
+    def test_retransmitted_move_gets_the_same_reply(self, server):
+        move = ttt.encode_move(7, 4, ttt.X, seq=1)
+
+        server.datagram_received(move, ADDRESS)
+        server.datagram_received(move, ADDRESS)
+
+        first, second = server.transport.sent
+        assert first == second
+        # played once, or the server would have refused the cell the second time
+        assert ttt.decode(second[0])[3][1] is None
+
+
+class TestJsonFallback:
+    def send(self, server, **message):
+        server.datagram_received(json.dumps(message).encode("utf-8"), ADDRESS)
+        return json.loads(server.transport.sent[-1][0])
+
+    def test_numbered_move_is_answered_once(self, server):
+        first = self.send(server, game=7, move=5, seq=1)
+        second = self.send(server, game=7, move=5, seq=1)
+
+        assert first == second
+        assert first == {
+            "game": 7,
+            "seq": 1,
+            "board": ["O", "", "", "", "X", "", "", "", ""],
+            "result": None,
+        }
+
+    def test_unnumbered_move_is_played_every_time(self, server):
+        self.send(server, game=7, move=5)
+        reply = self.send(server, game=7, move=5)
+
+        assert "seq" not in reply
+        assert reply["error"] == "bad move"
+
+
+class TestEviction:
+    @pytest.fixture
+    def clock(self):
+        return Clock()
+
+    @pytest.fixture
+    def server(self, clock):
+        server = ttt.GameServer(idle_timeout=60, clock=clock)
+        server.connection_made(FakeTransport())
+        return server
+
+    def test_idle_games_are_dropped(self, server, clock):
+        server.datagram_received(ttt.encode_move(1, 4, ttt.X, seq=1), ADDRESS)
+        clock.now = 30
+        server.datagram_received(ttt.encode_move(2, 4, ttt.X, seq=1), ADDRESS)
+
+        clock.now = 60
+        assert server.evict() == 0
+        clock.now = 61
+        assert server.evict() == 1
+        assert list(server.games) == [(ADDRESS, 2)]
+        clock.now = 91
+        assert server.evict() == 1
+        assert server.games == {}
+
+    def test_finished_games_linger_to_answer_retransmits(self, server, clock):
+        # X takes the diagonal while the server fills from the top left
+        moves = [
+            ttt.encode_move(1, cell, ttt.X, seq)
+            for seq, cell in ((1, 4), (2, 2), (3, 6))
+        ]
+        for move in moves:
+            server.datagram_received(move, ADDRESS)
+        assert ttt.decode(server.transport.sent[-1][0])[3][1] == "X"
+
+        clock.now = ttt.FINISHED_LINGER
+        assert server.evict() == 0
+        server.datagram_received(moves[-1], ADDRESS)
+        assert server.transport.sent[-1] == server.transport.sent[-2]
+
+        clock.now = 2 * ttt.FINISHED_LINGER + 1
+        assert server.evict() == 1
+        assert server.games == {}
+
+
+class TestLoadClient:
+    @pytest.mark.parametrize(
+        "data",
+        [
+            ttt.encode_ack(1, 1),
+            ttt.encode_move(1, 4, ttt.X, seq=1),
+            b"\x01",
+            b"{not json",
+            b'{"game": []}',
+        ],
+    )
+    def test_stray_datagrams_are_ignored(self, data):
+        client = ttt.LoadClient()
+
+        client.datagram_received(data, ADDRESS)
+
+        assert client.waiting == {}
+
+
+def play_out(xs, os, ai, outcomes):
+    """Plays best_move as ai against every reply, counting how each game ends"""
+    result = ttt.evaluate(xs, os)
+    if result != ttt.EMPTY:
+        outcomes[result] = outcomes.get(result, 0) + 1
+        return
+    x_to_move = bin(xs).count("1") == bin(os).count("1")
+    if x_to_move == (ai == ttt.X):
+        cells = [ttt.best_move(ttt.Board(xs, os))]
+    else:
+        cells = [cell for cell in range(9) if not (xs | os) >> cell & 1]
+    for cell in cells:
+        if x_to_move:
+            play_out(xs | 1 << cell, os, ai, outcomes)
+        else:
+            play_out(xs, os | 1 << cell, ai, outcomes)
+
+
+def moved(mask, symmetry):
+    return sum(1 << symmetry[cell] for cell in range(9) if mask >> cell & 1)
+
+
+class TestAI:
+    @pytest.mark.parametrize("ai", [ttt.X, ttt.O])
+    def test_never_loses(self, ai):
+        outcomes = {}
+
+        play_out(0, 0, ai, outcomes)
+
+        opponent = ttt.O if ai == ttt.X else ttt.X
+        assert opponent not in outcomes
+        assert sum(outcomes.values()) == {ttt.X: 73, ttt.O: 569}[ai]
+
+    def test_canonical_agrees_across_symmetries(self):
+        symmetries = ttt.symmetries()
+        assert len({tuple(symmetry) for symmetry in symmetries}) == 8
+
+        for cells in itertools.product((ttt.EMPTY, ttt.X, ttt.O), repeat=9):
+            board = ttt.Board.from_cells(cells)
+            canonical = ttt.canonical(board.xs, board.os)
+            for symmetry in symmetries:
+                xs, os = moved(board.xs, symmetry), moved(board.os, symmetry)
+                assert ttt.canonical(xs, os) == canonical
+
+    def test_best_move_refuses_finished_games(self):
+        with pytest.raises(ValueError):
+            ttt.best_move(ttt.Board.from_cells([ttt.X] * 3 + [ttt.O] * 2 + [0] * 4))
+
+
+async def load_test_in_process(games, concurrency, protocol):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        ttt.GameServer, local_addr=("127.0.0.1", 0)
+    )
+    try:
+        port = transport.get_extra_info("sockname")[1]
+        return await ttt.load_test(
+            "127.0.0.1", port, games, concurrency, timeout=2, protocol=protocol
+        )
+    finally:
+        transport.close()
+
+
+class TestLoadTest:
+    @pytest.mark.parametrize("protocol", ["binary", "json"])
+    def test_every_game_is_played_out(self, protocol):
+        report = asyncio.run(load_test_in_process(50, 10, protocol))
+
+        assert report["games"] == 50
+        assert sum(report["results"].values()) == 50
+        assert set(report["results"]) <= {"X", "O", "tie"}
+        assert report["moves"] >= 3 * 50
+
+
+class TestRttEstimator:
+    def test_samples_are_smoothed(self):
+        rtt = ttt.RttEstimator()
+        assert rtt.rto == ttt.INITIAL_RTO
+
+        rtt.sample(0.1)
+        assert (rtt.srtt, rtt.rttvar) == pytest.approx((0.1, 0.05))
+        assert rtt.rto == pytest.approx(0.1 + 4 * 0.05)
+
+        rtt.sample(0.2)
+        assert rtt.rttvar == pytest.approx(0.75 * 0.05 + 0.25 * 0.1)
+        assert rtt.srtt == pytest.approx(0.875 * 0.1 + 0.125 * 0.2)
+        assert rtt.rto == pytest.approx(rtt.srtt + 4 * rtt.rttvar)
+
+    def test_timeout_is_bounded(self):
+        rtt = ttt.RttEstimator()
+
+        rtt.sample(0.001)
+        assert rtt.rto == ttt.MIN_RTO
+        rtt.sample(60)
+        assert rtt.rto == ttt.MAX_RTO
+
+    def test_timeout_doubles_with_each_retransmit(self):
+        rtt = ttt.RttEstimator(initial=0.5)
+
+        timeouts = [rtt.timeout(attempt) for attempt in range(6)]
+
+        assert timeouts == [0.5, 1, 2, 4, ttt.MAX_RTO, ttt.MAX_RTO]
+
+
+@pytest.fixture
+def peer():
+    """A Channel on a loopback socket, and a raw socket connected to it"""
+    sock = socket.socket(type=socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    other = socket.socket(type=socket.SOCK_DGRAM)
+    other.connect(sock.getsockname())
+    other.settimeout(1)
+    yield ttt.Channel(sock), other
+    sock.close()
+    other.close()
+
+
+def acks(sock):
+    """The sequence numbers of the acknowledgements waiting at sock"""
+    seqs = []
+    sock.settimeout(0.2)
+    while True:
+        try:
+            kind, seq, _, _ = ttt.decode_game_message(sock.recv(ttt.BUFFER_SIZE))
+        except socket.timeout:
+            return seqs
+        assert kind == ttt.ACK
+        seqs.append(seq)
+
+
+class TestChannel:
+    def test_boards_are_acknowledged_mid_turn(self, peer):
+        channel, other = peer
+        board = ["X", "", "", "", "", "", "", "", ""]
+        other.send(ttt.encode_game_board(board, "binary", 1))
+        assert channel.receive() == board
+        assert acks(other) == [1]
+
+        # the acknowledgement was lost, and they resend while a move is typed
+        with channel.servicing():
+            other.send(ttt.encode_game_board(board, "binary", 1))
+            assert acks(other) == [1]
+
+        assert not channel.inbox
+
+    def test_duplicates_are_acknowledged_again_but_delivered_once(self, peer):
+        channel, other = peer
+        first = ["X", "", "", "", "", "", "", "", ""]
+        second = ["X", "O", "X", "", "", "", "", "", ""]
+        for seq, board in ((1, first), (1, first), (2, second), (2, second)):
+            other.send(ttt.encode_game_board(board, "binary", seq))
+
+        assert channel.receive() == first
+        assert channel.receive() == second
+        channel.linger(0.2)
+
+        assert acks(other) == [1, 1, 2, 2]
+        assert not channel.inbox
+
+    @pytest.mark.parametrize("lost, sampled", [(0, True), (1, False)])
+    def test_only_first_sends_are_timed(self, peer, lost, sampled):
+        channel, other = peer
+        channel.rtt = ttt.RttEstimator(initial=ttt.MIN_RTO)
+        channel.address = other.getsockname()
+
+        def answer():
+            for _ in range(lost + 1):
+                data = other.recv(ttt.BUFFER_SIZE)
+            other.send(ttt.encode_game_ack(ttt.decode_game_message(data)[1]))
+
+        thread = threading.Thread(target=answer)
+        thread.start()
+        channel.send(["X", "", "", "", "", "", "", "", ""])
+        thread.join()
+
+        # Karn's rule: which send a retransmitted board's ACK answers is unknown
+        assert (channel.rtt.srtt is not None) == sampled
+
+
+def play(channel, player, results):
+    """Plays a whole game of best moves through channel, X going first"""
+    board = [""] * 9
+    seen = []
+    turn = player == "X"
+    while ttt.Board.from_symbols(board).outcome() == ttt.EMPTY:
+        if turn:
+            board[ttt.best_move(ttt.Board.from_symbols(board))] = player
+            channel.send(board[:])
+        else:
+            board = channel.receive()
+            seen.append(board)
+        turn = not turn
+    if not turn:
+        # the other player may still be waiting on the last acknowledgement
+        channel.linger()
+    results[player] = seen
+
+
+class TestLoopbackGame:
+    def test_game_survives_loss(self):
+        server = socket.socket(type=socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        client = socket.socket(type=socket.SOCK_DGRAM)
+        client.connect(server.getsockname())
+        channels = {
+            "X": ttt.Channel(client, "binary", impairment=ttt.Impairment(0.2, seed=1)),
+            "O": ttt.Channel(server, impairment=ttt.Impairment(0.2, seed=2)),
+        }
+        results = {}
+        try:
+            for channel in channels.values():
+                channel.rtt = ttt.RttEstimator(initial=ttt.MIN_RTO)
+            threads = [
+                threading.Thread(target=play, args=(channel, player, results))
+                for player, channel in channels.items()
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(30)
+        finally:
+            server.close()
+            client.close()
+
+        # X has 5 moves and O 4, each seen once and in order by the other
+        assert [board.count("X") for board in results["O"]] == [1, 2, 3, 4, 5]
+        assert [board.count("O") for board in results["X"]] == [1, 2, 3, 4]
+        assert ttt.Board.from_symbols(results["O"][-1]).outcome() == ttt.TIE
+
+
+class TestLegacyPlayers:
+    def test_bare_lists_are_answered_in_kind(self):
+        sock = socket.socket(type=socket.SOCK_DGRAM)
+        peer = socket.socket(type=socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        peer.connect(sock.getsockname())
+        peer.settimeout(1)
+        try:
+            channel = ttt.Channel(sock)
+            board = ["X", "", "", "", "", "", "", "", ""]
+            peer.send(json.dumps(board).encode("utf-8"))
+
+            assert channel.receive() == board
+            board[4] = "O"
+            channel.send(board)
+
+            assert json.loads(peer.recv(ttt.BUFFER_SIZE)) == board
+            # unacknowledged, as it always was, rather than resent
+            peer.settimeout(2 * ttt.INITIAL_RTO)
+            with pytest.raises(socket.timeout):
+                peer.recv(ttt.BUFFER_SIZE)
+        finally:
+            sock.close()
+            peer.close()
@@ -1,14 +1,72 @@
 import argparse
+import asyncio
+import collections
+import contextlib
+import itertools
+import random
 import socket
 import json
+import struct
+import threading
+import time
 
-MAX_BYTES = 655355
+# big enough for the largest message, a JSON board
+BUFFER_SIZE = 512
+# seconds a hosted game can go without a move before it's dropped
+IDLE_TIMEOUT = 60
+# seconds the load generator keeps retrying a move before giving up on the game
+MOVE_TIMEOUT = 5
+# retransmit timeouts in seconds: before the first round trip is measured, and the
+# bounds on what the measured round trips set it to
+INITIAL_RTO = 0.5
+MIN_RTO = 0.05
+MAX_RTO = 5
+# sends of a message in the two player game before the other player is given up on
+MAX_SENDS = 10
+# seconds to keep acknowledging the other player after the game, in case the last
+# acknowledgement was lost
+LINGER = 2
+# seconds between checks for the turn being over, while acknowledging in the
+# background during one
+SERVICE_INTERVAL = 0.1
+# seconds a finished hosted game is kept, to answer retransmits of the last move
+FINISHED_LINGER = 5
 
 board = ["", "", "", "", "", "", "", "", ""]
 
 
 NUMBERS = [1, 2, 3, 4, 5, 6, 7, 8, 9]
 
+# cells of each row, column and diagonal
+LINES = [
+    (0, 1, 2),
+    (3, 4, 5),
+    (6, 7, 8),
+    (0, 3, 6),
+    (1, 4, 7),
+    (2, 5, 8),
+    (0, 4, 8),
+    (2, 4, 6),
+]
+# what a hosted game's cells hold
+EMPTY, X, O = 0, 1, 2
+SYMBOLS = ["", "X", "O"]
+# outcomes, numbered as the binary protocol's statuses; EMPTY while the game goes on
+TIE = 3
+
+# Binary messages start with a version byte, which JSON never does, so both can be
+# told apart per datagram and JSON stays available as a fallback. Every message has
+# an 8 byte header of version, kind, sequence number and game id.
+PROTOCOL_VERSION = 1
+JSON_STARTS = (b"{", b"[")
+MOVE, BOARD, ACK = 1, 2, 3
+HEADER = struct.Struct("!BBHI")
+# a move is one byte, the player in the high nibble and the cell 0-8 in the low
+MOVE_MESSAGE = struct.Struct("!BBHIB")
+# a board is the cells packed 2 bits each into 18 bits, then a status byte
+BOARD_MESSAGE = struct.Struct("!BBHIIB")
+STATUSES = [None, "X", "O", "tie", "refused"]
+
 
 def board_print(fill):
     print(
@@ -24,32 +82,13 @@ def board_print(fill):
 
 
 def check_win():
-    players = ["X", "O"]
     global board
 
-    line1 = [x for x in board[0:3]]
-    line2 = [x for x in board[3:6]]
-    line3 = [x for x in board[6:9]]
-    col1 = [x for x in board[0:8:3]]
-    col2 = [x for x in board[1:9:3]]
-    col3 = [x for x in board[2:10:3]]
-    diag1 = [x for x in board[0:10:4]]
-    diag2 = [x for x in board[2:8:2]]
-
-    for sym in players:
-        if (
-            line1.count(sym) == 3
-            or line2.count(sym) == 3
-            or line3.count(sym) == 3
-            or col1.count(sym) == 3
-            or col2.count(sym) == 3
-            or col3.count(sym) == 3
-            or diag1.count(sym) == 3
-            or diag2.count(sym) == 3
-        ):
-            print("\nPlayer {} wins!\n".format(players.index(sym) + 1))
-            return True
-    if "" not in board:
+    result = Board.from_symbols(board).outcome()
+    if result in (X, O):
+        print("\nPlayer {} wins!\n".format(result))
+        return True
+    if result == TIE:
         print("It's a tie.")
         return True
 
@@ -76,11 +115,519 @@ def do_turn(player):
             continue
 
 
-def player1_client(hostname, port):
+def ai_turn(player):
+    """
+    Plays the best move for player without asking anyone, in place of do_turn
+    """
+    cell = best_move(Board.from_symbols(board))
+    board[cell] = player
+    print("\nPlayer '{}' took {}\n".format(player, cell + 1))
+
+
+# The evaluation engine. A position is a pair of 9 bit masks, one per player, with
+# bit i set for each cell i they hold, so a line is won when a mask covers it.
+FULL = 0x1FF
+LINE_MASKS = [sum(1 << cell for cell in line) for line in LINES]
+# whether each of the 512 masks holds a line
+WINNING = bytes(
+    any(mask & line == line for line in LINE_MASKS) for mask in range(FULL + 1)
+)
+# each mask's cells as base 3 digits of 1, so a position's number is
+# TERNARY[xs] + 2 * TERNARY[os], with each cell's EMPTY, X or O as its digit
+TERNARY = [
+    sum(3**cell for cell in range(9) if mask >> cell & 1) for mask in range(FULL + 1)
+]
+
+
+def evaluate(xs, os):
+    """
+    Works out the outcome of a position: X or O for a win, TIE for a full board, or
+    EMPTY while the game goes on
+    """
+    if WINNING[xs]:
+        return X
+    if WINNING[os]:
+        return O
+    if xs | os == FULL:
+        return TIE
+    return EMPTY
+
+
+def position(xs, os):
+    return TERNARY[xs] + 2 * TERNARY[os]
+
+
+def outcome_table():
+    """
+    Evaluates all 3^9 positions, including the unreachable ones, into a table
+    indexed by position()
+    """
+    table = bytearray(3**9)
+    for xs in range(FULL + 1):
+        # every os that doesn't overlap xs, by counting down through its submasks
+        free = FULL & ~xs
+        os = free
+        while True:
+            table[position(xs, os)] = evaluate(xs, os)
+            if not os:
+                break
+            os = (os - 1) & free
+    return bytes(table)
+
+
+OUTCOMES = outcome_table()
+
+
+class Board:
+    """
+    A board as two 9 bit masks, for evaluating without side effects as often as
+    needed. Cells are numbered 0-8.
+    """
+
+    __slots__ = ("xs", "os")
+
+    def __init__(self, xs=0, os=0):
+        self.xs = xs
+        self.os = os
+
+    @classmethod
+    def from_cells(cls, cells):
+        """From 9 EMPTY, X or O cells"""
+        xs = os = 0
+        for cell, player in enumerate(cells):
+            if player == X:
+                xs |= 1 << cell
+            elif player == O:
+                os |= 1 << cell
+        return cls(xs, os)
+
+    @classmethod
+    def from_symbols(cls, symbols):
+        """From the two player game's board of "X", "O" and "" """
+        return cls.from_cells([SYMBOLS.index(symbol) for symbol in symbols])
+
+    def cells(self):
+        return [
+            X if self.xs >> cell & 1 else O if self.os >> cell & 1 else EMPTY
+            for cell in range(9)
+        ]
+
+    def symbols(self):
+        return [SYMBOLS[cell] for cell in self.cells()]
+
+    def free(self):
+        """The mask of empty cells"""
+        return FULL & ~(self.xs | self.os)
+
+    def is_free(self, cell):
+        return bool(self.free() >> cell & 1)
+
+    def play(self, cell, player):
+        if player == X:
+            self.xs |= 1 << cell
+        else:
+            self.os |= 1 << cell
+
+    def outcome(self):
+        """X, O, TIE or EMPTY, looked up in OUTCOMES"""
+        return OUTCOMES[position(self.xs, self.os)]
+
+
+def symmetries():
+    """
+    The 8 ways to rotate and reflect the board, each as the cell every cell moves to
+    """
+    rotate = [3 * (cell % 3) + 2 - cell // 3 for cell in range(9)]
+    reflect = [3 * (cell // 3) + 2 - cell % 3 for cell in range(9)]
+    found = []
+    moved = list(range(9))
+    for _ in range(4):
+        found.append(moved)
+        found.append([reflect[cell] for cell in moved])
+        moved = [rotate[cell] for cell in moved]
+    return found
+
+
+# TERNARY for each symmetry, of each mask once it's moved
+SYMMETRIC_TERNARY = [
+    [
+        TERNARY[sum(1 << moved[cell] for cell in range(9) if mask >> cell & 1)]
+        for mask in range(FULL + 1)
+    ]
+    for moved in symmetries()
+]
+
+
+def canonical(xs, os):
+    """
+    The lowest position number among a position's rotations and reflections, which
+    all play the same
+    """
+    return min(ternary[xs] + 2 * ternary[os] for ternary in SYMMETRIC_TERNARY)
+
+
+def negamax(xs, os, table):
+    """
+    Scores a position for the player about to move, X when both have as many cells:
+    positive if they can force a win, higher the sooner, negative if the other player
+    can, and 0 for a tie. Memoized in table by canonical position.
+    """
+    key = canonical(xs, os)
+    score = table.get(key)
+    if score is not None:
+        return score
+
+    free = FULL & ~(xs | os)
+    result = OUTCOMES[position(xs, os)]
+    if result == TIE:
+        score = 0
+    elif result:
+        # the player who just moved won
+        score = -(bin(free).count("1") + 1)
+    else:
+        x_to_move = bin(xs).count("1") == bin(os).count("1")
+        score = -FULL
+        while free:
+            bit = free & -free
+            free ^= bit
+            if x_to_move:
+                score = max(score, -negamax(xs | bit, os, table))
+            else:
+                score = max(score, -negamax(xs, os | bit, table))
+    table[key] = score
+    return score
+
+
+# every position reachable from an empty board, solved once at import
+SCORES = {}
+negamax(0, 0, SCORES)
+# best_move's answers, by position
+MOVES = {}
+
+
+def best_move(board):
+    """
+    The cell the player to move should take, the lowest of any that score the same.
+    Raises ValueError if the game is already over.
+    """
+    key = position(board.xs, board.os)
+    cell = MOVES.get(key)
+    if cell is not None:
+        return cell
+    if OUTCOMES[key] != EMPTY:
+        raise ValueError("the game is over")
+
+    xs, os = board.xs, board.os
+    x_to_move = bin(xs).count("1") == bin(os).count("1")
+    best = -FULL
+    for move in range(9):
+        bit = 1 << move
+        if (xs | os) & bit:
+            continue
+        if x_to_move:
+            score = -negamax(xs | bit, os, SCORES)
+        else:
+            score = -negamax(xs, os | bit, SCORES)
+        if score > best:
+            best, cell = score, move
+    MOVES[key] = cell
+    return cell
+
+
+def pack_cells(cells):
+    """Packs 9 EMPTY, X or O cells 2 bits each into an int"""
+    packed = 0
+    for index, cell in enumerate(cells):
+        packed |= cell << (2 * index)
+    return packed
+
+
+def unpack_cells(packed):
+    return [(packed >> (2 * index)) & 3 for index in range(9)]
+
+
+def encode_move(game, cell, player, seq=0):
+    return MOVE_MESSAGE.pack(PROTOCOL_VERSION, MOVE, seq, game, player << 4 | cell)
+
+
+def encode_board(game, cells, status=None, seq=0):
+    return BOARD_MESSAGE.pack(
+        PROTOCOL_VERSION, BOARD, seq, game, pack_cells(cells), STATUSES.index(status)
+    )
+
+
+def decode(data):
+    """
+    Decodes a binary message from any buffer, without copying it
+
+    Returns (kind, seq, game, body), where body is (cell, player) for a MOVE and
+    (cells, status) for a BOARD. Raises ValueError if it isn't a message this
+    version understands.
+    """
+    try:
+        version, kind, seq, game = HEADER.unpack_from(data)
+        if version != PROTOCOL_VERSION:
+            raise ValueError("unsupported protocol version {}".format(version))
+        if kind == MOVE:
+            move = MOVE_MESSAGE.unpack_from(data)[4]
+            return kind, seq, game, (move & 0xF, move >> 4)
+        if kind == BOARD:
+            packed, status = BOARD_MESSAGE.unpack_from(data)[4:]
+            return kind, seq, game, (unpack_cells(packed), STATUSES[status])
+        if kind == ACK:
+            return kind, seq, game, None
+    except (struct.error, IndexError) as e:
+        raise ValueError("malformed message") from e
+    raise ValueError("unknown message kind {}".format(kind))
+
+
+def encode_ack(game, seq):
+    return HEADER.pack(PROTOCOL_VERSION, ACK, seq, game)
+
+
+def is_json(data):
+    return bytes(data[:1]) in JSON_STARTS
+
+
+def encode_game_board(board, protocol="binary", seq=0):
+    """
+    Encodes the two player game's board of symbols. A "legacy" board is the bare
+    JSON list sent before sequence numbers, for players that still send those.
+    """
+    if protocol == "legacy":
+        return json.dumps(board).encode("utf-8")
+    if protocol == "json":
+        return json.dumps({"seq": seq, "board": board}).encode("utf-8")
+    return encode_board(0, [SYMBOLS.index(cell) for cell in board], seq=seq)
+
+
+def encode_game_ack(seq, protocol="binary"):
+    if protocol == "json":
+        return json.dumps({"ack": seq}).encode("utf-8")
+    return encode_ack(0, seq)
+
+
+def decode_game_message(data):
+    """
+    Decodes a message in the two player game from either protocol
+
+    Returns its kind, BOARD or ACK, its sequence number, the board of symbols if it
+    is one, and the protocol it came in. A bare JSON list is a board from before
+    sequence numbers, so its sequence number is None and its protocol "legacy".
+    """
+    if is_json(data):
+        message = json.loads(bytes(data).decode("utf-8"))
+        if isinstance(message, list):
+            return BOARD, None, message, "legacy"
+        if "ack" in message:
+            return ACK, message["ack"], None, "json"
+        return BOARD, message["seq"], message["board"], "json"
+    kind, seq, game, body = decode(data)
+    if kind == BOARD:
+        return kind, seq, [SYMBOLS[cell] for cell in body[0]], "binary"
+    return kind, seq, None, "binary"
+
+
+class RttEstimator:
+    """
+    Smoothed round trip time and variance, giving the retransmit timeout as in
+    TCP. Round trips of retransmitted messages are ambiguous, so aren't sampled.
+    """
+
+    def __init__(self, initial=INITIAL_RTO):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def timeout(self, attempt):
+        """The timeout for a send, doubling with each retransmit"""
+        return min(MAX_RTO, self.rto * 2**attempt)
+
+
+class Impairment:
+    """
+    Makes a network worse on purpose, for trying the game out locally. Drops loss of
+    the datagrams sent through it, and delays the rest by latency plus up to jitter
+    seconds.
+    """
+
+    def __init__(self, loss=0, latency=0, jitter=0, seed=None):
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+
+    def drop(self):
+        return self.rng.random() < self.loss
+
+    def delay(self):
+        return self.latency + self.rng.uniform(0, self.jitter)
+
+
+class Channel:
+    """
+    Reliable delivery of boards between the two players over a UDP socket. Each
+    board carries a sequence number and is resent, on an adaptive timeout, until
+    the other player acknowledges it or their next board arrives. Boards that arrive
+    twice are acknowledged again but only delivered once.
+
+    The server doesn't know who it's playing, or in which protocol, until the first
+    board arrives, so address and protocol can be left for the first message to set.
+    A connected socket needs neither. A player sending bare JSON lists predates all
+    this, so is answered in kind, each board sent once and never acknowledged.
+    """
+
+    def __init__(self, sock, protocol=None, address=None, impairment=None):
+        self.sock = sock
+        self.protocol = protocol
+        self.address = address
+        self.impairment = impairment
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.rtt = RttEstimator()
+        self.seq = 0
+        self.delivered = 0
+        self.inbox = collections.deque()
+        try:
+            sock.getpeername()
+            self.connected = True
+        except OSError:
+            self.connected = False
+
+    def _send(self, data):
+        if self.impairment:
+            if self.impairment.drop():
+                return
+            time.sleep(self.impairment.delay())
+        if self.connected:
+            self.sock.send(data)
+        else:
+            self.sock.sendto(data, self.address)
+
+    def _receive(self, timeout):
+        self.sock.settimeout(timeout)
+        size, address = self.sock.recvfrom_into(self.buffer)
+        try:
+            message = decode_game_message(memoryview(self.buffer)[:size])
+        except (ValueError, KeyError, TypeError):
+            # not one of ours
+            return None, None, None
+        kind, seq, board, protocol = message
+        if not self.connected and self.address is None:
+            self.address = address
+        self.protocol = self.protocol or protocol
+        return kind, seq, board
+
+    def _accept(self, seq, board):
+        """Acknowledges a board, returning whether it's new"""
+        if seq is None:
+            self.inbox.append(board)
+            return True
+        self._send(encode_game_ack(seq, self.protocol))
+        if seq <= self.delivered:
+            return False
+        self.delivered = seq
+        self.inbox.append(board)
+        return True
+
+    def send(self, board):
+        """
+        Sends board, returning once the other player has it. Raises TimeoutError if
+        they don't answer after MAX_SENDS tries. They acknowledge even mid-turn, see
+        servicing, so that means they've gone.
+        """
+        self.seq += 1
+        data = encode_game_board(board, self.protocol, self.seq)
+        if self.protocol == "legacy":
+            self._send(data)
+            return
+        for attempt in range(MAX_SENDS):
+            sent = time.monotonic()
+            self._send(data)
+            deadline = sent + self.rtt.timeout(attempt)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    kind, seq, reply = self._receive(remaining)
+                except socket.timeout:
+                    break
+                if kind == ACK and seq == self.seq:
+                    if attempt == 0:
+                        self.rtt.sample(time.monotonic() - sent)
+                    return
+                # their next board means they had this one
+                if kind == BOARD and self._accept(seq, reply):
+                    return
+        raise TimeoutError("the other player stopped answering")
+
+    def receive(self):
+        """Waits as long as it takes for the other player's next board"""
+        while not self.inbox:
+            kind, seq, board = self._receive(None)
+            if kind == BOARD:
+                self._accept(seq, board)
+        return self.inbox.popleft()
+
+    @contextlib.contextmanager
+    def servicing(self):
+        """
+        Keeps acknowledging boards from a background thread for the life of the with
+        block, such as while a player types their move. Otherwise an acknowledgement
+        lost just before then leaves the other player resending until they give up.
+        Boards that arrive are delivered by the next receive.
+        """
+        done = threading.Event()
+
+        def service():
+            while not done.is_set():
+                try:
+                    kind, seq, board = self._receive(SERVICE_INTERVAL)
+                except socket.timeout:
+                    continue
+                if kind == BOARD:
+                    self._accept(seq, board)
+
+        thread = threading.Thread(target=service, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def linger(self, seconds=LINGER):
+        """
+        Keeps acknowledging boards for a while after the game, in case the other
+        player missed the last acknowledgement and is still resending
+        """
+        deadline = time.monotonic() + seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                kind, seq, board = self._receive(remaining)
+            except socket.timeout:
+                return
+            if kind == BOARD:
+                self._accept(seq, board)
+
+
+def player1_client(hostname, port, protocol="binary", impairment=None):
     global board
     sock = socket.socket(type=socket.SOCK_DGRAM)
     # get ip to connect to
     sock.connect((hostname, port))
+    channel = Channel(sock, protocol, impairment=impairment)
     print(
         "\n============================\n| Welcome to UDP TicTacToe |\n============================\n"
     )
@@ -88,29 +635,28 @@ def player1_client(hostname, port):
     board_print(NUMBERS)
 
     while True:
-        do_turn("X")
+        with channel.servicing():
+            do_turn("X")
         if check_win():
-            data = json.dumps(board)
-            sock.send(data.encode("utf-8"))
+            channel.send(board)
             board_print(board)
             break
         print("\nThank you. Please wait for the other player to finish their turn\n")
-        data = json.dumps(board)
-        sock.send(data.encode("utf-8"))
-        response = sock.recv(MAX_BYTES)
-        response = response.decode("utf-8")
-        response = json.loads(response)
-        board = response[:]
+        channel.send(board)
+        board = channel.receive()
         print("\nPlayer 2 made their move. The board is as follows:\n")
         board_print(board)
         if check_win():
+            channel.linger()
             break
 
 
-def player2_server(interface, port):
+def player2_server(interface, port, impairment=None, turn=do_turn):
     global board
     sock = socket.socket(type=socket.SOCK_DGRAM)
     sock.bind((interface, port))
+    # answers in whichever protocol the client speaks
+    channel = Channel(sock, impairment=impairment)
     print(
         "\n============================\n| Welcome to UDP TicTacToe |\n============================\n"
     )
@@ -118,28 +664,429 @@ def player2_server(interface, port):
     board_print(NUMBERS)
     print("\nWaiting for the other player. Please be patient.")
     while True:
-        data, address = sock.recvfrom(MAX_BYTES)
-        data = data.decode("utf-8")
-        data = json.loads(data)
-        board = data[:]
+        board = channel.receive()
         print("\nPlayer 1 made their move. The board is as follows:\n")
         board_print(board)
         if check_win():
+            channel.linger()
             break
-        do_turn("O")
+        with channel.servicing():
+            turn("O")
         if check_win():
-            response = json.dumps(board)
-            sock.sendto(response.encode("utf-8"), address)
+            channel.send(board)
             board_print(board)
             print("")
             break
         print("\nThank you. Please wait for the other player to finish their turn\n")
-        response = json.dumps(board)
-        sock.sendto(response.encode("utf-8"), address)
+        channel.send(board)
+
+
+def ai_server(interface, port, impairment=None):
+    """
+    Player 2 as a bot, which can't be beaten
+    """
+    player2_server(interface, port, impairment, turn=ai_turn)
+
+
+def outcome(cells):
+    """
+    Like check_win but pure, for a board of EMPTY, X and O cells. Returns "X" or "O"
+    for a win, "tie" for a full board, or None while the game goes on
+    """
+    return STATUSES[Board.from_cells(cells).outcome()]
+
+
+def server_move(board):
+    """
+    The hosted games' player 2 takes the first free cell
+    """
+    free = board.free()
+    return (free & -free).bit_length() - 1
+
+
+class Game:
+    """
+    A hosted game. The last move's sequence number and reply are kept to answer
+    retransmits of it.
+    """
+
+    __slots__ = ("board", "seen", "seq", "reply", "finished")
+
+    def __init__(self, now):
+        self.board = Board()
+        self.seen = now
+        self.seq = None
+        self.reply = None
+        self.finished = False
+
+
+class ImpairedTransport:
+    """
+    Sends through an asyncio datagram transport via an Impairment
+    """
+
+    def __init__(self, transport, impairment):
+        self.transport = transport
+        self.impairment = impairment
+        self.loop = asyncio.get_running_loop()
+
+    def sendto(self, data, address=None):
+        if self.impairment.drop():
+            return
+        delay = self.impairment.delay()
+        if delay:
+            self.loop.call_later(delay, self.transport.sendto, data, address)
+        else:
+            self.transport.sendto(data, address)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+class GameServer(asyncio.DatagramProtocol):
+    """
+    Hosts any number of games on one socket, playing player 2 in each. Games are
+    keyed by the client's address and the game id it sends, so one client can play
+    many at once. A game is dropped a while after it's over, or when it has been
+    idle for idle_timeout seconds.
+
+    Clients send a binary MOVE and get back a BOARD with the same sequence number,
+    which is also the acknowledgement. A client that doesn't hear back resends the
+    move, and a move that arrives twice gets the same reply without being replayed.
+    The JSON fallback is {"game": id, "move": 1-9, "seq": n}, answered with
+    {"game": id, "seq": n, "board": [...], "result": "X" | "O" | "tie" | null},
+    plus "error" if the move was refused. The seq is optional, as in the binary
+    protocol, where 0 means unnumbered.
+    """
+
+    def __init__(
+        self, idle_timeout=IDLE_TIMEOUT, clock=time.monotonic, impairment=None
+    ):
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.impairment = impairment
+        self.games = {}
+        self.transport = None
+
+    def connection_made(self, transport):
+        if self.impairment:
+            transport = ImpairedTransport(transport, self.impairment)
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if is_json(data):
+            return self.json_received(data, address)
+        try:
+            kind, seq, game_id, body = decode(data)
+        except ValueError:
+            # not one of ours, and nothing sensible to answer
+            return
+        if kind != MOVE:
+            return
+        cell, player = body
+
+        def encode(game, status):
+            return encode_board(game_id, game.board.cells(), status, seq)
+
+        reply = self.respond(address, game_id, seq, cell + 1, encode)
+        self.transport.sendto(reply, address)
+
+    def json_received(self, data, address):
+        try:
+            message = json.loads(data)
+            game_id = message["game"]
+            move = int(message["move"])
+            seq = int(message.get("seq", 0))
+            # games are keyed by it
+            hash(game_id)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+
+        def encode(game, status):
+            reply = {"game": game_id, "board": game.board.symbols(), "result": status}
+            if seq:
+                reply["seq"] = seq
+            if status == "refused":
+                reply.update(result=None, error="bad move")
+            return json.dumps(reply).encode("utf-8")
+
+        reply = self.respond(address, game_id, seq, move, encode)
+        self.transport.sendto(reply, address)
+
+    def respond(self, address, game_id, seq, move, encode):
+        """
+        Plays move 1-9 in the game and returns encode(game, status) as the reply,
+        unless it's a retransmit of the last move, which gets the same reply again
+        """
+        game = self.session(address, game_id)
+        # sequence number 0 is from a client that doesn't number its moves
+        if seq == 0 or seq != game.seq:
+            if game.finished:
+                # a new move in a finished game starts the next one
+                game = self.games[(address, game_id)] = Game(self.clock())
+            status = self.play(game, move)
+            game.finished = status in ("X", "O", "tie")
+            game.seq = seq
+            game.reply = encode(game, status)
+        return game.reply
+
+    def session(self, address, game_id):
+        key = (address, game_id)
+        game = self.games.get(key)
+        if game is None:
+            game = self.games[key] = Game(self.clock())
+        game.seen = self.clock()
+        return game
+
+    def play(self, game, move):
+        """
+        Plays player 1's move and the server's answer. Returns the outcome, or
+        "refused" if the move isn't allowed
+        """
+        board = game.board
+        if move not in NUMBERS or not board.is_free(move - 1):
+            return "refused"
+
+        board.play(move - 1, X)
+        result = board.outcome()
+        if result == EMPTY:
+            board.play(server_move(board), O)
+            result = board.outcome()
+        return STATUSES[result]
+
+    def evict(self):
+        """Drops games that are over or have been idle too long, returning how many"""
+        now = self.clock()
+        idle = []
+        for key, game in self.games.items():
+            timeout = FINISHED_LINGER if game.finished else self.idle_timeout
+            if now - game.seen > timeout:
+                idle.append(key)
+        for key in idle:
+            del self.games[key]
+        return len(idle)
+
+    async def evict_idle(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, FINISHED_LINGER) / 2)
+            self.evict()
+
+
+async def serve(interface, port, idle_timeout=IDLE_TIMEOUT, impairment=None):
+    loop = asyncio.get_running_loop()
+    transport, server = await loop.create_datagram_endpoint(
+        lambda: GameServer(idle_timeout, impairment=impairment),
+        local_addr=(interface or "0.0.0.0", port),
+    )
+    print("Hosting games at {}".format(transport.get_extra_info("sockname")))
+    try:
+        await server.evict_idle()
+    finally:
+        transport.close()
+
+
+def multi_server(interface, port, idle_timeout=IDLE_TIMEOUT, impairment=None):
+    """
+    Hosts as many games as clients care to start, each against the server's player 2
+    """
+    try:
+        asyncio.run(serve(interface, port, idle_timeout, impairment))
+    except KeyboardInterrupt:
+        pass
+
+
+class LoadClient(asyncio.DatagramProtocol):
+    """
+    Matches the server's replies to the games waiting on them, in either protocol,
+    and counts the bytes each way. Moves are numbered, and resent on an adaptive
+    timeout until the server answers.
+    """
+
+    def __init__(self, protocol="binary", impairment=None):
+        self.protocol = protocol
+        self.impairment = impairment
+        self.waiting = {}
+        self.seqs = {}
+        self.rtt = RttEstimator()
+        self.bytes_sent = self.bytes_received = 0
+        self.retransmits = 0
+
+    def connection_made(self, transport):
+        if self.impairment:
+            transport = ImpairedTransport(transport, self.impairment)
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        self.bytes_received += len(data)
+        try:
+            if is_json(data):
+                reply = json.loads(data)
+                game, board, result = reply["game"], reply["board"], reply["result"]
+                seq = reply.get("seq")
+            else:
+                kind, seq, game, body = decode(data)
+                if kind != BOARD:
+                    return
+                cells, status = body
+                board = [SYMBOLS[cell] for cell in cells]
+                result = None if status == "refused" else status
+            expected, future = self.waiting.get(game, (None, None))
+        except (ValueError, KeyError, TypeError):
+            # not an answer to any of our moves
+            return
+        # a late reply to an earlier send of the last move is no use now
+        if future is not None and not future.done() and seq == expected:
+            future.set_result((board, result))
+
+    def _send(self, data):
+        self.bytes_sent += len(data)
+        self.transport.sendto(data)
+
+    async def move(self, game, move, timeout):
+        """
+        Plays move 1-9 in game, returning the board and result the server sends.
+        Raises asyncio.TimeoutError if there's no answer within timeout seconds.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # wraps round to 1, since 0 means unnumbered
+        seq = self.seqs[game] = self.seqs.get(game, 0) % 0xFFFF + 1
+        self.waiting[game] = (seq, future)
+        if self.protocol == "json":
+            message = {"game": game, "move": move, "seq": seq}
+            data = json.dumps(message).encode("utf-8")
+        else:
+            data = encode_move(game, move - 1, X, seq)
+        deadline = loop.time() + timeout
+        try:
+            for attempt in itertools.count():
+                sent = loop.time()
+                if sent >= deadline:
+                    raise asyncio.TimeoutError
+                if attempt:
+                    self.retransmits += 1
+                self._send(data)
+                wait = min(self.rtt.timeout(attempt), deadline - sent)
+                try:
+                    reply = await asyncio.wait_for(asyncio.shield(future), wait)
+                except asyncio.TimeoutError:
+                    continue
+                if attempt == 0:
+                    self.rtt.sample(loop.time() - sent)
+                return reply
+        finally:
+            self.waiting.pop(game, None)
+
+
+async def play_scripted(client, game, rng, timeout, latencies):
+    """
+    Plays one game as player 1, trying cells in a random order, and returns the result
+    """
+    order = rng.sample(NUMBERS, len(NUMBERS))
+    board = [""] * 9
+    while True:
+        move = next(cell for cell in order if not board[cell - 1])
+        start = time.perf_counter()
+        board, result = await client.move(game, move, timeout)
+        latencies.append(time.perf_counter() - start)
+        if result:
+            return result
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def load_test(
+    host,
+    port,
+    games=1000,
+    concurrency=100,
+    timeout=MOVE_TIMEOUT,
+    seed=0,
+    protocol="binary",
+    impairment=None,
+):
+    """
+    Plays games scripted games against a multi_server, concurrency at a time over
+    one socket, and returns a report of throughput, move latency, bytes per move and
+    retransmits
+    """
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(
+        lambda: LoadClient(protocol, impairment),
+        remote_addr=(host or "localhost", port),
+    )
+    rng = random.Random(seed)
+    limit = asyncio.Semaphore(concurrency)
+    latencies, results = [], {}
+
+    async def run(game):
+        async with limit:
+            try:
+                result = await play_scripted(client, game, rng, timeout, latencies)
+            except asyncio.TimeoutError:
+                result = "timeout"
+            results[result] = results.get(result, 0) + 1
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(run(game) for game in range(games)))
+    finally:
+        transport.close()
+    elapsed = time.perf_counter() - start
+
+    completed = games - results.get("timeout", 0)
+    quantiles = (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+    return {
+        "games": games,
+        "results": results,
+        "seconds": elapsed,
+        "games_per_second": completed / elapsed,
+        "moves": len(latencies),
+        "protocol": protocol,
+        "bytes_per_move": (client.bytes_sent + client.bytes_received)
+        / max(1, len(latencies)),
+        "retransmits": client.retransmits,
+        "latency_ms": {
+            name: percentile(latencies, fraction) * 1000
+            for name, fraction in (quantiles if latencies else ())
+        },
+    }
+
+
+def load_generator(
+    host, port, games=1000, concurrency=100, protocol="binary", impairment=None
+):
+    report = asyncio.run(
+        load_test(
+            host, port, games, concurrency, protocol=protocol, impairment=impairment
+        )
+    )
+    print("Played {games} games in {seconds:.2f}s".format(**report))
+    print("{games_per_second:.0f} games/s, {moves} moves".format(**report))
+    print("{retransmits} retransmits".format(**report))
+    print("{bytes_per_move:.1f} bytes per move over {protocol}".format(**report))
+    print(
+        "Results: "
+        + ", ".join("{} {}".format(k, v) for k, v in sorted(report["results"].items()))
+    )
+    print(
+        "Move latency: "
+        + ", ".join("{} {:.2f}ms".format(k, v) for k, v in report["latency_ms"].items())
+    )
+    return report
 
 
 if __name__ == "__main__":
-    choices = {"client": player1_client, "server": player2_server}
+    choices = {
+        "client": player1_client,
+        "server": player2_server,
+        "ai": ai_server,
+        "multiserver": multi_server,
+        "loadgen": load_generator,
+    }
     parser = argparse.ArgumentParser(
         description="Send and receive UDP," " pretending packets are often dropped"
     )
@@ -151,6 +1098,57 @@ if __name__ == "__main__":
     parser.add_argument(
         "-p", metavar="PORT", type=int, default=1060, help="UDP port (default 1060)"
     )
+    parser.add_argument(
+        "--protocol",
+        choices=["binary", "json"],
+        default="binary",
+        help="wire format for the client and load generator; servers answer in kind",
+    )
+    parser.add_argument(
+        "--games", type=int, default=1000, help="games the load generator plays"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=100,
+        help="games the load generator plays at once",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=IDLE_TIMEOUT,
+        help="seconds before the multiserver drops an idle game",
+    )
+    parser.add_argument(
+        "--loss",
+        type=float,
+        default=0,
+        help="fraction of the datagrams this end sends to drop on purpose",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="milliseconds to hold each datagram this end sends",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0,
+        help="up to this many more milliseconds, at random",
+    )
     args = parser.parse_args()
+    impairment = None
+    if args.loss or args.latency or args.jitter:
+        impairment = Impairment(args.loss, args.latency / 1000, args.jitter / 1000)
     function = choices[args.role]  # closure - binds either server or client to function
-    function(args.host, args.p)  # invokes bound function with port
+    if args.role == "multiserver":
+        function(args.host, args.p, args.idle_timeout, impairment)
+    elif args.role == "loadgen":
+        function(
+            args.host, args.p, args.games, args.concurrency, args.protocol, impairment
+        )
+    elif args.role == "client":
+        function(args.host, args.p, args.protocol, impairment)
+    else:
+        function(args.host, args.p, impairment)  # invokes bound function with port